@@ -0,0 +1,285 @@
+import asyncio
+import heapq
+import json
+import ssl
+import urllib.parse
+
+from merge_proxy import SSBAPI, AuthenticationError
+
+
+class AsyncSSBAPI:
+    # the coroutine version of SSBAPI; the connection only needs an awaitable request() that returns
+    # a response with a status and an awaitable read(), so many requests can be in flight on one loop
+    def __init__(self, connection):
+        self.conn = connection
+        self.authentication_token = None
+        self._credentials = None
+        self._login_lock = asyncio.Lock()
+
+    async def login(self, username, password):
+        # kept to be able to log in again when the session expires
+        self._credentials = (username, password)
+        self.authentication_token = await self._login(username, password)
+
+    async def _login(self, username, password):
+        params = urllib.parse.urlencode({'username': username, 'password': password})
+        headers = {"Content-type": "application/x-www-form-urlencoded",
+                   "Accept": "text/plain"}
+        response = await self.conn.request("POST", "/api/1/login", params, headers)
+        raw_response = (await response.read()).decode()
+        try:
+            token = json.loads(raw_response)['result']
+        except (ValueError, KeyError, TypeError):
+            token = None
+        if response.status != 200 or not isinstance(token, str):
+            raise AuthenticationError("Login as '%s' failed with HTTP status %d" % (username, response.status))
+        return token
+
+    async def list_logspaces(self):
+        return set(await self._get_response_for_query("/api/1/search/logspace/list_logspaces"))
+
+    async def _get_response_for_query(self, get_query):
+        response = await self._authenticated_response(get_query)
+        response_body = json.loads((await response.read()).decode())
+        return response_body['result']
+
+    async def _authenticated_response(self, get_query):
+        token = self.authentication_token
+        response = await self._authenticated_get_query(get_query, token)
+        if response.status == 401 and self._credentials is not None:
+            # the session expired or the SSB was restarted: one new login and one more try
+            await response.read()
+            await self._renew_session(token)
+            response = await self._authenticated_get_query(get_query, self.authentication_token)
+        if response.status == 401:
+            await response.read()
+            raise AuthenticationError("The session was rejected by the SSB")
+        return response
+
+    async def _renew_session(self, rejected_token):
+        async with self._login_lock:
+            # the other coroutines getting the same 401 find the session renewed already
+            if self.authentication_token == rejected_token:
+                self.authentication_token = await self._login(*self._credentials)
+
+    async def _authenticated_get_query(self, get_query, authentication_token):
+        return await self.conn.request("GET", get_query,
+                                       headers={
+                                           "Cookie": urllib.parse.urlencode(
+                                               {"AUTHENTICATION_TOKEN": authentication_token})
+                                       })
+
+    async def logout(self):
+        self._credentials = None
+        response = await self._authenticated_get_query("/api/1/logout", self.authentication_token)
+        await response.read()
+
+    async def filter(self, logspace, from_timestamp=0, to_timestamp=9999999999, search_expression=None, offset=0, limit=10):
+        return await self._get_response_for_query(
+            SSBAPI._filter_type_query("filter", logspace, from_timestamp, to_timestamp, search_expression,
+                                      offset, limit))
+
+    async def number_of_messages(self, logspace, from_timestamp=0, to_timestamp=9999999999, search_expression=None, offset=0, limit=10):
+        return await self._get_response_for_query(
+            SSBAPI._filter_type_query("number_of_messages", logspace, from_timestamp, to_timestamp,
+                                      search_expression))
+
+
+class AsyncHTTPSConnection:
+    # a minimal HTTP/1.1 client on asyncio streams, keeping up to maxsize idle keep-alive connections
+    _STALE_CONNECTION_ERRORS = (ConnectionError, asyncio.IncompleteReadError)
+
+    def __init__(self, address, maxsize=16, timeout=None, context=None):
+        (self._host, separator, port) = address.partition(':')
+        self._port = int(port) if separator else 443
+        self._address = address
+        self._maxsize = maxsize
+        self._timeout = timeout
+        self._context = context if context is not None else ssl.create_default_context()
+        self._idle_streams = []
+
+    async def request(self, method, url, body=None, headers={}):
+        return await asyncio.wait_for(self._request(method, url, body, headers), self._timeout)
+
+    async def _request(self, method, url, body, headers):
+        if self._idle_streams:
+            (reader, writer) = self._idle_streams.pop()
+            try:
+                return await self._exchange(reader, writer, method, url, body, headers)
+            except self._STALE_CONNECTION_ERRORS:
+                # the server may have closed the idle connection meanwhile, that's worth one retry
+                writer.close()
+        (reader, writer) = await asyncio.open_connection(self._host, self._port, ssl=self._context)
+        try:
+            return await self._exchange(reader, writer, method, url, body, headers)
+        except BaseException:
+            writer.close()
+            raise
+
+    async def _exchange(self, reader, writer, method, url, body, headers):
+        if isinstance(body, str):
+            body = body.encode()
+        request_headers = {"Host": self._address, "Content-Length": str(len(body or b''))}
+        request_headers.update(headers)
+        head = "%s %s HTTP/1.1\r\n" % (method, url)
+        head += "".join("%s: %s\r\n" % header for header in request_headers.items())
+        writer.write(head.encode('latin-1') + b"\r\n" + (body or b''))
+        await writer.drain()
+
+        status_line = await reader.readuntil(b"\r\n")
+        status = int(status_line.split()[1])
+        response_headers = {}
+        while True:
+            line = await reader.readuntil(b"\r\n")
+            if line == b"\r\n":
+                break
+            (name, _, value) = line.decode('latin-1').partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+        data = await self._read_body(reader, response_headers)
+
+        if response_headers.get('connection', '').lower() == 'close' or len(self._idle_streams) >= self._maxsize:
+            writer.close()
+        else:
+            self._idle_streams.append((reader, writer))
+        return AsyncHTTPResponse(status, response_headers, data)
+
+    @staticmethod
+    async def _read_body(reader, response_headers):
+        if response_headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                chunk_size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+                if chunk_size == 0:
+                    await reader.readuntil(b"\r\n")
+                    return b"".join(chunks)
+                chunks.append(await reader.readexactly(chunk_size))
+                await reader.readexactly(2)
+        if 'content-length' in response_headers:
+            return await reader.readexactly(int(response_headers['content-length']))
+        response_headers['connection'] = 'close'
+        return await reader.read()
+
+    def close(self):
+        for (reader, writer) in self._idle_streams:
+            writer.close()
+        self._idle_streams = []
+
+
+class AsyncHTTPResponse:
+    def __init__(self, status, headers, data):
+        self.status = status
+        self._headers = headers
+        self._data = data
+
+    def getheader(self, name, default=None):
+        return self._headers.get(name.lower(), default)
+
+    async def read(self):
+        return self._data
+
+
+class AsyncSSB(AsyncSSBAPI):
+    def __init__(self, address, timeout=None, pool_size=16, context=None):
+        self.address = address
+        super().__init__(AsyncHTTPSConnection(address, maxsize=pool_size, timeout=timeout, context=context))
+
+
+class AsyncSSBCursor:
+    # the async counterpart of SSBCursor: one page of one SSB is held in memory at a time
+    def __init__(self, ssb, logspace, from_timestamp, to_timestamp, search_expression, page_size):
+        self._ssb = ssb
+        self._query = (logspace, from_timestamp, to_timestamp, search_expression)
+        self._page_size = page_size
+        self._page = []
+        self._position = 0
+        self._next_offset = 0
+        self._exhausted = False
+
+    async def fetch_page(self):
+        self._page = []
+        self._position = 0
+        if self._exhausted:
+            return
+        self._page = await self._ssb.filter(*self._query, offset=self._next_offset, limit=self._page_size)
+        self._next_offset += len(self._page)
+        if len(self._page) < self._page_size:
+            self._exhausted = True
+
+    async def next(self):
+        if self._position >= len(self._page):
+            await self.fetch_page()
+            if len(self._page) == 0:
+                return None
+        log = self._page[self._position]
+        self._position += 1
+        return log
+
+
+class AsyncMergeProxy:
+    def __init__(self, ssbs, max_concurrency=None, timeout=None, page_size=1000):
+        self.ssbs = ssbs
+        self._max_concurrency = max_concurrency if max_concurrency is not None else max(len(ssbs), 1)
+        self._timeout = timeout
+        self._page_size = page_size
+
+    async def _fan_out(self, coroutine_func, backends):
+        # the semaphore is created here, so it's bound to the loop the caller runs on
+        semaphore = asyncio.Semaphore(self._max_concurrency)
+
+        async def call(backend):
+            async with semaphore:
+                return await asyncio.wait_for(coroutine_func(backend), self._timeout)
+
+        return await asyncio.gather(*[call(backend) for backend in backends])
+
+    async def login(self, username, password):
+        await self._fan_out(lambda ssb_instance: ssb_instance.login(username, password), self.ssbs)
+
+    async def logout(self):
+        await self._fan_out(lambda ssb_instance: ssb_instance.logout(), self.ssbs)
+
+    async def list_logspaces(self):
+        logspaces = set()
+        for ssb_logspaces in await self._fan_out(lambda ssb_instance: ssb_instance.list_logspaces(), self.ssbs):
+            logspaces |= ssb_logspaces
+        return logspaces
+
+    async def number_of_messages(self, logspace, from_timestamp=0, to_timestamp=9999999999, search_expression=None):
+        counts = await self._fan_out(
+            lambda ssb_instance: ssb_instance.number_of_messages(logspace, from_timestamp, to_timestamp,
+                                                                 search_expression),
+            self.ssbs)
+        return sum(counts)
+
+    async def filter(self, logspace, from_timestamp=0, to_timestamp=9999999999, search_expression=None, offset=0, limit=10):
+        offset = int(offset)
+        limit = int(limit)
+        if limit <= 0:
+            return []
+
+        page_size = min(self._page_size, offset + limit)
+        cursors = [AsyncSSBCursor(ssb_instance, logspace, from_timestamp, to_timestamp, search_expression, page_size)
+                   for ssb_instance in self.ssbs]
+        await self._fan_out(lambda cursor: cursor.fetch_page(), cursors)
+
+        # the same (key, SSB index, log) heap as in KWayMerger, but a cursor running dry may await its next page
+        heap = []
+        for (ssb_index, cursor) in enumerate(cursors):
+            log = await cursor.next()
+            if log is not None:
+                heap.append((log['processed_timestamp'], ssb_index, log))
+        heapq.heapify(heap)
+
+        logs = []
+        while heap and len(logs) < limit:
+            (timestamp, ssb_index, log) = heap[0]
+            next_log = await cursors[ssb_index].next()
+            if next_log is None:
+                heapq.heappop(heap)
+            else:
+                heapq.heapreplace(heap, (next_log['processed_timestamp'], ssb_index, next_log))
+            if offset > 0:
+                offset -= 1
+            else:
+                logs.append(log)
+        return logs
@@ -0,0 +1,267 @@
+import asyncio
+import unittest
+import urllib.parse, json
+from async_merge_proxy import *
+from fake_ssb import FakeSSB, SyntheticLogspace
+
+
+class AsyncSSBAPITests(unittest.TestCase):
+    USERNAME = "foo"
+    PASSWORD = "bar"
+    LOGSPACE_NAME = "apple"
+    AUTH_TOKEN = "asdfasdfaqwerqwerqewr"
+
+    def _get_connection_api_pair(self, responses):
+        connection = MockAsyncHTTPConnection()
+        connection.set_responses(responses)
+        return connection, AsyncSSBAPI(connection)
+
+    def _generate_successful_response(self, object_to_return):
+        return json.dumps({"result": object_to_return})
+
+    def test_login_calls_a_post_with_the_user_and_pass(self):
+        (connection, api) = self._get_connection_api_pair([self._generate_successful_response(self.AUTH_TOKEN)])
+
+        asyncio.run(api.login(self.USERNAME, self.PASSWORD))
+
+        (method, url, body, headers) = connection.get_requests()[0]
+        self.assertEqual("POST", method)
+        self.assertEqual("/api/1/login", url)
+        self.assertEqual(urllib.parse.urlencode({'username': self.USERNAME, 'password': self.PASSWORD}), body)
+        self.assertEqual(self.AUTH_TOKEN, api.authentication_token)
+
+    def test_filter_proxies_filter_with_the_auth_token(self):
+        LOGS = [{"logmsg1": "logvalue1"}, {"logmsg2": "logvalue2"}]
+        (connection, api) = self._get_connection_api_pair([self._generate_successful_response(self.AUTH_TOKEN),
+                                                           self._generate_successful_response(LOGS)])
+
+        async def login_and_filter():
+            await api.login(self.USERNAME, self.PASSWORD)
+            return await api.filter(self.LOGSPACE_NAME, 123, 456, "search_expression", 222, 333)
+
+        self.assertEqual(LOGS, asyncio.run(login_and_filter()))
+        (method, url, body, headers) = connection.get_requests()[1]
+        self.assertEqual("GET", method)
+        parsed_url = urllib.parse.urlparse(url)
+        self.assertEqual("/api/1/search/logspace/filter/%s" % self.LOGSPACE_NAME, parsed_url.path)
+        self.assertDictEqual({'from': ['123'], 'to': ['456'], 'search_expression': ['search_expression'],
+                              'offset': ['222'], 'limit': ['333']},
+                             urllib.parse.parse_qs(parsed_url.query))
+        self.assertEqual("AUTHENTICATION_TOKEN=%s" % self.AUTH_TOKEN, headers['Cookie'])
+
+    def test_failed_login_raises_authentication_error(self):
+        for response in ((401, '{"error": {"message": "bad password"}}'), '{"result": null}', "<html>"):
+            (connection, api) = self._get_connection_api_pair([response])
+
+            with self.assertRaises(AuthenticationError):
+                asyncio.run(api.login(self.USERNAME, self.PASSWORD))
+
+    def test_expired_session_is_renewed_and_the_request_is_sent_again(self):
+        (connection, api) = self._get_connection_api_pair([
+            self._generate_successful_response("old_token"),  # login
+            (401, '{"error": {"message": "session expired"}}'),  # list_logspaces
+            self._generate_successful_response("new_token"),  # login again
+            self._generate_successful_response(["logspace1"]),  # list_logspaces again
+        ])
+
+        async def login_and_list():
+            await api.login(self.USERNAME, self.PASSWORD)
+            return await api.list_logspaces()
+
+        self.assertEqual({"logspace1"}, asyncio.run(login_and_list()))
+        requests = connection.get_requests()
+        self.assertListEqual(["/api/1/login", "/api/1/search/logspace/list_logspaces", "/api/1/login",
+                              "/api/1/search/logspace/list_logspaces"],
+                             [url for (method, url, body, headers) in requests])
+        self.assertEqual("AUTHENTICATION_TOKEN=new_token", requests[3][3]['Cookie'])
+
+    def test_rejected_session_without_credentials_raises_authentication_error(self):
+        (connection, api) = self._get_connection_api_pair([(401, "")])
+
+        with self.assertRaises(AuthenticationError):
+            asyncio.run(api.list_logspaces())
+
+    def test_list_logspaces_and_number_of_messages_are_proxied(self):
+        (connection, api) = self._get_connection_api_pair([self._generate_successful_response(["a", "b"]),
+                                                           self._generate_successful_response(999)])
+
+        async def query():
+            return await api.list_logspaces(), await api.number_of_messages(self.LOGSPACE_NAME)
+
+        self.assertEqual(({"a", "b"}, 999), asyncio.run(query()))
+        self.assertEqual("/api/1/search/logspace/list_logspaces", connection.get_requests()[0][1])
+
+    def test_logout_is_proxied_to_logout(self):
+        (connection, api) = self._get_connection_api_pair([])
+
+        asyncio.run(api.logout())
+
+        self.assertEqual("/api/1/logout", connection.get_requests()[0][1])
+
+
+class MockAsyncHTTPConnection:
+    def __init__(self):
+        self.requests = []
+        self.responses = []
+
+    def set_responses(self, responses):
+        self.responses = responses
+
+    def get_requests(self):
+        return self.requests
+
+    async def request(self, method, url, body=None, headers={}):
+        self.requests.append((method, url, body, headers))
+        (status, response_data) = (200, "")
+        if len(self.responses) > 0:
+            response_data = self.responses.pop(0)
+        if isinstance(response_data, tuple):
+            (status, response_data) = response_data
+        return AsyncHTTPResponse(status, {}, str.encode(response_data))
+
+
+class AsyncMergeProxyTest(unittest.TestCase):
+    LOGSPACE_NAME = "testlogspacename"
+
+    def _create_ssbs_with_interleaved_logs(self, number_of_ssbs, logs_per_ssb):
+        ssbs = []
+        all_logs = []
+        for i in range(number_of_ssbs):
+            new_logs = [{'processed_timestamp': j * number_of_ssbs + i, 'host': i} for j in range(logs_per_ssb)]
+            ssbs.append(MockAsyncSSB(logs=new_logs))
+            all_logs += new_logs
+        all_logs = sorted(all_logs, key=lambda log: log['processed_timestamp'])
+        return tuple(ssbs), all_logs
+
+    def test_list_logspaces_results_are_merged(self):
+        proxy = AsyncMergeProxy((MockAsyncSSB(logspaces={"a", "b"}), MockAsyncSSB(logspaces={"b", "c"})))
+
+        self.assertSetEqual({"a", "b", "c"}, asyncio.run(proxy.list_logspaces()))
+
+    def test_number_of_messages_is_added_from_multiple_SSBs(self):
+        proxy = AsyncMergeProxy(tuple(MockAsyncSSB(number_of_messages=i) for i in range(10)))
+
+        self.assertEqual(sum(range(10)), asyncio.run(proxy.number_of_messages(self.LOGSPACE_NAME)))
+
+    def test_filter_merges_the_SSBs_in_timestamp_order(self):
+        (ssbs, all_logs) = self._create_ssbs_with_interleaved_logs(number_of_ssbs=4, logs_per_ssb=20)
+        proxy = AsyncMergeProxy(ssbs)
+
+        self.assertListEqual(all_logs[:30], asyncio.run(proxy.filter(self.LOGSPACE_NAME, limit=30)))
+
+    def test_filter_with_offset_pages_through_the_SSBs(self):
+        (ssbs, all_logs) = self._create_ssbs_with_interleaved_logs(number_of_ssbs=3, logs_per_ssb=50)
+        proxy = AsyncMergeProxy(ssbs, page_size=7)
+
+        self.assertListEqual(all_logs[95:120], asyncio.run(proxy.filter(self.LOGSPACE_NAME, offset=95, limit=25)))
+
+    def test_SSBs_are_queried_concurrently(self):
+        number_of_ssbs = 20
+        ssbs = tuple(MockAsyncSSB(number_of_messages=1, delay=0.2) for i in range(number_of_ssbs))
+        proxy = AsyncMergeProxy(ssbs)
+
+        loop = asyncio.new_event_loop()
+        started = loop.time()
+        self.assertEqual(number_of_ssbs, loop.run_until_complete(proxy.number_of_messages(self.LOGSPACE_NAME)))
+        self.assertLess(loop.time() - started, 0.2 * number_of_ssbs / 2)
+        loop.close()
+
+    def test_slow_SSB_raises_timeout_error(self):
+        proxy = AsyncMergeProxy((MockAsyncSSB(), MockAsyncSSB(delay=1)), timeout=0.05)
+
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(proxy.number_of_messages(self.LOGSPACE_NAME))
+
+    def test_login_is_sent_to_every_SSB(self):
+        ssbs = (MockAsyncSSB(), MockAsyncSSB())
+        proxy = AsyncMergeProxy(ssbs)
+
+        asyncio.run(proxy.login("user", "password"))
+
+        for ssb in ssbs:
+            self.assertEqual([("login", ("user", "password"))], ssb.calls)
+
+
+class AsyncSSBTests(unittest.TestCase):
+    def _fake_ssb(self, **kwargs):
+        fake_ssb = FakeSSB([SyntheticLogspace('center', 500), SyntheticLogspace('other', 10)], seed=1,
+                           **kwargs).start()
+        self.addCleanup(fake_ssb.stop)
+        return fake_ssb
+
+    def _run(self, fake_ssb, query):
+        # the connections belong to the loop of asyncio.run, they are closed before it ends
+        async def run():
+            ssb = AsyncSSB(fake_ssb.address, timeout=5, context=FakeSSB.client_context())
+            try:
+                await ssb.login("user", "password")
+                return await query(ssb)
+            finally:
+                ssb.conn.close()
+
+        return asyncio.run(run())
+
+    def test_queries_share_one_kept_alive_connection(self):
+        for chunked in (False, True):
+            with self.subTest(chunked=chunked):
+                fake_ssb = self._fake_ssb(chunked=chunked)
+
+                async def query(ssb):
+                    return (await ssb.list_logspaces(), await ssb.number_of_messages('center'),
+                            await ssb.filter('center', offset=100, limit=300))
+
+                (logspaces, count, logs) = self._run(fake_ssb, query)
+
+                self.assertSetEqual({'center', 'other'}, logspaces)
+                self.assertEqual(500, count)
+                self.assertListEqual(list(range(100, 400)), [log['pid'] for log in logs])
+                self.assertEqual(1, fake_ssb.connections)
+
+    def test_connection_closed_by_the_SSB_is_replaced(self):
+        fake_ssb = self._fake_ssb(chunked=True)
+
+        async def query(ssb):
+            fake_ssb.drop_connections()
+            await asyncio.sleep(0.05)
+            return await ssb.number_of_messages('other')
+
+        self.assertEqual(10, self._run(fake_ssb, query))
+        self.assertEqual(2, fake_ssb.connections)
+
+    def test_concurrent_queries_open_more_connections(self):
+        fake_ssb = self._fake_ssb()
+        fake_ssb.latency = 0.05
+
+        async def query(ssb):
+            return await asyncio.gather(*[ssb.number_of_messages('other') for i in range(3)])
+
+        self.assertListEqual([10, 10, 10], self._run(fake_ssb, query))
+        self.assertEqual(3, fake_ssb.connections)
+
+
+class MockAsyncSSB:
+    def __init__(self, logspaces=set(), number_of_messages=0, logs=[], delay=0):
+        self._logspaces = logspaces
+        self._number_of_messages = number_of_messages
+        self._logs = logs
+        self._delay = delay
+        self.calls = []
+
+    async def login(self, *args):
+        self.calls.append(("login", args))
+
+    async def list_logspaces(self):
+        await asyncio.sleep(self._delay)
+        return self._logspaces
+
+    async def number_of_messages(self, *args, **kwargs):
+        await asyncio.sleep(self._delay)
+        return self._number_of_messages
+
+    async def filter(self, *args, offset=0, limit=10):
+        await asyncio.sleep(self._delay)
+        return self._logs[offset:offset + limit]
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+import argparse
+import datetime
+import gc
+import io
+import json
+import multiprocessing
+import resource
+import time
+import tracemalloc
+
+from fake_ssb import FIRST_TIMESTAMP, FakeSSB, SyntheticLogspace
+import json_stream
+from log_batch import LogBatch, LogRecord, RawRecord, RecordEncoder, json_default
+from merge_proxy import SSB, KWayMerger, MergeProxy, SeekIndex
+from syslog_format import MODES, SyslogFormatter
+
+
+class LinearScanKWayMerger:
+    # the original KWayMerger implementation that scans every source on each next(), kept as the baseline
+    def __init__(self, fetch_functions):
+        self._fetch_functions = fetch_functions
+        self._next_values = [None] * len(fetch_functions)
+
+    def next(self):
+        for i, fetch_func in enumerate(self._fetch_functions):
+            if self._next_values[i] is None:
+                self._next_values[i] = fetch_func()
+
+        smallest = None
+        smallest_key = None
+        for i, current in enumerate(self._next_values):
+            if smallest is None or (current is not None and current < smallest):
+                smallest = current
+                smallest_key = i
+        self._next_values[smallest_key] = None
+        return smallest
+
+
+def _zipper_fetchers(number_of_sources, items_per_source):
+    fetchers = []
+    for i in range(number_of_sources):
+        iterator = iter(range(i, number_of_sources * items_per_source, number_of_sources))
+        fetchers.append(lambda iterator=iterator: next(iterator, None))
+    return fetchers
+
+
+def _time_merge(merge):
+    started = time.perf_counter()
+    merged_count = merge()
+    return merged_count, time.perf_counter() - started
+
+
+def _drain_with_next(merger):
+    count = 0
+    while merger.next() is not None:
+        count += 1
+    return count
+
+
+def _drain_with_take(merger, batch_size):
+    count = 0
+    while True:
+        taken = len(merger.take(batch_size))
+        if taken == 0:
+            return count
+        count += taken
+
+
+def benchmark_merger(args):
+    print("%8s %10s %-22s %10s %14s" % ("sources", "items", "implementation", "seconds", "items/sec"))
+    for number_of_sources in args.sources:
+        items_per_source = max(args.items // number_of_sources, 1)
+        runs = (
+            ("linear scan next()",
+             lambda: _drain_with_next(LinearScanKWayMerger(_zipper_fetchers(number_of_sources, items_per_source)))),
+            ("heap next()",
+             lambda: _drain_with_next(KWayMerger(_zipper_fetchers(number_of_sources, items_per_source)))),
+            ("heap take(%d)" % args.batch_size,
+             lambda: _drain_with_take(KWayMerger(_zipper_fetchers(number_of_sources, items_per_source)),
+                                      args.batch_size)),
+        )
+        for (name, merge) in runs:
+            (merged_count, seconds) = _time_merge(merge)
+            print("%8d %10d %-22s %10.3f %14.0f" % (number_of_sources, merged_count, name, seconds,
+                                                    merged_count / seconds))
+
+
+def _per_record_format(logs, stream):
+    # the original exporter: a datetime and a print for every single log
+    for log in logs:
+        log['date'] = datetime.datetime.fromtimestamp(int(log['timestamp'])).strftime('%Y-%m-%dT%H:%M:%S')
+        stream.write(('%(date)s %(host)s %(program)s[%(pid)s]: %(message)s' % log).encode('utf-8') + b'\n')
+
+
+def _syslog_logs(number_of_logs, logs_per_second):
+    return [{'timestamp': 1425599507 + i // logs_per_second, 'host': "host%d" % (i % 50), 'program': "sshd",
+             'pid': i, 'message': "Accepted publickey for user%d from 10.0.%d.%d" % (i, i % 256, i % 200)}
+            for i in range(number_of_logs)]
+
+
+def benchmark_formatter(args):
+    logs = _syslog_logs(args.logs, args.logs_per_second)
+    pages = [logs[i:i + args.page_size] for i in range(0, len(logs), args.page_size)]
+    print("%-22s %10s %14s" % ("implementation", "seconds", "logs/sec"))
+    runs = [("per-record print", lambda stream: _per_record_format(logs, stream))]
+    for mode in MODES:
+        runs.append(("%s pages" % mode, lambda stream, formatter=SyslogFormatter(mode):
+                     [formatter.write_page(page, stream) for page in pages]))
+    for (name, write) in runs:
+        stream = io.BytesIO()
+        started = time.perf_counter()
+        write(stream)
+        seconds = time.perf_counter() - started
+        print("%-22s %10.3f %14.0f" % (name, seconds, len(logs) / seconds))
+
+
+def _parsed_pages(number_of_logs, page_size):
+    # the logs are parsed from JSON page by page like the SSB responses, so no string is shared by accident
+    for first in range(0, number_of_logs, page_size):
+        logs = _syslog_logs(min(page_size, number_of_logs - first), 100)
+        for (i, log) in enumerate(logs):
+            log['processed_timestamp'] = log['timestamp'] + 1
+            log['pid'] = first + i
+        yield json.loads(json.dumps(logs))
+
+
+def _retained_memory(collect, number_of_logs, page_size):
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    kept = collect(_parsed_pages(number_of_logs, page_size))
+    seconds = time.perf_counter() - started
+    gc.collect()
+    (retained, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    return retained, peak, seconds
+
+
+def _collect_dicts(pages):
+    logs = []
+    for page in pages:
+        logs.extend(page)
+    return logs
+
+
+def _collect_batch(pages):
+    batch = LogBatch()
+    for page in pages:
+        batch.extend(LogBatch.from_logs(page))
+    return batch
+
+
+def benchmark_memory(args):
+    print("%-10s %10s %12s %12s %12s %10s" % ("records", "logs", "retained MB", "peak MB", "bytes/log", "seconds"))
+    for (name, collect) in (("dicts", _collect_dicts), ("LogBatch", _collect_batch)):
+        (retained, peak, seconds) = _retained_memory(collect, args.logs, args.page_size)
+        print("%-10s %10d %12.1f %12.1f %12.0f %10.3f" % (name, args.logs, retained / 2 ** 20, peak / 2 ** 20,
+                                                          retained / args.logs, seconds))
+
+
+def _serialize_dicts(body):
+    # what the proxy did before the RawRecords: the logs are decoded to dicts, then encoded again
+    return json.dumps(list(json_stream.iter_result(io.BytesIO(body).read))).encode('utf-8')
+
+
+def _serialize_log_records(body):
+    records = LogBatch(LogRecord.from_dict(log) for log in json_stream.iter_result(io.BytesIO(body).read))
+    return json.dumps(records.records, default=json_default).encode('utf-8')
+
+
+def _serialize_raw_records(body, encoder):
+    return encoder.encode(LogBatch(RawRecord.from_json(log, text)
+                                   for (log, text) in json_stream.iter_result(io.BytesIO(body).read, raw=True)))
+
+
+def benchmark_serialize(args):
+    # an SSB response is parsed and the page is encoded as the response of the proxy
+    logspace = SyntheticLogspace(SUITE_LOGSPACE, args.page_size, message_size=args.message_size)
+    body = json.dumps({'result': logspace.filter(0, 9999999999, 0, args.page_size)}).encode('utf-8')
+    runs = (("dicts", _serialize_dicts),
+            ("dicts orjson", lambda body, encoder=RecordEncoder(fast=True):
+             encoder.encode(list(json_stream.iter_result(io.BytesIO(body).read)))),
+            ("LogRecords", _serialize_log_records),
+            ("RawRecords", lambda body, encoder=RecordEncoder(): _serialize_raw_records(body, encoder)))
+    print("%-14s %10s %14s %12s" % ("records", "seconds", "logs/sec", "us/log"))
+    for (name, serialize) in runs:
+        started = time.perf_counter()
+        for i in range(args.pages):
+            serialize(body)
+        seconds = time.perf_counter() - started
+        number_of_logs = args.pages * args.page_size
+        print("%-14s %10.3f %14.0f %12.2f" % (name, seconds, number_of_logs / seconds,
+                                               seconds / number_of_logs * 1e6))
+
+
+SUITE_LOGSPACE = 'center'
+SUITE_SCENARIOS = ('export', 'merge', 'deep-paging')
+
+
+class _NullStream:
+    def write(self, data):
+        pass
+
+
+def _timed(call, latencies):
+    started = time.perf_counter()
+    result = call()
+    latencies.append(time.perf_counter() - started)
+    return result
+
+
+def _export_scenario(ssbs, options):
+    # the exporter: a single SSB paged through from the start, each page formatted as syslog lines
+    formatter = SyslogFormatter(timestamp_field='processed_timestamp')
+    (latencies, offset) = ([], 0)
+    while True:
+        page = _timed(lambda: ssbs[0].filter(SUITE_LOGSPACE, 0, 9999999999, offset=offset,
+                                             limit=options['page_size']), latencies)
+        formatter.write_page(page, _NullStream())
+        offset += len(page)
+        if len(page) < options['page_size']:
+            return offset, latencies
+
+
+def _merge_scenario(ssbs, options):
+    # queries of the first limit logs of windows spread over the logspace, each merged from all the SSBs
+    proxy = MergeProxy(ssbs, page_size=options['page_size'], compact=options['compact'])
+    seconds = options['logs'] // options['logs_per_second']
+    (latencies, logs) = ([], 0)
+    for query in range(options['queries']):
+        from_timestamp = FIRST_TIMESTAMP + seconds * query // options['queries']
+        logs += len(_timed(lambda: proxy.filter(SUITE_LOGSPACE, from_timestamp, 9999999999,
+                                                limit=options['limit']), latencies))
+    return logs, latencies
+
+
+def _deep_paging_scenario(ssbs, options):
+    # the merged logspace paged through with growing offsets, which the seek index should keep cheap
+    proxy = MergeProxy(ssbs, page_size=options['page_size'], seek_index=SeekIndex(), compact=options['compact'])
+    (latencies, logs) = ([], 0)
+    for page_number in range(options['queries']):
+        page = _timed(lambda: proxy.filter(SUITE_LOGSPACE, offset=page_number * options['limit'],
+                                           limit=options['limit']), latencies)
+        if not page:
+            break
+        logs += len(page)
+    return logs, latencies
+
+
+_SCENARIO_FUNCTIONS = {'export': _export_scenario, 'merge': _merge_scenario, 'deep-paging': _deep_paging_scenario}
+
+
+def _percentile(values, percent):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) * percent // 100, len(ordered) - 1)]
+
+
+def _run_scenario(scenario, addresses, options):
+    # runs in a process of its own, so the peak RSS is the scenario's only
+    ssbs = tuple(SSB(address, context=FakeSSB.client_context(), pool_size=options['pool_size'])
+                 for address in addresses)
+    for ssb in ssbs:
+        ssb.login('benchmark', 'benchmark')
+    started = time.perf_counter()
+    (logs, latencies) = _SCENARIO_FUNCTIONS[scenario](ssbs, options)
+    seconds = time.perf_counter() - started
+    for ssb in ssbs:
+        ssb.logout()
+    return {'scenario': scenario, 'backends': len(ssbs), 'logs': logs, 'requests': len(latencies),
+            'seconds': seconds, 'logs_per_second': logs / seconds,
+            'p50_latency': _percentile(latencies, 50), 'p99_latency': _percentile(latencies, 99),
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+def benchmark_suite(args):
+    options = {'logs': args.logs, 'logs_per_second': args.logs_per_second, 'page_size': args.page_size,
+               'limit': args.limit, 'queries': args.queries, 'compact': args.compact,
+               'pool_size': args.pool_size}
+    fake_ssbs = [FakeSSB([SyntheticLogspace(SUITE_LOGSPACE, args.logs, args.logs_per_second, args.message_size,
+                                            host_prefix='ssb%d-host' % i)],
+                         latency=args.latency, jitter=args.jitter, seed=i,
+                         compression=not args.no_compression).start()
+                 for i in range(args.backends)]
+    unknown = set(args.scenarios) - set(SUITE_SCENARIOS)
+    if unknown:
+        raise SystemExit("Unknown scenarios: %s" % ', '.join(sorted(unknown)))
+    results = []
+    print("%-12s %8s %10s %8s %10s %12s %10s %10s %12s %10s" % ("scenario", "backends", "logs", "requests", "seconds",
+                                                               "logs/sec", "p50 ms", "p99 ms", "peak RSS MB",
+                                                               "sent MB"))
+    try:
+        spawn = multiprocessing.get_context('spawn')
+        for scenario in args.scenarios or SUITE_SCENARIOS:
+            addresses = [fake_ssb.address for fake_ssb in (fake_ssbs[:1] if scenario == 'export' else fake_ssbs)]
+            sent_before = sum(fake_ssb.sent_bytes for fake_ssb in fake_ssbs)
+            with spawn.Pool(1) as pool:
+                result = pool.apply(_run_scenario, (scenario, addresses, options))
+            # what went over the "network" from the fake SSBs, compressed unless --no-compression
+            result['sent_bytes'] = sum(fake_ssb.sent_bytes for fake_ssb in fake_ssbs) - sent_before
+            results.append(result)
+            print("%-12s %8d %10d %8d %10.3f %12.0f %10.1f %10.1f %12.1f %10.1f" % (
+                scenario, result['backends'], result['logs'], result['requests'], result['seconds'],
+                result['logs_per_second'], result['p50_latency'] * 1000, result['p99_latency'] * 1000,
+                result['peak_rss_kb'] / 1024, result['sent_bytes'] / 2 ** 20))
+    finally:
+        for fake_ssb in fake_ssbs:
+            fake_ssb.stop()
+
+    if args.baseline is not None:
+        _compare(results, args.baseline)
+    if args.output is not None:
+        parameters = dict(options, backends=args.backends, message_size=args.message_size, latency=args.latency,
+                          jitter=args.jitter, compression=not args.no_compression)
+        with open(args.output, 'w') as output:
+            json.dump({'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'parameters': parameters, 'results': results},
+                      output, indent=2)
+
+
+def _compare(results, baseline_path):
+    with open(baseline_path) as baseline_file:
+        baseline = {result['scenario']: result for result in json.load(baseline_file)['results']}
+    print("\ncompared with %s:" % baseline_path)
+    for result in results:
+        old = baseline.get(result['scenario'])
+        if old is not None:
+            print("%-12s logs/sec %+7.1f%%  p99 %+7.1f%%  peak RSS %+7.1f%%" % (
+                result['scenario'], _change(old['logs_per_second'], result['logs_per_second']),
+                _change(old['p99_latency'], result['p99_latency']), _change(old['peak_rss_kb'], result['peak_rss_kb'])))
+
+
+def _change(old, new):
+    return (new - old) * 100.0 / old if old else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks for the merge proxy building blocks")
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    merger_parser = subparsers.add_parser('merger', help="k-way merge of zipped integer sources")
+    merger_parser.add_argument('--sources', type=int, nargs='+', default=[10, 200, 2000])
+    merger_parser.add_argument('--items', type=int, default=20000, help="total number of merged items")
+    merger_parser.add_argument('--batch-size', type=int, default=1000)
+    merger_parser.set_defaults(func=benchmark_merger)
+
+    formatter_parser = subparsers.add_parser('formatter', help="syslog line formatting of exported logs")
+    formatter_parser.add_argument('--logs', type=int, default=200000)
+    formatter_parser.add_argument('--logs-per-second', type=int, default=100)
+    formatter_parser.add_argument('--page-size', type=int, default=1000)
+    formatter_parser.set_defaults(func=benchmark_formatter)
+
+    memory_parser = subparsers.add_parser('memory', help="memory held by merged logs as dicts and as a LogBatch")
+    memory_parser.add_argument('--logs', type=int, default=1000000)
+    memory_parser.add_argument('--page-size', type=int, default=1000)
+    memory_parser.set_defaults(func=benchmark_memory)
+
+    serialize_parser = subparsers.add_parser('serialize', help="parsing an SSB response and encoding it again")
+    serialize_parser.add_argument('--pages', type=int, default=200)
+    serialize_parser.add_argument('--page-size', type=int, default=1000)
+    serialize_parser.add_argument('--message-size', type=int, default=80)
+    serialize_parser.set_defaults(func=benchmark_serialize)
+
+    suite_parser = subparsers.add_parser('suite', help="export, merge and deep paging against local fake SSBs")
+    suite_parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                              help="some of %s, all of them by default" % ', '.join(SUITE_SCENARIOS))
+    suite_parser.add_argument('--backends', type=int, default=4, help="fake SSBs of the merge")
+    suite_parser.add_argument('--logs', type=int, default=100000, help="logs on each fake SSB")
+    suite_parser.add_argument('--logs-per-second', type=int, default=100)
+    suite_parser.add_argument('--message-size', type=int, default=80)
+    suite_parser.add_argument('--latency', type=float, default=0.005, help="seconds added to every request")
+    suite_parser.add_argument('--jitter', type=float, default=0.005, help="at most this many random seconds too")
+    suite_parser.add_argument('--page-size', type=int, default=1000)
+    suite_parser.add_argument('--limit', type=int, default=1000, help="logs asked by a merge or paging query")
+    suite_parser.add_argument('--queries', type=int, default=50)
+    suite_parser.add_argument('--pool-size', type=int, default=4, help="connections kept to each fake SSB")
+    suite_parser.add_argument('--compact', action='store_true', help="merge into compact LogBatches")
+    suite_parser.add_argument('--no-compression', action='store_true',
+                              help="the fake SSBs send uncompressed responses")
+    suite_parser.add_argument('--output', help="the results are saved here as JSON")
+    suite_parser.add_argument('--baseline', help="the JSON results of an earlier run to compare with")
+    suite_parser.set_defaults(func=benchmark_suite)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
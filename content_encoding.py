@@ -0,0 +1,122 @@
+# The HTTP content codings of the merge proxy: the responses of the proxy are compressed with the best
+# coding a client accepts, and the SSBs are asked for compressed responses, which are decompressed while
+# they are read. zstd is only offered if the zstandard package is installed.
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# in the order of preference, when a client accepts more of them equally
+ENCODINGS = ('zstd', 'gzip', 'deflate') if zstandard is not None else ('gzip', 'deflate')
+
+_ZLIB_WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}  # deflate is the zlib format in HTTP
+
+
+def accept_encoding():
+    # the Accept-Encoding header of the requests to the SSBs
+    return ', '.join(ENCODINGS)
+
+
+def choose_encoding(accept_encoding_header):
+    # the coding to compress a response with, None if the client accepts none of ENCODINGS
+    if not accept_encoding_header:
+        return None
+    qualities = {}
+    for item in accept_encoding_header.split(','):
+        (coding, separator, parameters) = item.partition(';')
+        quality = 1.0
+        for parameter in parameters.split(';'):
+            (name, separator, value) = parameter.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.strip().lower()] = quality
+    best = None
+    for coding in ENCODINGS:
+        quality = qualities.get(coding, qualities.get('*', 0.0))
+        if quality > 0 and (best is None or quality > best[0]):
+            best = (quality, coding)
+    return None if best is None else best[1]
+
+
+class Compressor(object):
+    # compresses a body piece by piece; flush() sends out what the pieces so far compress to, so a
+    # streamed response doesn't wait in the compressor, finish() ends the body
+    def __init__(self, encoding):
+        if encoding == 'zstd':
+            self._compressor = zstandard.ZstdCompressor().compressobj()
+            self._flush_mode = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        else:
+            self._compressor = zlib.compressobj(6, zlib.DEFLATED, _ZLIB_WBITS[encoding])
+            self._flush_mode = zlib.Z_SYNC_FLUSH
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush(self._flush_mode)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+def compress(encoding, data):
+    compressor = Compressor(encoding)
+    return compressor.compress(data) + compressor.finish()
+
+
+def _decompressor(encoding):
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj()
+    if encoding in _ZLIB_WBITS:
+        return zlib.decompressobj(_ZLIB_WBITS[encoding])
+    raise ValueError("Unsupported Content-Encoding '%s'" % encoding)
+
+
+class DecodedResponse(object):
+    # the decompressed body of a compressed HTTP response, read like the response itself; its other
+    # attributes are the ones of the response
+    def __init__(self, response, encoding):
+        self._response = response
+        self._decompressor = _decompressor(encoding)
+        self._eof = False
+
+    def read(self, amt=None):
+        if amt is None:
+            return self.readall()
+        # a compressed chunk may not give a single byte yet, but an empty read would mean the end of the body
+        while not self._eof:
+            chunk = self._response.read(amt)
+            if not chunk:
+                self._eof = True
+                return self._flush()
+            data = self._decompressor.decompress(chunk)
+            if data:
+                return data
+        return b''
+
+    def readall(self):
+        if self._eof:
+            return b''
+        self._eof = True
+        return self._decompressor.decompress(self._response.read()) + self._flush()
+
+    def _flush(self):
+        flush = getattr(self._decompressor, 'flush', None)
+        return flush() if flush is not None else b''
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+
+def decoded(response):
+    # the response itself if it's not compressed
+    getheader = getattr(response, 'getheader', None)
+    encoding = getheader('Content-Encoding') if getheader is not None else None
+    if not encoding or encoding.strip().lower() == 'identity':
+        return response
+    return DecodedResponse(response, encoding.strip().lower())
@@ -0,0 +1,126 @@
+import gzip
+import io
+import json
+import unittest
+import zlib
+from content_encoding import *
+
+
+class ChooseEncodingTests(unittest.TestCase):
+    def test_the_most_preferred_accepted_coding_is_chosen(self):
+        self.assertEqual('gzip', choose_encoding('gzip, deflate'))
+        self.assertEqual('gzip', choose_encoding('deflate, gzip'))
+        self.assertEqual('deflate', choose_encoding('gzip;q=0.5, deflate'))
+        self.assertEqual('deflate', choose_encoding('br, DEFLATE ; q=0.8'))
+
+    def test_codings_of_zero_quality_are_refused(self):
+        self.assertEqual('deflate', choose_encoding('gzip;q=0, deflate;q=0.1'))
+        self.assertIsNone(choose_encoding('gzip;q=0, deflate;q=0'))
+        self.assertIsNone(choose_encoding('*;q=0'))
+
+    def test_wildcard_accepts_any_coding(self):
+        self.assertEqual(ENCODINGS[0], choose_encoding('*'))
+        self.assertIn(choose_encoding('gzip;q=0, *'), set(ENCODINGS) - {'gzip'})
+
+    def test_nothing_is_chosen_without_an_accepted_coding(self):
+        for header in (None, '', 'identity', 'br', 'gzip;q=invalid'):
+            self.assertIsNone(choose_encoding(header))
+
+
+class CompressorTests(unittest.TestCase):
+    CHUNKS = [json.dumps({'processed_timestamp': i, 'message': "message %d" % i}).encode() + b'\n'
+              for i in range(100)]
+
+    def test_compressed_bodies_are_the_standard_formats(self):
+        body = b''.join(self.CHUNKS)
+
+        self.assertEqual(body, gzip.decompress(compress('gzip', body)))
+        self.assertEqual(body, zlib.decompress(compress('deflate', body)))
+
+    def test_flushed_chunks_can_be_decompressed_before_the_end(self):
+        for encoding in ENCODINGS:
+            compressor = Compressor(encoding)
+            response = DecodedResponse(_StreamedResponse(), encoding)
+
+            for chunk in self.CHUNKS[:3]:
+                response.add(compressor.compress(chunk) + compressor.flush())
+                self.assertEqual(chunk, response.read(1024))
+            response.add(compressor.finish())
+            response.end()
+            self.assertEqual(b'', response.read(1024))
+
+
+class DecodedResponseTests(unittest.TestCase):
+    BODY = json.dumps({'result': [{'processed_timestamp': i} for i in range(1000)]}).encode()
+
+    def test_small_reads_return_nothing_only_at_the_end(self):
+        for encoding in ENCODINGS:
+            response = DecodedResponse(_Response(compress(encoding, self.BODY)), encoding)
+
+            chunks = []
+            while True:
+                chunk = response.read(1)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+
+            self.assertEqual(self.BODY, b''.join(chunks))
+
+    def test_the_whole_body_is_read_at_once(self):
+        response = DecodedResponse(_Response(compress('gzip', self.BODY)), 'gzip')
+
+        self.assertEqual(self.BODY, response.readall())
+        self.assertEqual(b'', response.read())
+        self.assertEqual(200, response.status)
+
+    def test_uncompressed_responses_are_left_alone(self):
+        response = _Response(self.BODY)
+
+        self.assertIs(response, decoded(response))
+        response.headers['Content-Encoding'] = 'identity'
+        self.assertIs(response, decoded(response))
+        response.headers['Content-Encoding'] = 'gzip'
+        self.assertIsInstance(decoded(response), DecodedResponse)
+
+    def test_unknown_coding_raises_value_error(self):
+        response = _Response(self.BODY, {'Content-Encoding': 'br'})
+
+        with self.assertRaises(ValueError):
+            decoded(response)
+
+
+class _Response(object):
+    status = 200
+
+    def __init__(self, body, headers=None):
+        self._body = io.BytesIO(body)
+        self.headers = headers or {}
+
+    def read(self, amt=None):
+        return self._body.read(amt)
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+
+class _StreamedResponse(object):
+    # a response whose body arrives while it's being read
+    def __init__(self):
+        self._chunks = []
+        self._ended = False
+
+    def add(self, data):
+        self._chunks.append(data)
+
+    def end(self):
+        self._ended = True
+
+    def read(self, amt=None):
+        if not self._chunks:
+            assert self._ended, "the reader waits for data which was sent already"
+            return b''
+        return self._chunks.pop(0)
+
+
+if __name__ == '__main__':
+    unittest.main()
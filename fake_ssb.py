@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+# A fake SSB for benchmarks: serves the part of the REST API the merge proxy and the exporters use over
+# HTTPS, from synthetic logspaces which are computed and not stored, so they can be of any size. Every
+# request is delayed by latency plus a random jitter, like an SSB across the network. With compression, the
+# responses are compressed for the clients accepting that; with chunked, they are sent in chunks of CHUNK_SIZE.
+import argparse
+import http.server
+import json
+import os
+import random
+import socket
+import ssl
+import threading
+import time
+import urllib.parse
+
+import content_encoding
+
+CERTIFICATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'merge_proxy.pem')
+FIRST_TIMESTAMP = 1425599507
+CHUNK_SIZE = 16 * 1024  # bytes, of the chunked responses
+
+
+class SyntheticLogspace:
+    # number_of_logs logs, logs_per_second of them in each second from first_timestamp on; the logs of the
+    # fake SSBs of a merge have the same timestamps, so the merge has to interleave them
+    def __init__(self, name, number_of_logs, logs_per_second=100, message_size=80, host_prefix='host',
+                 first_timestamp=FIRST_TIMESTAMP):
+        self.name = name
+        self.number_of_logs = number_of_logs
+        self._logs_per_second = logs_per_second
+        self._message_size = message_size
+        self._host_prefix = host_prefix
+        self._first_timestamp = first_timestamp
+
+    def log(self, index):
+        timestamp = self._first_timestamp + index // self._logs_per_second
+        message = "Accepted publickey for user%d from 10.0.%d.%d " % (index, index % 256, index % 200)
+        return {'processed_timestamp': timestamp, 'timestamp': timestamp - 1,
+                'host': '%s%d' % (self._host_prefix, index % 50), 'program': 'sshd', 'pid': index,
+                'facility': 4, 'priority': 6, 'message': message.ljust(self._message_size, 'x')}
+
+    def index_range(self, from_timestamp, to_timestamp):
+        # the [first, end) indexes of the logs processed in [from_timestamp, to_timestamp)
+        def first_index_at(timestamp):
+            seconds = max(timestamp - self._first_timestamp, 0)
+            return min(seconds * self._logs_per_second, self.number_of_logs)
+
+        return first_index_at(from_timestamp), max(first_index_at(to_timestamp), first_index_at(from_timestamp))
+
+    def filter(self, from_timestamp, to_timestamp, offset, limit):
+        (first, end) = self.index_range(from_timestamp, to_timestamp)
+        first += offset
+        return [self.log(index) for index in range(first, min(first + limit, end))]
+
+    def number_of_messages(self, from_timestamp, to_timestamp):
+        (first, end) = self.index_range(from_timestamp, to_timestamp)
+        return end - first
+
+
+class FakeSSB:
+    # the search_expression of the queries is ignored, every log matches
+    def __init__(self, logspaces, latency=0, jitter=0, port=0, certificate=CERTIFICATE_PATH, seed=None,
+                 compression=True, chunked=False):
+        self.logspaces = {logspace.name: logspace for logspace in logspaces}
+        self.latency = latency
+        self.jitter = jitter
+        self.compression = compression
+        self.chunked = chunked
+        self.requests = 0
+        self.connections = 0  # accepted so far
+        self.sent_bytes = 0  # of the response bodies
+        self._random = random.Random(seed)
+        self._tokens = set()
+        self._open_connections = set()
+        self._lock = threading.Lock()
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', port), _FakeSSBRequestHandler)
+        self._server.daemon_threads = True
+        self._server.fake_ssb = self
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.set_ciphers('DEFAULT:@SECLEVEL=0')  # the sample certificate has an old 1024 bit key
+        context.load_cert_chain(certificate)
+        self._server.socket = context.wrap_socket(self._server.socket, server_side=True)
+        self._thread = None
+
+    @property
+    def address(self):
+        return '%s:%d' % self._server.server_address
+
+    @staticmethod
+    def client_context():
+        # what a client needs to talk to the fake with its self-signed sample certificate
+        context = ssl._create_unverified_context()
+        context.set_ciphers('DEFAULT:@SECLEVEL=0')
+        return context
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def delay(self):
+        with self._lock:
+            self.requests += 1
+            delay = self.latency + self._random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def login(self):
+        token = '%032x' % self._random.getrandbits(128)
+        with self._lock:
+            self._tokens.add(token)
+        return token
+
+    def logout(self, token):
+        with self._lock:
+            self._tokens.discard(token)
+
+    def is_logged_in(self, token):
+        with self._lock:
+            return token in self._tokens
+
+    def count_sent_bytes(self, number_of_bytes):
+        with self._lock:
+            self.sent_bytes += number_of_bytes
+
+    def connection_opened(self, connection):
+        with self._lock:
+            self.connections += 1
+            self._open_connections.add(connection)
+
+    def connection_closed(self, connection):
+        with self._lock:
+            self._open_connections.discard(connection)
+
+    def drop_connections(self):
+        # closes the kept-alive connections without a word, like an SSB restarting or timing out idle clients
+        with self._lock:
+            connections = list(self._open_connections)
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class _FakeSSBRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the SSB
+
+    def setup(self):
+        super().setup()
+        # the headers and the body are sent separately, Nagle's algorithm would hold the body back
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server.fake_ssb.connection_opened(self.connection)
+
+    def finish(self):
+        self.server.fake_ssb.connection_closed(self.connection)
+        super().finish()
+
+    def do_POST(self):
+        fake_ssb = self.server.fake_ssb
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        fake_ssb.delay()
+        if self.path != '/api/1/login':
+            return self._send(404, {'error': {'message': "Unknown URL"}})
+        self._send(200, {'result': fake_ssb.login()})
+
+    def do_GET(self):
+        fake_ssb = self.server.fake_ssb
+        fake_ssb.delay()
+        url = urllib.parse.urlparse(self.path)
+        token = self._token()
+        if not fake_ssb.is_logged_in(token):
+            return self._send(401, {'error': {'message': "Authentication required"}})
+        if url.path == '/api/1/logout':
+            fake_ssb.logout(token)
+            return self._send(200, {'result': True})
+        if url.path == '/api/1/search/logspace/list_logspaces':
+            return self._send(200, {'result': sorted(fake_ssb.logspaces)})
+
+        parts = url.path.split('/')
+        if len(parts) != 7 or parts[:5] != ['', 'api', '1', 'search', 'logspace'] or \
+                parts[6] not in fake_ssb.logspaces:
+            return self._send(404, {'error': {'message': "Unknown URL"}})
+        (command, logspace) = (parts[5], fake_ssb.logspaces[parts[6]])
+        params = dict(urllib.parse.parse_qsl(url.query))
+        (from_timestamp, to_timestamp) = (int(params.get('from', 0)), int(params.get('to', 9999999999)))
+        if command == 'number_of_messages':
+            return self._send(200, {'result': logspace.number_of_messages(from_timestamp, to_timestamp)})
+        if command == 'filter':
+            logs = logspace.filter(from_timestamp, to_timestamp, int(params.get('offset', 0)),
+                                   int(params.get('limit', 10)))
+            return self._send(200, {'result': logs})
+        self._send(404, {'error': {'message': "Unknown command"}})
+
+    def _token(self):
+        cookies = urllib.parse.parse_qs(self.headers.get('Cookie', ''))
+        return cookies.get('AUTHENTICATION_TOKEN', [None])[0]
+
+    def _send(self, status, response):
+        body = json.dumps(response).encode()
+        encoding = None
+        if self.server.fake_ssb.compression:
+            encoding = content_encoding.choose_encoding(self.headers.get('Accept-Encoding'))
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if encoding is not None:
+            body = content_encoding.compress(encoding, body)
+            self.send_header('Content-Encoding', encoding)
+        # counted before the write, the client may have read the whole body and moved on by the time it returns
+        if not self.server.fake_ssb.chunked:
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.server.fake_ssb.count_sent_bytes(len(body))
+            self.wfile.write(body)
+            return
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        self.server.fake_ssb.count_sent_bytes(len(body))
+        for start in range(0, len(body), CHUNK_SIZE):
+            chunk = body[start:start + CHUNK_SIZE]
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+        self.wfile.write(b'0\r\n\r\n')
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serves synthetic logspaces like an SSB, for trying out the "
+                                                 "exporters and the merge proxy")
+    parser.add_argument('--port', type=int, default=8443)
+    parser.add_argument('--logspace', action='append', default=None, help="may be given more times")
+    parser.add_argument('--logs', type=int, default=100000, help="logs in each logspace")
+    parser.add_argument('--logs-per-second', type=int, default=100)
+    parser.add_argument('--message-size', type=int, default=80)
+    parser.add_argument('--latency', type=float, default=0, help="seconds added to every request")
+    parser.add_argument('--jitter', type=float, default=0, help="at most this many random seconds added too")
+    parser.add_argument('--no-compression', action='store_true', help="don't compress the responses")
+    parser.add_argument('--chunked', action='store_true', help="send the responses with chunked encoding")
+    args = parser.parse_args()
+
+    logspaces = [SyntheticLogspace(name, args.logs, args.logs_per_second, args.message_size)
+                 for name in (args.logspace or ['center'])]
+    fake_ssb = FakeSSB(logspaces, args.latency, args.jitter, args.port, compression=not args.no_compression,
+                       chunked=args.chunked).start()
+    print("Serving %s on %s, any username and password logs in" % (', '.join(sorted(fake_ssb.logspaces)),
+                                                                  fake_ssb.address))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake_ssb.stop()
+
+
+if __name__ == '__main__':
+    main()
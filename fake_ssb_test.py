@@ -0,0 +1,77 @@
+import time
+import unittest
+from fake_ssb import *
+from merge_proxy import SSB, AuthenticationError
+
+
+class SyntheticLogspaceTests(unittest.TestCase):
+    def test_logs_are_in_processed_timestamp_order_with_the_given_rate(self):
+        logspace = SyntheticLogspace('center', 250, logs_per_second=100, message_size=100)
+
+        logs = logspace.filter(0, 9999999999, 0, 1000)
+
+        self.assertEqual(250, len(logs))
+        self.assertEqual([FIRST_TIMESTAMP] * 100, [log['processed_timestamp'] for log in logs[:100]])
+        self.assertEqual(FIRST_TIMESTAMP + 2, logs[-1]['processed_timestamp'])
+        self.assertEqual(100, len(logs[0]['message']))
+
+    def test_time_range_is_half_open(self):
+        logspace = SyntheticLogspace('center', 250, logs_per_second=100)
+
+        self.assertEqual(100, logspace.number_of_messages(FIRST_TIMESTAMP + 1, FIRST_TIMESTAMP + 2))
+        self.assertEqual([100, 101], [log['pid'] for log in logspace.filter(FIRST_TIMESTAMP + 1, FIRST_TIMESTAMP + 2,
+                                                                            0, 2)])
+        self.assertEqual([], logspace.filter(FIRST_TIMESTAMP + 1, FIRST_TIMESTAMP + 2, 100, 10))
+
+
+class FakeSSBTests(unittest.TestCase):
+    def setUp(self):
+        self.fake_ssb = FakeSSB([SyntheticLogspace('center', 500), SyntheticLogspace('other', 10)], seed=1).start()
+        self.ssb = SSB(self.fake_ssb.address, context=FakeSSB.client_context())
+
+    def tearDown(self):
+        self.ssb.conn.close()
+        self.fake_ssb.stop()
+
+    def test_serves_the_logspaces_to_the_SSB_client(self):
+        self.ssb.login("user", "password")
+
+        self.assertSetEqual({'center', 'other'}, self.ssb.list_logspaces())
+        self.assertEqual(500, self.ssb.number_of_messages('center'))
+        self.assertEqual([150, 151], [log['pid'] for log in self.ssb.filter('center', offset=150, limit=2)])
+        self.assertEqual(list(range(10)), [log['pid'] for log in self.ssb.iter_filter('other', limit=100)])
+
+    def test_queries_need_a_session(self):
+        self.ssb.login("user", "password")
+        self.ssb.logout()
+
+        with self.assertRaises(AuthenticationError):
+            self.ssb.list_logspaces()
+
+    def test_requests_are_delayed_by_the_latency(self):
+        self.fake_ssb.latency = 0.05
+        self.ssb.login("user", "password")
+
+        started = time.time()
+        self.ssb.number_of_messages('center')
+
+        self.assertGreaterEqual(time.time() - started, 0.05)
+        self.assertEqual(2, self.fake_ssb.requests)
+
+    def test_responses_are_compressed_for_the_clients_accepting_that(self):
+        self.ssb.login("user", "password")
+        expected = self.fake_ssb.logspaces['center'].filter(0, 9999999999, 0, 500)
+        sent_bytes = []
+
+        for compression in (False, True):
+            self.fake_ssb.compression = compression
+            sent_before = self.fake_ssb.sent_bytes
+            self.assertEqual(expected, self.ssb.filter('center', limit=500))
+            self.assertEqual(expected, list(self.ssb.iter_filter('center', limit=500)))
+            sent_bytes.append(self.fake_ssb.sent_bytes - sent_before)
+
+        self.assertLess(sent_bytes[1] * 5, sent_bytes[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,20 +3,44 @@
 import urllib
 import urllib2
 import json
-import datetime
 import sys
+import os
 import urlparse
+import argparse
+import threading
+import Queue
+import collections
+import shutil
+import tempfile
+from multiprocessing.pool import ThreadPool
 
-# FIXME: this is NASTY, dangerous and prone to parsing errors....
-config_infos = {}
-execfile("ssb_credentials", config_infos)
-ssb_ip = config_infos['SSB_IP']
-username = config_infos['USERNAME']
-password = config_infos['PASSWORD']
+import json_stream
+import syslog_format
 
-auth_token = None
+ssb_ip = None
+username = None
+password = None
 
-def call_rpc(method, command, arguments):
+PAGE_SIZE = 1000
+# a slice fetched ahead of the one being written is kept in memory up to this size, then in a temporary file
+SLICE_SPOOL_SIZE = 16 * 1024 * 1024
+
+# every thread has its own session, so the parallel workers don't share one
+session = threading.local()
+
+# replaced in main() according to the output options
+formatter = syslog_format.SyslogFormatter()
+
+def load_credentials(path="ssb_credentials"):
+    global ssb_ip, username, password
+    # FIXME: this is NASTY, dangerous and prone to parsing errors....
+    config_infos = {}
+    execfile(path, config_infos)
+    ssb_ip = config_infos['SSB_IP']
+    username = config_infos['USERNAME']
+    password = config_infos['PASSWORD']
+
+def open_rpc(method, command, arguments):
     url = 'https://%s/api/1/%s' % (ssb_ip, command)
     data = urllib.urlencode(arguments)
 
@@ -24,28 +48,94 @@ def call_rpc(method, command, arguments):
         request = urllib2.Request(url, data)
     if method == 'get':
         request = urllib2.Request('%s?%s' % (url, data))
-        request.add_header('Cookie', 'AUTHENTICATION_TOKEN=%s;' % auth_token)
+        request.add_header('Cookie', 'AUTHENTICATION_TOKEN=%s;' % session.auth_token)
+
+    return urllib2.urlopen(request)
 
-    response = urllib2.urlopen(request).read()
+def call_rpc(method, command, arguments):
+    response = open_rpc(method, command, arguments).read()
     return json.loads(response)
 
 def login():
-    global auth_token
-
     response = call_rpc('post', 'login', {'username': username, 'password': password})
-    auth_token = response['result']
+    session.auth_token = response['result']
+
+def iter_filter(logspace_name, from_timestamp, to_timestamp, search_expression, offset, limit=PAGE_SIZE):
+    # the logs are parsed one by one while the page is downloading
+    response = open_rpc('get', 'search/logspace/filter/%s' % logspace_name, {'from': from_timestamp,
+                                                                             'to': to_timestamp,
+                                                                             'search_expression': search_expression,
+                                                                             'offset': offset,
+                                                                             'limit': limit})
+    return json_stream.iter_result(response.read)
 
-def call_filter(logspace_name, from_timestamp, to_timestamp, search_expression, offset):
-    return call_rpc('get', 'search/logspace/filter/%s' % logspace_name, {'from': from_timestamp,
-                                                                         'to': to_timestamp,
-                                                                         'search_expression': search_expression,
-                                                                         'offset': offset,
-                                                                         'limit': 1000})
+def call_number_of_messages(logspace_name, from_timestamp, to_timestamp, search_expression):
+    return call_rpc('get', 'search/logspace/number_of_messages/%s' % logspace_name,
+                    {'from': from_timestamp,
+                     'to': to_timestamp,
+                     'search_expression': search_expression})['result']
 
-def print_log(log):
-    log['date'] = datetime.datetime.fromtimestamp(int(log['timestamp'])).strftime('%Y-%m-%dT%H:%M:%S')
+def iter_logs(logspace_name, from_timestamp, to_timestamp, search_expression):
+    # the next page is asked from the last timestamp change seen, so the SSB never has to skip more
+    # than about a page of logs, however deep the export is
+    offset = 0
+    while True:
+        number_of_logs = 0
+        last_timestamp = None
+        last_timestamp_change = None
+        for log in iter_filter(logspace_name, from_timestamp, to_timestamp, search_expression, offset):
+            yield log
+            if last_timestamp is not None and log['processed_timestamp'] > last_timestamp:
+                last_timestamp_change = number_of_logs
+            last_timestamp = log['processed_timestamp']
+            number_of_logs += 1
+        if number_of_logs == 0:
+            return
+        if last_timestamp_change is None:
+            offset += number_of_logs
+        else:
+            from_timestamp = last_timestamp
+            offset = number_of_logs - last_timestamp_change
 
-    print ('%(date)s %(host)s %(program)s[%(pid)s]: %(message)s' % log).encode('utf-8')
+def iter_pages(logs, page_size):
+    page = []
+    for log in logs:
+        page.append(log)
+        if len(page) == page_size:
+            yield page
+            page = []
+    if page:
+        yield page
+
+def read_ahead(logs, page_size, depth):
+    # a thread downloads the logs in pages while the caller formats the previous ones; it stays at
+    # most depth pages ahead, so it waits for the caller when the output is slow
+    pages = Queue.Queue(depth)
+    auth_token = session.auth_token
+
+    def download():
+        session.auth_token = auth_token
+        try:
+            for page in iter_pages(logs, page_size):
+                pages.put(page)
+            pages.put(None)
+        except Exception as error:
+            pages.put(error)
+
+    downloader = threading.Thread(target=download)
+    downloader.daemon = True
+    downloader.start()
+    while True:
+        page = pages.get()
+        if page is None:
+            return
+        if isinstance(page, Exception):
+            raise page
+        yield page
+
+def print_page(logs):
+    # one write for the whole page instead of one print per log
+    formatter.write_page(logs, sys.stdout)
 
 def parse_query_url(query_url):
     parsed = urlparse.urlparse(query_url)
@@ -56,17 +146,133 @@ def parse_query_url(query_url):
             'search_expression':
                 params['search_expression'][0] if 'search_expression' in params else ""}
 
+def get_processed_timestamp_at(query, from_timestamp, to_timestamp, offset):
+    for log in iter_filter(query['logspace'], from_timestamp, to_timestamp, query['search_expression'], offset, 1):
+        return log['processed_timestamp']
+
+def split_to_slices(query, from_timestamp, to_timestamp, logs_per_slice):
+    # equal time slices between the first and the last log, as many as needed for about logs_per_slice
+    # logs each; the first and the last slice reach out to the ends of the queried range
+    number_of_messages = call_number_of_messages(query['logspace'], from_timestamp, to_timestamp,
+                                                 query['search_expression'])
+    if number_of_messages == 0:
+        return [[from_timestamp, to_timestamp]]
+    first_timestamp = get_processed_timestamp_at(query, from_timestamp, to_timestamp, 0)
+    last_timestamp = get_processed_timestamp_at(query, from_timestamp, to_timestamp, number_of_messages - 1)
+    time_span = last_timestamp + 1 - first_timestamp
+    number_of_slices = max(1, min(-(-number_of_messages // logs_per_slice), time_span))
+    boundaries = [first_timestamp + time_span * i // number_of_slices for i in range(number_of_slices + 1)]
+    boundaries[0] = from_timestamp
+    boundaries[-1] = to_timestamp
+    return [[boundaries[i], boundaries[i + 1]] for i in range(number_of_slices)]
+
+def load_export_state(state_file, query_url):
+    if state_file is None or not os.path.exists(state_file):
+        return None
+    with open(state_file) as state:
+        export_state = json.load(state)
+    if export_state['query_url'] != query_url:
+        sys.exit("%s belongs to another query: %s" % (state_file, export_state['query_url']))
+    return export_state
+
+def save_export_state(state_file, export_state):
+    if state_file is None:
+        return
+    with open(state_file + '.tmp', 'w') as state:
+        json.dump(export_state, state)
+    os.rename(state_file + '.tmp', state_file)
+
+def fetch_slice(query_and_slice):
+    # formatted page by page into a spooled file, so a big slice waiting for its turn doesn't fill the memory
+    (query, (from_timestamp, to_timestamp)) = query_and_slice
+    output = tempfile.SpooledTemporaryFile(SLICE_SPOOL_SIZE)
+    try:
+        for page in iter_pages(iter_logs(query['logspace'], from_timestamp, to_timestamp,
+                                         query['search_expression']), PAGE_SIZE):
+            output.write(formatter.format_page(page).encode('utf-8'))
+    except Exception:
+        output.close()
+        raise
+    output.seek(0)
+    return output
+
+def export_in_parallel(query_url, query, workers, logs_per_slice, state_file):
+    # slices are fetched by the workers at the same time, each with its own session, but they are
+    # written strictly in order; at most workers slices are fetched ahead of the one being written, so a
+    # slow slice doesn't make the others pile up. The state file tells how many slices were written, to be
+    # able to resume.
+    export_state = load_export_state(state_file, query_url)
+    if export_state is None:
+        export_state = {'query_url': query_url,
+                        'slices': split_to_slices(query, int(query['from']), int(query['to']), logs_per_slice),
+                        'completed_slices': 0}
+        save_export_state(state_file, export_state)
+
+    pending_slices = iter(export_state['slices'][export_state['completed_slices']:])
+    pool = ThreadPool(workers, initializer=login)
+    in_flight = collections.deque()
+    try:
+        while True:
+            while len(in_flight) < workers + 1:
+                time_slice = next(pending_slices, None)
+                if time_slice is None:
+                    break
+                in_flight.append(pool.apply_async(fetch_slice, ((query, time_slice),)))
+            if not in_flight:
+                break
+            output = in_flight.popleft().get()
+            try:
+                shutil.copyfileobj(output, sys.stdout)
+            finally:
+                output.close()
+            sys.stdout.flush()
+            export_state['completed_slices'] += 1
+            save_export_state(state_file, export_state)
+    finally:
+        pool.terminate()
+        for result in in_flight:
+            if result.ready() and result.successful():
+                result.get().close()
+
+    if state_file is not None:
+        os.remove(state_file)
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Fetches the results of an SSB search as syslog lines')
+    parser.add_argument('query_url', help='the URL of the search on the SSB web interface')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of slices of the time range fetched at the same time')
+    parser.add_argument('--logs-per-slice', type=int, default=100000,
+                        help='the time range is split to slices of about this many logs in parallel mode')
+    parser.add_argument('--state-file',
+                        help='remembers the written slices in parallel mode, an interrupted export resumes from it')
+    parser.add_argument('--read-ahead', type=int, default=2,
+                        help='number of pages downloaded ahead while the current one is written, 0 turns it off')
+    parser.add_argument('--format', choices=syslog_format.MODES, default='iso',
+                        help='iso is the classic "date host program[pid]: message" line, jsonl writes the logs as they are')
+    parser.add_argument('--local-time', action='store_true',
+                        help='dates are written in the local time zone instead of UTC')
+    return parser.parse_args()
+
 def main():
+    global formatter
+    arguments = parse_arguments()
+    formatter = syslog_format.SyslogFormatter(arguments.format, utc=not arguments.local_time)
+    query = parse_query_url(arguments.query_url)
+    load_credentials()
     login()
-    query = parse_query_url(sys.argv[1])
-    offset = 0
-    while True:
-        logs = call_filter(query['logspace'], query['from'], query['to'], query['search_expression'], offset)['result']
-        if len(logs) == 0:
-            return 0
-        for log in logs:
-            print_log(log)
-        offset += len(logs)
+    if arguments.workers > 1:
+        export_in_parallel(arguments.query_url, query, arguments.workers, arguments.logs_per_slice,
+                           arguments.state_file)
+    else:
+        logs = iter_logs(query['logspace'], query['from'], query['to'], query['search_expression'])
+        if arguments.read_ahead > 0:
+            pages = read_ahead(logs, PAGE_SIZE, arguments.read_ahead)
+        else:
+            pages = iter_pages(logs, PAGE_SIZE)
+        for page in pages:
+            print_page(page)
+    return 0
 
 if __name__ == '__main__':
     main()
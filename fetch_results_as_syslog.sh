@@ -22,25 +22,8 @@ function api_request {
 }
 
 function format_results_as_syslog {
-    RAW_RESULTS=$@
-
-    NUM_RESULTS=`echo $RAW_RESULTS | jq -r -c '. | length'`
-    ITER_MAX=$[$NUM_RESULTS - 1]
-    for i in `seq 0 $ITER_MAX`
-    do
-        # FIXME: this is horribly inefficient this way
-
-        LOG_MSG=`echo $RAW_RESULTS | jq -c ".[$i]"`
-
-        TIMESTAMP=`echo $LOG_MSG | jq -r -c ".timestamp"`
-        DATESTRING=`date -d @$TIMESTAMP` # FIXME: this is local time
-        HOST=`echo $LOG_MSG | jq -r -c ".host"`
-        PROGRAM=`echo $LOG_MSG | jq -r -c ".program"`
-        PID=`echo $LOG_MSG | jq -r -c ".pid"`
-        MESSAGE=`echo $LOG_MSG | jq -r -c ".message"`
-
-        echo "$DATESTRING $HOST $PROGRAM[$PID]: $MESSAGE"
-    done
+    # one jq run formats the whole page; the dates are in UTC like in fetch_results_as_syslog.py
+    jq -r '.[] | "\(.timestamp | tonumber | todate | sub("Z$"; "")) \(.host) \(.program)[\(.pid)]: \(.message)"'
 }
 
 API_REQUEST=$(translate_query_url_to_api_request $1)
@@ -50,4 +33,4 @@ SESSID=`wget -q --no-check-certificate -O - "https://$SSB_IP/api/1/login" --post
 
 RESULTS=$(api_request $API_REQUEST)
 
-format_results_as_syslog $RESULTS
+echo "$RESULTS" | format_results_as_syslog
@@ -0,0 +1,217 @@
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import unittest
+
+if sys.version_info[0] > 2:
+    raise unittest.SkipTest("the exporter runs on python 2")
+
+import fetch_results_as_syslog
+
+
+class ExportTestCase(unittest.TestCase):
+    QUERY = {'logspace': "center", 'from': "0", 'to': "1000", 'search_expression': ""}
+
+    def setUp(self):
+        # one log a second
+        self.timestamps = list(range(100, 900))
+        self._patch('login', lambda: None)
+        self._patch('call_number_of_messages', self._number_of_messages)
+        self._patch('iter_filter', self._iter_filter)
+
+    def _patch(self, name, value):
+        original = getattr(fetch_results_as_syslog, name)
+        setattr(fetch_results_as_syslog, name, value)
+        self.addCleanup(setattr, fetch_results_as_syslog, name, original)
+
+    def _selected(self, from_timestamp, to_timestamp):
+        return [timestamp for timestamp in self.timestamps if int(from_timestamp) <= timestamp < int(to_timestamp)]
+
+    def _number_of_messages(self, logspace_name, from_timestamp, to_timestamp, search_expression):
+        return len(self._selected(from_timestamp, to_timestamp))
+
+    def _iter_filter(self, logspace_name, from_timestamp, to_timestamp, search_expression, offset,
+                     limit=fetch_results_as_syslog.PAGE_SIZE):
+        return iter([{'processed_timestamp': timestamp, 'timestamp': timestamp, 'host': "host", 'program': "prog",
+                      'pid': 1, 'message': "log %d" % timestamp}
+                     for timestamp in self._selected(from_timestamp, to_timestamp)[offset:offset + limit]])
+
+
+class SplitToSlicesTests(ExportTestCase):
+    def test_slices_cover_the_whole_range_without_overlaps(self):
+        slices = fetch_results_as_syslog.split_to_slices(self.QUERY, 0, 1000, 100)
+
+        self.assertEqual(8, len(slices))
+        self.assertEqual(0, slices[0][0])
+        self.assertEqual(1000, slices[-1][1])
+        for (previous, following) in zip(slices, slices[1:]):
+            self.assertEqual(previous[1], following[0])
+        self.assertEqual(len(self.timestamps), sum(self._number_of_messages(None, from_timestamp, to_timestamp, None)
+                                                   for (from_timestamp, to_timestamp) in slices))
+
+    def test_slices_are_at_least_a_second_long(self):
+        self.timestamps = [500] * 1000
+
+        self.assertEqual([[0, 1000]], fetch_results_as_syslog.split_to_slices(self.QUERY, 0, 1000, 100))
+
+    def test_empty_range_is_a_single_slice(self):
+        self.timestamps = []
+
+        self.assertEqual([[0, 1000]], fetch_results_as_syslog.split_to_slices(self.QUERY, 0, 1000, 100))
+
+
+class ExportInParallelTests(ExportTestCase):
+    def setUp(self):
+        super(ExportInParallelTests, self).setUp()
+        self.output = io.BytesIO()
+        self._patch_stdout(self.output)
+
+    def _patch_stdout(self, output):
+        original = sys.stdout
+        sys.stdout = output
+        self.addCleanup(setattr, sys, 'stdout', original)
+
+    def _slowly(self, iter_filter):
+        # the slices finish in a random order
+        def slow_iter_filter(*args, **kwargs):
+            time.sleep(random.random() * 0.01)
+            return iter_filter(*args, **kwargs)
+
+        return slow_iter_filter
+
+    def _exported_timestamps(self):
+        return [int(line.split()[-1]) for line in self.output.getvalue().decode('utf-8').splitlines()]
+
+    def test_slices_are_written_in_order(self):
+        self._patch('iter_filter', self._slowly(self._iter_filter))
+
+        fetch_results_as_syslog.export_in_parallel("url", self.QUERY, 4, 50, None)
+
+        self.assertEqual(self.timestamps, self._exported_timestamps())
+
+    def test_interrupted_export_resumes_from_the_state_file(self):
+        (file_descriptor, state_file) = tempfile.mkstemp()
+        os.close(file_descriptor)
+        slices = fetch_results_as_syslog.split_to_slices(self.QUERY, 0, 1000, 100)
+        with open(state_file, 'w') as state:
+            json.dump({'query_url': "url", 'slices': slices, 'completed_slices': 3}, state)
+
+        fetch_results_as_syslog.export_in_parallel("url", self.QUERY, 2, 100, state_file)
+
+        self.assertEqual(self._selected(slices[3][0], 1000), self._exported_timestamps())
+        self.assertFalse(os.path.exists(state_file))
+
+    def test_only_a_few_slices_are_fetched_ahead(self):
+        fetch_slice = fetch_results_as_syslog.fetch_slice
+        counts = {'started': 0, 'written': 0, 'most_ahead': 0}
+
+        def counting_fetch_slice(query_and_slice):
+            counts['started'] += 1
+            counts['most_ahead'] = max(counts['most_ahead'], counts['started'] - counts['written'])
+            return _CountedOutput(fetch_slice(query_and_slice), counts)
+
+        self._patch('fetch_slice', counting_fetch_slice)
+
+        fetch_results_as_syslog.export_in_parallel("url", self.QUERY, 2, 10, None)
+
+        self.assertEqual(80, counts['written'])
+        self.assertLessEqual(counts['most_ahead'], 2 + 1)
+        self.assertEqual(self.timestamps, self._exported_timestamps())
+
+
+class IterLogsTests(ExportTestCase):
+    def setUp(self):
+        super(IterLogsTests, self).setUp()
+        self.calls = []
+
+        def paged_iter_filter(logspace_name, from_timestamp, to_timestamp, search_expression, offset):
+            self.calls.append((int(from_timestamp), offset))
+            return self._iter_filter(logspace_name, from_timestamp, to_timestamp, search_expression, offset, 10)
+
+        self._patch('iter_filter', paged_iter_filter)
+
+    def _exported_timestamps(self):
+        return [log['processed_timestamp'] for log in fetch_results_as_syslog.iter_logs("center", 0, 1000, "")]
+
+    def test_pages_are_asked_from_the_last_timestamp_change(self):
+        # three logs a second, so a page ends in the middle of a second
+        self.timestamps = sorted(list(range(100, 200)) * 3)
+
+        self.assertEqual(self.timestamps, self._exported_timestamps())
+        self.assertEqual((0, 0), self.calls[0])
+        self.assertEqual((103, 1), self.calls[1])
+        self.assertTrue(all(offset <= 10 for (from_timestamp, offset) in self.calls))
+
+    def test_pages_of_a_single_timestamp_are_skipped_with_the_offset(self):
+        self.timestamps = [100] * 25 + [101] * 5
+
+        self.assertEqual(self.timestamps, self._exported_timestamps())
+        self.assertEqual([(0, 0), (0, 10), (0, 20), (101, 5)], self.calls)
+
+
+class ReadAheadTests(unittest.TestCase):
+    def setUp(self):
+        fetch_results_as_syslog.session.auth_token = "token"
+        self.downloaded = []
+
+    def _logs(self, count, error=None):
+        for log in range(count):
+            self.downloaded.append(log)
+            yield log
+        if error is not None:
+            raise error
+
+    def test_pages_come_in_order(self):
+        pages = list(fetch_results_as_syslog.read_ahead(self._logs(25), 10, 2))
+
+        self.assertEqual([list(range(10)), list(range(10, 20)), list(range(20, 25))], pages)
+
+    def test_downloader_waits_for_a_slow_output(self):
+        pages = fetch_results_as_syslog.read_ahead(self._logs(1000), 10, 2)
+
+        next(pages)
+        time.sleep(0.1)
+
+        # the page taken, the depth pages in the queue, and the one waiting to be put there
+        self.assertEqual((1 + 2 + 1) * 10, len(self.downloaded))
+        self.assertEqual(99, len(list(pages)))
+
+    def test_download_errors_reach_the_consumer(self):
+        pages = fetch_results_as_syslog.read_ahead(self._logs(15, IOError("SSB went away")), 10, 2)
+
+        self.assertEqual(list(range(10)), next(pages))
+        with self.assertRaises(IOError):
+            next(pages)
+
+    def test_downloader_uses_the_session_of_the_caller(self):
+        tokens = []
+
+        def logs():
+            tokens.append(fetch_results_as_syslog.session.auth_token)
+            yield 1
+
+        self.assertEqual([[1]], list(fetch_results_as_syslog.read_ahead(logs(), 10, 2)))
+        self.assertEqual(["token"], tokens)
+
+
+class _CountedOutput(object):
+    def __init__(self, output, counts):
+        self._output = output
+        self._counts = counts
+
+    def read(self, size=-1):
+        # the writer is slower than the workers
+        time.sleep(0.001)
+        return self._output.read(size)
+
+    def close(self):
+        self._counts['written'] += 1
+        self._output.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
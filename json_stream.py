@@ -0,0 +1,115 @@
+# Incremental parsing of SSB API responses, so the elements of a big "result" array can be used
+# while the rest of the response is still on the wire. Works on both python 2 and 3, as the
+# exporter scripts use it too.
+import codecs
+import json
+
+CHUNK_SIZE = 64 * 1024
+
+_WHITESPACE = ' \t\n\r'
+
+
+def iter_result(read, key='result', chunk_size=CHUNK_SIZE, raw=False):
+    # read is a read(size) callable like the one of a HTTP response, returning an empty string on EOF;
+    # with raw, the elements come with the JSON text they were parsed from, as (element, text) pairs.
+    # A response without key (an error response) raises ValueError, with the error of the response if any.
+    scanner = _Scanner(read, chunk_size)
+    scanner.expect('{')
+    found = False
+    error = None
+    if scanner.peek() == '}':
+        _raise_missing(key, error)
+
+    while True:
+        name = scanner.decode_value()
+        scanner.expect(':')
+        if name == key:
+            found = True
+        if name == key and scanner.peek() == '[':
+            scanner.expect('[')
+            if scanner.peek() == ']':
+                scanner.expect(']')
+            else:
+                while True:
+                    yield scanner.decode_value(raw)
+                    if scanner.next_char() == ']':
+                        break
+        else:
+            value = scanner.decode_value()
+            if name == key and value is not None:
+                raise ValueError("'%s' is not an array in the response" % key)
+            if name == 'error':
+                error = value
+
+        if scanner.next_char() == '}':
+            if not found:
+                _raise_missing(key, error)
+            return
+
+
+def _raise_missing(key, error):
+    if error is not None:
+        raise ValueError("No '%s' in the response, the error is: %s" % (key, json.dumps(error)))
+    raise ValueError("No '%s' in the response" % key)
+
+
+class _Scanner(object):
+    def __init__(self, read, chunk_size):
+        self._read = read
+        self._chunk_size = chunk_size
+        self._utf8_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._json_decoder = json.JSONDecoder()
+        self._text = u''
+        self._position = 0
+        self._eof = False
+
+    def _read_more(self):
+        if self._eof:
+            return
+        chunk = self._read(self._chunk_size)
+        if not chunk:
+            self._eof = True
+        # the already parsed part of the buffer is dropped here
+        self._text = self._text[self._position:] + self._utf8_decoder.decode(chunk, final=self._eof)
+        self._position = 0
+
+    def _skip_whitespace(self):
+        while True:
+            while self._position < len(self._text) and self._text[self._position] in _WHITESPACE:
+                self._position += 1
+            if self._position < len(self._text):
+                return
+            if self._eof:
+                raise ValueError("Unexpected end of JSON data")
+            self._read_more()
+
+    def peek(self):
+        self._skip_whitespace()
+        return self._text[self._position]
+
+    def next_char(self):
+        char = self.peek()
+        self._position += 1
+        return char
+
+    def expect(self, expected_char):
+        char = self.next_char()
+        if char != expected_char:
+            raise ValueError("Expected '%s' in JSON data, got '%s'" % (expected_char, char))
+
+    def decode_value(self, raw=False):
+        self._skip_whitespace()
+        while True:
+            try:
+                (value, end) = self._json_decoder.raw_decode(self._text, self._position)
+            except ValueError:
+                if self._eof:
+                    raise
+                self._read_more()
+                continue
+            # a value ending right at the end of the buffer might go on in the next chunk (think of numbers)
+            if end < len(self._text) or self._eof:
+                start = self._position
+                self._position = end
+                return (value, self._text[start:end]) if raw else value
+            self._read_more()
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+# the exporter reads its pages with iter_result, so these run on python 2 too
+import io
+import json
+import unittest
+from json_stream import *
+
+
+class IterResultTests(unittest.TestCase):
+    LOGS = [{'processed_timestamp': i, 'message': u"message %d árvíztűrő" % i, 'pid': 10 ** i}
+            for i in range(20)]
+
+    def _iter_result_in_chunks(self, document, chunk_size, **kwargs):
+        stream = io.BytesIO(document.encode('utf-8'))
+        return list(iter_result(stream.read, chunk_size=chunk_size, **kwargs))
+
+    def test_elements_of_result_are_returned(self):
+        document = json.dumps({'result': self.LOGS})
+
+        self.assertListEqual(self.LOGS, self._iter_result_in_chunks(document, CHUNK_SIZE))
+
+    def test_elements_split_between_any_chunks_are_parsed(self):
+        # one byte chunks split every number, string and multibyte character
+        document = json.dumps({'result': self.LOGS}, indent=2)
+
+        self.assertListEqual(self.LOGS, self._iter_result_in_chunks(document, 1))
+
+    def test_number_elements_are_not_cut_at_chunk_boundary(self):
+        document = '{"result": [12345, 678]}'
+
+        for chunk_size in range(1, len(document)):
+            self.assertListEqual([12345, 678], self._iter_result_in_chunks(document, chunk_size))
+
+    def test_other_keys_are_skipped(self):
+        document = json.dumps({'error': {'code': None, 'message': "[not, an, array]"}, 'result': [1, 2],
+                               'warnings': []})
+
+        self.assertListEqual([1, 2], self._iter_result_in_chunks(document, 3))
+
+    def test_empty_and_null_results_return_nothing(self):
+        for document in ('{"result": []}', '{"result": null}'):
+            self.assertListEqual([], self._iter_result_in_chunks(document, 2))
+
+    def test_response_without_result_raises_value_error_with_its_error(self):
+        with self.assertRaises(ValueError):
+            self._iter_result_in_chunks('{}', 2)
+        with self.assertRaises(ValueError) as raised:
+            self._iter_result_in_chunks('{"error": {"code": 500, "message": "internal error"}}', 2)
+        self.assertIn("internal error", str(raised.exception))
+
+    def test_result_which_is_not_an_array_raises_value_error(self):
+        with self.assertRaises(ValueError):
+            self._iter_result_in_chunks('{"result": 123}', 4)
+
+    def test_truncated_response_raises_value_error(self):
+        with self.assertRaises(ValueError):
+            self._iter_result_in_chunks('{"result": [{"a": 1}, {"b"', 4)
+
+    def test_elements_are_returned_before_the_whole_response_is_read(self):
+        stream = io.BytesIO(json.dumps({'result': self.LOGS}).encode('utf-8'))
+
+        first_log = next(iter_result(stream.read, chunk_size=64))
+
+        self.assertEqual(self.LOGS[0], first_log)
+        self.assertLess(stream.tell(), 200)
+
+    def test_raw_elements_come_with_their_json_text(self):
+        document = '{"result": [{"a": [1, 2]} , "x\\"y",3]}'
+
+        self.assertListEqual([({'a': [1, 2]}, '{"a": [1, 2]}'), ('x"y', '"x\\"y"'), (3, '3')],
+                             self._iter_result_in_chunks(document, 2, raw=True))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,183 @@
+# A compact form of the SSB logs for holding lots of them: a log is a LogRecord with __slots__ instead
+# of a dict, its host and program strings are interned (a few distinct values repeat over millions of logs),
+# and a LogBatch holds the records of a page. A RawRecord keeps a log as the JSON text it arrived in instead,
+# which is written out again without re-encoding it.
+import collections.abc
+import json
+import sys
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+FIELDS = ('processed_timestamp', 'timestamp', 'host', 'program', 'pid', 'facility', 'priority', 'message')
+_SLOTS = frozenset(FIELDS)
+_INTERNED_FIELDS = ('host', 'program')
+
+
+class LogRecord(collections.abc.Mapping):
+    # reads like the dict it was made of; the fields an SSB log doesn't have are left unset, the ones
+    # not in FIELDS go to the extra dict
+    __slots__ = FIELDS + ('_extra',)
+
+    @classmethod
+    def from_dict(cls, log):
+        record = cls.__new__(cls)
+        extra = None
+        for (name, value) in log.items():
+            if name in _SLOTS:
+                if name in _INTERNED_FIELDS and type(value) is str:
+                    value = sys.intern(value)
+                setattr(record, name, value)
+            else:
+                if extra is None:
+                    extra = {}
+                extra[name] = value
+        record._extra = extra
+        return record
+
+    def __getitem__(self, name):
+        if name in _SLOTS:
+            try:
+                return getattr(self, name)
+            except AttributeError:
+                raise KeyError(name)
+        if self._extra is None:
+            raise KeyError(name)
+        return self._extra[name]
+
+    def __iter__(self):
+        for name in FIELDS:
+            if hasattr(self, name):
+                yield name
+        if self._extra is not None:
+            for name in self._extra:
+                yield name
+
+    def __len__(self):
+        return sum(1 for name in FIELDS if hasattr(self, name)) + (len(self._extra) if self._extra else 0)
+
+    def as_dict(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return 'LogRecord(%r)' % self.as_dict()
+
+
+class RawRecord(collections.abc.Mapping):
+    # only the processed_timestamp of the log is decoded, for the merge; the other fields are decoded from
+    # the text each time they are read, which only the tests and the exporters do
+    __slots__ = ('processed_timestamp', 'raw')
+
+    def __init__(self, processed_timestamp, raw):
+        self.processed_timestamp = processed_timestamp
+        self.raw = raw
+
+    @classmethod
+    def from_json(cls, log, text):
+        # a pretty printed response would break the line based stream formats; in valid JSON the line
+        # breaks can only be whitespace between the tokens, those in strings are escaped
+        if '\n' in text or '\r' in text:
+            text = text.replace('\r', ' ').replace('\n', ' ')
+        return cls(log['processed_timestamp'], text)
+
+    @classmethod
+    def from_dict(cls, log):
+        return cls(log['processed_timestamp'], json.dumps(log, default=json_default))
+
+    def __getitem__(self, name):
+        if name == 'processed_timestamp':
+            return self.processed_timestamp
+        return self.as_dict()[name]
+
+    def __iter__(self):
+        return iter(self.as_dict())
+
+    def __len__(self):
+        return len(self.as_dict())
+
+    def as_dict(self):
+        return json.loads(self.raw)
+
+    def __repr__(self):
+        return 'RawRecord(%s)' % self.raw
+
+
+class LogBatch(object):
+    # logs in processed_timestamp order, like a merged page; indexing gives LogRecords, slicing gives a batch
+    __slots__ = ('records', 'degraded_backends')
+
+    def __init__(self, records=(), degraded_backends=()):
+        self.records = []
+        self.degraded_backends = list(degraded_backends)
+        self.extend(records)
+
+    @classmethod
+    def from_logs(cls, logs):
+        return cls(log if isinstance(log, LogRecord) else LogRecord.from_dict(log) for log in logs)
+
+    def append(self, record):
+        self.records.append(record)
+
+    def extend(self, records):
+        for record in records:
+            self.append(record)
+
+    def to_dicts(self):
+        return [record.as_dict() for record in self.records]
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            batch = LogBatch(degraded_backends=self.degraded_backends)
+            batch.records = self.records[index]
+            return batch
+        return self.records[index]
+
+    def __eq__(self, other):
+        if isinstance(other, LogBatch):
+            other = other.records
+        return self.records == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'LogBatch(%r)' % self.records
+
+
+def json_default(value):
+    # the default hook of a JSON encoder, so records and batches are written like the dicts and lists they replace
+    if isinstance(value, (LogRecord, RawRecord)):
+        return value.as_dict()
+    if isinstance(value, LogBatch):
+        return value.records
+    raise TypeError("Object of type %s is not JSON serializable" % type(value).__name__)
+
+
+class RecordEncoder(object):
+    # encodes to UTF-8 JSON bytes; the RawRecords, alone or in a list of them, are spliced in as they are.
+    # With fast, the rest is encoded with orjson if it's installed; it writes no spaces after the separators
+    # and non-ASCII characters unescaped, but the same JSON values as the json module.
+    def __init__(self, fast=False):
+        self.fast = fast and orjson is not None
+
+    def encode(self, value):
+        if isinstance(value, RawRecord):
+            return value.raw.encode('utf-8')
+        if isinstance(value, (list, LogBatch)) and len(value) > 0 and isinstance(value[0], RawRecord):
+            texts = [element.raw if isinstance(element, RawRecord) else self.encode(element).decode('utf-8')
+                     for element in value]
+            return ('[%s]' % ','.join(texts)).encode('utf-8')
+        if self.fast:
+            try:
+                return orjson.dumps(value, default=json_default)
+            except TypeError:
+                pass  # like integers beyond 64 bits, the json module can do them
+        return json.dumps(value, default=json_default).encode('utf-8')
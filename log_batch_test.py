@@ -0,0 +1,137 @@
+import json
+import unittest
+from log_batch import *
+from syslog_format import SyslogFormatter
+
+
+class LogRecordTests(unittest.TestCase):
+    LOG = {'processed_timestamp': 1425599508, 'timestamp': 1425599507, 'host': "testhost", 'program': "sshd",
+           'pid': 1234, 'message': "Accepted publickey for árvíztűrő", 'dynamic_columns': {'user': "root"}}
+
+    def test_record_reads_like_the_dict_it_was_made_of(self):
+        record = LogRecord.from_dict(self.LOG)
+
+        self.assertEqual(self.LOG, record)
+        self.assertEqual(self.LOG, record.as_dict())
+        self.assertEqual("testhost", record['host'])
+        self.assertEqual({'user': "root"}, record['dynamic_columns'])
+        self.assertEqual(len(self.LOG), len(record))
+
+    def test_missing_fields_are_missing_not_none(self):
+        record = LogRecord.from_dict({'processed_timestamp': 1, 'host': None})
+
+        self.assertIsNone(record['host'])
+        self.assertNotIn('program', record)
+        self.assertIsNone(record.get('program'))
+        with self.assertRaises(KeyError):
+            record['program']
+        with self.assertRaises(KeyError):
+            record['no_such_field']
+
+    def test_record_has_no_instance_dict(self):
+        record = LogRecord.from_dict(self.LOG)
+
+        with self.assertRaises(AttributeError):
+            record.__dict__
+
+    def test_hosts_and_programs_are_interned(self):
+        records = [LogRecord.from_dict(json.loads(json.dumps(self.LOG))) for i in range(2)]
+
+        self.assertIs(records[0]['host'], records[1]['host'])
+        self.assertIs(records[0]['program'], records[1]['program'])
+
+    def test_record_is_formatted_as_syslog_like_its_dict(self):
+        log = dict(self.LOG)
+        del log['dynamic_columns']
+        record = LogRecord.from_dict(log)
+
+        for mode in ('iso', 'rfc3164', 'rfc5424'):
+            formatter = SyslogFormatter(mode)
+            self.assertEqual(formatter.format_page([log]), formatter.format_page([record]))
+        # a record keeps its fields in its own order
+        self.assertEqual(log, json.loads(SyslogFormatter('jsonl').format_page([record])))
+
+
+class LogBatchTests(unittest.TestCase):
+    LOGS = [{'processed_timestamp': i, 'host': "host%d" % (i % 3), 'message': "message %d" % i} for i in range(10)]
+
+    def test_batch_reads_like_the_list_of_its_logs(self):
+        batch = LogBatch.from_logs(self.LOGS)
+
+        self.assertEqual(10, len(batch))
+        self.assertEqual(self.LOGS, batch)
+        self.assertEqual(self.LOGS[3], batch[3])
+
+    def test_slice_is_a_batch(self):
+        batch = LogBatch.from_logs(self.LOGS)[2:5]
+
+        self.assertIsInstance(batch, LogBatch)
+        self.assertEqual(self.LOGS[2:5], batch.to_dicts())
+
+    def test_records_and_batches_are_written_as_json_like_dicts_and_lists(self):
+        batch = LogBatch.from_logs(self.LOGS)
+
+        self.assertEqual(json.dumps(self.LOGS), json.dumps(batch, default=json_default))
+        with self.assertRaises(TypeError):
+            json.dumps(object(), default=json_default)
+
+
+class RawRecordTests(unittest.TestCase):
+    TEXT = '{"processed_timestamp": 1425599508, "host": "testhost", "message": "\\u00e1rv\\u00edzt\\u0171r\\u0151"}'
+
+    def test_record_reads_like_the_dict_of_its_text(self):
+        record = RawRecord.from_json(json.loads(self.TEXT), self.TEXT)
+
+        self.assertEqual(1425599508, record.processed_timestamp)
+        self.assertEqual(json.loads(self.TEXT), record)
+        self.assertEqual("árvíztűrő", record['message'])
+        self.assertEqual(3, len(record))
+        with self.assertRaises(KeyError):
+            record['program']
+
+    def test_line_breaks_of_pretty_printed_text_are_removed(self):
+        text = '{\n  "processed_timestamp": 1,\r\n  "message": "a\\nb"\n}'
+
+        record = RawRecord.from_json(json.loads(text), text)
+
+        self.assertNotIn('\n', record.raw)
+        self.assertEqual({'processed_timestamp': 1, 'message': "a\nb"}, record)
+
+    def test_record_made_of_a_dict_has_its_json_text(self):
+        record = RawRecord.from_dict({'processed_timestamp': 2, 'pid': 3})
+
+        self.assertEqual('{"processed_timestamp": 2, "pid": 3}', record.raw)
+
+
+class RecordEncoderTests(unittest.TestCase):
+    LOGS = [{'processed_timestamp': i, 'message': "message %d árvíztűrő" % i} for i in range(3)]
+
+    def _raw_records(self):
+        # the texts of an SSB response are kept byte for byte, whatever their spacing
+        return [RawRecord.from_json(log, json.dumps(log, separators=(',', ':'), ensure_ascii=False))
+                for log in self.LOGS]
+
+    def test_raw_records_are_spliced_in_as_they_are(self):
+        records = self._raw_records()
+
+        encoded = RecordEncoder().encode(LogBatch(records))
+
+        self.assertEqual(('[%s]' % ','.join(record.raw for record in records)).encode('utf-8'), encoded)
+        self.assertEqual(self.LOGS, json.loads(encoded.decode('utf-8')))
+        self.assertEqual(records[1].raw.encode('utf-8'), RecordEncoder().encode(records[1]))
+
+    def test_other_values_are_encoded_like_the_json_module_does(self):
+        value = {'result': LogBatch.from_logs(self.LOGS), 'count': 2 ** 70, 'empty': []}
+
+        self.assertEqual(json.dumps(value, default=json_default).encode('utf-8'), RecordEncoder().encode(value))
+
+    def test_fast_encoder_writes_the_same_values(self):
+        value = [LogBatch.from_logs(self.LOGS), self._raw_records(), {'count': 2 ** 70}]
+
+        for encoder in (RecordEncoder(), RecordEncoder(fast=True)):
+            self.assertEqual(json.loads(json.dumps(value, default=json_default)),
+                             json.loads(encoder.encode(value).decode('utf-8')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,54 +2,210 @@ __author__ = 'gyp@balabit.com'
 import http.client
 import urllib.parse
 import json
-import datetime
+import time
+import concurrent.futures
+import functools
+import heapq
+import itertools
+import collections
+import bisect
+import os
+import queue
+import threading
 import cherrypy
 import configparser
+import hashlib
+import content_encoding
+import json_stream
+import sys
+from syslog_format import SyslogFormatter
+from log_batch import LogBatch, LogRecord, RawRecord, RecordEncoder
+
+BACKEND_TIMEOUT = 30  # seconds
+BACKEND_DEADLINE = 10  # seconds, the SSBs answering later are left out of the result
+FOLLOW_MIN_INTERVAL = 0.2  # seconds
+FOLLOW_MAX_INTERVAL = 5  # seconds
+SESSION_REFRESH_INTERVAL = 15 * 60  # seconds
+COUNT_INDEX_PATH = 'merge_proxy_counts.json'
+STREAM_CHUNK_SIZE = 256  # logs per chunk of a streamed response
+MIN_FIRST_PAGE_SIZE = 16  # logs asked from an SSB first when a merge needs only a few
+MAX_FOLLOWS = 20  # followed streams open at once, each of them holds a server thread until the client leaves
+SERVER_THREAD_POOL = MAX_FOLLOWS + 10  # the threads left to the other requests when all the follows are open
+METRICS_ENABLED = True  # the per request timings and the /metrics endpoint, False saves their cost
+
+
+class AuthenticationError(Exception):
+    pass
+
+
+class SSBError(Exception):
+    # an SSB answering a request with an error status
+    pass
 
 
 class SSBAPI:
-    def __init__(self, http_connection):
+    # with metrics, the phases of each request are timed, labeled with the address of the SSB and the logspace
+    def __init__(self, http_connection, seek_index=None, metrics=None):
         self.conn = http_connection
         self.authentication_token = None
+        self.seek_index = seek_index
+        self._credentials = None
+        self._login_lock = threading.Lock()
+        self.metrics = metrics
 
     def login(self, username, password):
+        # kept to be able to log in again when the session expires, or on the next request if this login fails
+        self._credentials = (username, password)
+        self.authentication_token = self._login(username, password)
+
+    def _login(self, username, password):
         params = urllib.parse.urlencode({'username': username, 'password': password})
         headers = {"Content-type": "application/x-www-form-urlencoded",
                   "Accept": "text/plain"}
         self.conn.request("POST", "/api/1/login", params, headers)
+        response = self.conn.getresponse()
+        raw_response = response.readall().decode()
         try:
-            response = self.conn.getresponse()
-            response_body = json.loads(response.readall().decode())
-            self.authentication_token = response_body['result']
-        except Exception:
-            pass  # no error handling for now...
+            token = json.loads(raw_response)['result']
+        except (ValueError, KeyError, TypeError):
+            token = None
+        if response.status != 200 or not isinstance(token, str):
+            raise AuthenticationError("Login as '%s' failed with HTTP status %d" % (username, response.status))
+        return token
+
+    def refresh_session(self):
+        # the new session is opened before the old one is closed, so the requests in flight can finish
+        with self._login_lock:
+            old_token = self.authentication_token
+            self.authentication_token = self._login(*self._credentials)
+        if old_token is not None:
+            self._logout(old_token)
 
     def list_logspaces(self):
         return set(self._get_response_for_query("/api/1/search/logspace/list_logspaces"))
 
-    def _get_response_for_query(self, get_query):
-        self._authenticated_get_query(get_query)
+    def _get_response_for_query(self, get_query, logspace=''):
+        response = self._authenticated_response(get_query)
+        if self.metrics is None:
+            return json.loads(response.readall().decode())['result']
+        read_started = time.perf_counter()
+        raw_response = response.readall()
+        decode_started = time.perf_counter()
+        result = json.loads(raw_response.decode())['result']
+        # the bytes on the wire, compressed if the SSB compressed them
+        self._record_timings(response, logspace, [('read', decode_started - read_started),
+                                                  ('decode', time.perf_counter() - decode_started)],
+                             getattr(response, 'bytes_read', len(raw_response)))
+        return result
+
+    def _record_timings(self, response, logspace, phases, number_of_bytes):
+        # the connection pool times what happens before the response body: connect, tls and server
+        backend_name = getattr(self, 'address', '')
+        for (phase, seconds) in list(getattr(response, 'timings', {}).items()) + phases:
+            self.metrics.observe(phase, seconds, logspace, backend_name)
+        self.metrics.add_bytes(number_of_bytes, logspace, backend_name)
+
+    def _authenticated_response(self, get_query):
+        if self.authentication_token is None and self._credentials is not None:
+            # the login failed so far, it's tried again by each request until it succeeds
+            self._renew_session(None)
+        token = self.authentication_token
+        self._authenticated_get_query(get_query, token)
         response = self.conn.getresponse()
-        raw_response = response.readall().decode()
-        response_body = json.loads(raw_response)
-        self.conn.close()
-        return response_body['result']
+        if response.status == 401 and self._credentials is not None:
+            # the session expired or the SSB was restarted: one new login and one more try
+            response.read()
+            self._renew_session(token)
+            self._authenticated_get_query(get_query, self.authentication_token)
+            response = self.conn.getresponse()
+        if response.status == 401:
+            response.read()
+            raise AuthenticationError("The session was rejected by the SSB")
+        response = content_encoding.decoded(response)
+        if response.status != 200:
+            # a streamed error response would look like an empty result
+            raise SSBError("The SSB answered HTTP status %d: %s" % (response.status, self._error_message(response)))
+        return response
+
+    @staticmethod
+    def _error_message(response):
+        body = response.read().decode('utf-8', 'replace')
+        try:
+            return json.loads(body)['error']['message']
+        except (ValueError, KeyError, TypeError):
+            return body[:200]
+
+    def _renew_session(self, rejected_token):
+        with self._login_lock:
+            # the other threads getting the same 401 find the session renewed already
+            if self.authentication_token == rejected_token:
+                self.authentication_token = self._login(*self._credentials)
 
-    def _authenticated_get_query(self, get_query):
+    def _authenticated_get_query(self, get_query, authentication_token):
+        # the results are repetitive text, compressed they take a fraction of the time over a slow link
         self.conn.request("GET", get_query,
                           headers={
-                              "Cookie": urllib.parse.urlencode({"AUTHENTICATION_TOKEN": self.authentication_token})
+                              "Cookie": urllib.parse.urlencode({"AUTHENTICATION_TOKEN": authentication_token}),
+                              "Accept-Encoding": content_encoding.accept_encoding()
                           })
 
     def logout(self):
-        self._authenticated_get_query("/api/1/logout")
+        self._credentials = None
+        if self.authentication_token is not None:
+            self._logout(self.authentication_token)
+
+    def _logout(self, authentication_token):
+        self._authenticated_get_query("/api/1/logout", authentication_token)
+        # the body has to be read, otherwise the connection can't be used for the next request
+        self.conn.getresponse().read()
 
     def filter(self, logspace, from_timestamp=0, to_timestamp=9999999999, search_expression=None, offset=0, limit=10):
-        return self._filter_type_command("filter", logspace,
-                                         from_timestamp, to_timestamp, search_expression,
-                                         offset, limit)
+        if self.seek_index is None:
+            return self._filter_type_command("filter", logspace,
+                                             from_timestamp, to_timestamp, search_expression,
+                                             offset, limit)
+
+        (query, seek_from_timestamp, seek_offset) = self._seek(logspace, from_timestamp, to_timestamp,
+                                                               search_expression, offset)
+        logs = self._filter_type_command("filter", logspace,
+                                         seek_from_timestamp, to_timestamp, search_expression,
+                                         seek_offset, limit)
+        self.seek_index.record(query, int(offset), logs)
+        return logs
+
+    def _seek(self, logspace, from_timestamp, to_timestamp, search_expression, offset):
+        query = (logspace, int(from_timestamp), int(to_timestamp), search_expression)
+        (seek_from_timestamp, seek_offset) = self.seek_index.seek(query, int(offset))
+        if seek_from_timestamp is None:
+            seek_from_timestamp = from_timestamp
+        return query, seek_from_timestamp, seek_offset
+
+    def iter_filter(self, logspace, from_timestamp=0, to_timestamp=9999999999, search_expression=None, offset=0, limit=10,
+                    raw=False):
+        # the request is sent right away, but the logs are parsed one by one as the response body arrives;
+        # with raw, they are RawRecords keeping the JSON text of the logs
+        recorder = None
+        if self.seek_index is not None:
+            (query, from_timestamp, seek_offset) = self._seek(logspace, from_timestamp, to_timestamp,
+                                                              search_expression, offset)
+            recorder = self.seek_index.recorder(query, int(offset))
+            offset = seek_offset
+        response = self._authenticated_response(self._filter_type_query("filter", logspace,
+                                                                        from_timestamp, to_timestamp,
+                                                                        search_expression, offset, limit))
+        if self.metrics is None:
+            return ResultStream(response, recorder, raw=raw)
+        # reading and parsing the body go hand in hand here, they are timed together
+        return ResultStream(response, recorder, on_done=lambda seconds: self._record_timings(
+            response, logspace, [('stream', seconds)], getattr(response, 'bytes_read', 0)), raw=raw)
 
     def _filter_type_command(self, command, logspace, from_timestamp, to_timestamp, search_expression=None, offset=None, limit=None):
+        return self._get_response_for_query(self._filter_type_query(command, logspace,
+                                                                    from_timestamp, to_timestamp, search_expression,
+                                                                    offset, limit), logspace)
+
+    @staticmethod
+    def _filter_type_query(command, logspace, from_timestamp, to_timestamp, search_expression=None, offset=None, limit=None):
         params = {'from': from_timestamp, 'to': to_timestamp}
 
         if offset is not None:
@@ -61,166 +217,2035 @@ class SSBAPI:
 
         params_urlencoded = urllib.parse.urlencode(params)
 
-        return self._get_response_for_query("/api/1/search/logspace/%s/%s?%s" % (command, logspace, params_urlencoded))
+        return "/api/1/search/logspace/%s/%s?%s" % (command, logspace, params_urlencoded)
 
 
     def number_of_messages(self, logspace, from_timestamp=0, to_timestamp=9999999999, search_expression=None, offset=0, limit=10):
         return self._filter_type_command("number_of_messages", logspace,
                                          from_timestamp, to_timestamp, search_expression)
 
+    def follow(self, logspace, search_expression=None, backlog=10, page_size=1000,
+               min_interval=FOLLOW_MIN_INTERVAL, max_interval=FOLLOW_MAX_INTERVAL):
+        # an endless iterator of the last backlog logs, then the new ones as they arrive, like tail -f
+        return follow_logs(self.follower(logspace, search_expression, backlog, page_size),
+                           min_interval, max_interval)
+
+    def follower(self, logspace, search_expression=None, backlog=10, page_size=1000):
+        return LogFollower(self, logspace, search_expression, backlog, page_size)
+
+
+class SeekIndex:
+    # checkpoints of "exactly <offset> logs of the query have a processed_timestamp below <timestamp>",
+    # recorded while paging; a deep offset then becomes a query from <timestamp> with a small residual
+    # offset instead of making the SSB skip all the rows. New logs always get a later processed_timestamp,
+    # so the checkpoints stay valid for queries still receiving logs too.
+    def __init__(self, max_queries=128):
+        self._max_queries = max_queries
+        self._checkpoints = collections.OrderedDict()  # query -> ([offsets], [timestamps]), sorted by offset
+        self._lock = threading.Lock()
+
+    def seek(self, query, offset):
+        with self._lock:
+            if query not in self._checkpoints:
+                return None, offset
+            self._checkpoints.move_to_end(query)
+            (offsets, timestamps) = self._checkpoints[query]
+            position = bisect.bisect_right(offsets, offset) - 1
+            if position < 0:
+                return None, offset
+            return timestamps[position], offset - offsets[position]
+
+    def record(self, query, offset, logs):
+        recorder = self.recorder(query, offset)
+        for log in logs:
+            recorder.observe(log)
+        recorder.commit()
+
+    def recorder(self, query, offset):
+        return CheckpointRecorder(self, query, offset)
+
+    def add_checkpoint(self, query, offset, timestamp):
+        with self._lock:
+            (offsets, timestamps) = self._checkpoints.setdefault(query, ([], []))
+            self._checkpoints.move_to_end(query)
+            position = bisect.bisect_left(offsets, offset)
+            if position == len(offsets) or offsets[position] != offset:
+                offsets.insert(position, offset)
+                timestamps.insert(position, timestamp)
+            while len(self._checkpoints) > self._max_queries:
+                self._checkpoints.popitem(last=False)
+
+
+class CheckpointRecorder:
+    # watches a page of logs go by and keeps its last timestamp change as the checkpoint
+    def __init__(self, seek_index, query, offset):
+        self._seek_index = seek_index
+        self._query = query
+        self._offset = offset
+        self._previous_timestamp = None
+        self._checkpoint = None
+
+    def observe(self, log):
+        timestamp = log['processed_timestamp']
+        if self._previous_timestamp is not None and timestamp > self._previous_timestamp:
+            self._checkpoint = (self._offset, timestamp)
+        self._previous_timestamp = timestamp
+        self._offset += 1
+
+    def commit(self):
+        if self._checkpoint is not None:
+            self._seek_index.add_checkpoint(self._query, *self._checkpoint)
+            self._checkpoint = None
+
+
+class ResultStream:
+    # iterates over the "result" array of a response while it's being downloaded; on_done gets the seconds
+    # spent downloading and parsing when the stream is closed. With raw, the logs are RawRecords.
+    def __init__(self, response, recorder=None, on_done=None, raw=False):
+        self._response = response
+        self._next_result = json_stream.iter_result(response.read, raw=raw).__next__
+        if raw:
+            next_element_and_text = self._next_result
+            self._next_result = lambda: RawRecord.from_json(*next_element_and_text())
+        self._recorder = recorder
+        self._on_done = on_done
+        self._stopwatch = None
+        if on_done is not None:
+            self._stopwatch = Stopwatch()
+            self._next_result = self._stopwatch.timed(self._next_result)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            element = self._next_result()
+        except StopIteration:
+            self._response.read()
+            self.close()
+            raise
+        if self._recorder is not None:
+            self._recorder.observe(element)
+        return element
+
+    def close(self):
+        if self._recorder is not None:
+            self._recorder.commit()
+        self._response.close()
+        if self._on_done is not None:
+            (on_done, self._on_done) = (self._on_done, None)
+            on_done(self._stopwatch.seconds)
+
+
+class Stopwatch:
+    # adds up the time spent in the functions it wraps
+    def __init__(self):
+        self.seconds = 0.0
+
+    def timed(self, func):
+        def timed_func(*args):
+            started = time.perf_counter()
+            try:
+                return func(*args)
+            finally:
+                self.seconds += time.perf_counter() - started
+
+        return timed_func
+
+
+class TimedHTTPSConnection(http.client.HTTPSConnection):
+    # the connect of HTTPSConnection, with the TCP connect and the TLS handshake timed separately
+    connect_seconds = None
+    tls_seconds = None
+
+    def connect(self):
+        started = time.perf_counter()
+        http.client.HTTPConnection.connect(self)
+        connected = time.perf_counter()
+        server_hostname = self._tunnel_host if self._tunnel_host else self.host
+        self.sock = self._context.wrap_socket(self.sock, server_hostname=server_hostname)
+        self.connect_seconds = connected - started
+        self.tls_seconds = time.perf_counter() - connected
+
+
+class HTTPSConnectionPool:
+    # quacks like a single HTTPSConnection for SSBAPI, but each thread checks out its own keep-alive
+    # connection for a request()/getresponse() pair and it's given back once the response body is read
+    _STALE_CONNECTION_ERRORS = (ConnectionError, http.client.BadStatusLine)
+
+    def __init__(self, address, maxsize=4, timeout=None, context=None,
+                 connection_class=TimedHTTPSConnection):
+        self._address = address
+        self._timeout = timeout
+        self._context = context
+        self._connection_class = connection_class
+        self._idle_connections = queue.LifoQueue(maxsize)
+        self._checked_out = threading.local()
+
+    def request(self, method, url, body=None, headers={}):
+        try:
+            (connection, reused) = (self._idle_connections.get_nowait(), True)
+        except queue.Empty:
+            (connection, reused) = (self._new_connection(), False)
+        self._checked_out.request = (method, url, body, headers)
+        self._checked_out.connection = connection
+        self._checked_out.reused = reused
+        try:
+            connection.request(method, url, body, headers)
+        except self._STALE_CONNECTION_ERRORS:
+            self._reconnect_or_raise()
+        self._checked_out.sent_at = time.perf_counter()
+
+    def getresponse(self):
+        try:
+            response = self._checked_out.connection.getresponse()
+        except self._STALE_CONNECTION_ERRORS:
+            self._reconnect_or_raise()
+            response = self._checked_out.connection.getresponse()
+        connection = self._checked_out.connection
+        self._checked_out.connection = None
+        # the time the server took includes the network round trip, but not connecting
+        timings = {'server': time.perf_counter() - self._checked_out.sent_at}
+        if not self._checked_out.reused and getattr(connection, 'connect_seconds', None) is not None:
+            timings['connect'] = connection.connect_seconds
+            timings['tls'] = connection.tls_seconds
+        return PooledResponse(response, lambda: self._give_back(connection, response),
+                              lambda: connection.close(), timings)
+
+    def _reconnect_or_raise(self):
+        # an idle keep-alive connection may have been closed by the server meanwhile, that's worth one retry
+        self._checked_out.connection.close()
+        if not self._checked_out.reused:
+            raise
+        self._checked_out.connection = self._new_connection()
+        self._checked_out.reused = False
+        self._checked_out.connection.request(*self._checked_out.request)
+        self._checked_out.sent_at = time.perf_counter()
+
+    def _new_connection(self):
+        return self._connection_class(self._address, timeout=self._timeout, context=self._context)
+
+    def _give_back(self, connection, response):
+        if response.will_close:
+            connection.close()
+            return
+        try:
+            self._idle_connections.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def close(self):
+        while True:
+            try:
+                self._idle_connections.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class PooledResponse:
+    MAX_BYTES_TO_DRAIN = 64 * 1024
+
+    def __init__(self, response, release, discard, timings=None):
+        self._response = response
+        self._release = release
+        self._discard = discard
+        self._released = False
+        self.status = response.status
+        self.timings = timings if timings is not None else {}
+        self.bytes_read = 0
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    def read(self, amt=None):
+        data = self._response.read(amt)
+        self.bytes_read += len(data)
+        if self._response.isclosed() and not self._released:
+            self._released = True
+            self._release()
+        return data
+
+    def readall(self):
+        return self.read()
+
+    def close(self):
+        if self._released:
+            return
+        # a connection with an unread body in it can't be reused, but a short rest is worth reading out
+        remaining = self._response.length
+        if remaining is not None and remaining <= self.MAX_BYTES_TO_DRAIN:
+            self.read()
+            if self._released:
+                return
+        self._released = True
+        self._response.close()
+        self._discard()
+
 
 class SSB(SSBAPI):
-    def __init__(self, address):
-        connection = http.client.HTTPSConnection(address)
-        super().__init__(connection)
+    def __init__(self, address, timeout=None, pool_size=4, context=None, seek_index=None, metrics=None):
+        self.address = address
+        connection_pool = HTTPSConnectionPool(address, maxsize=pool_size, timeout=timeout, context=context)
+        super().__init__(connection_pool, seek_index if seek_index is not None else SeekIndex(), metrics)
 
 
 class KWayMerger:
-    def __init__(self, fetch_functions):
-        self._fetch_functions = fetch_functions
-        self._next_values = []
-        for i in range(len(fetch_functions)):
-            self._next_values.append(None)
+    # every fetch function returns the next value of an ordered source or None when it is exhausted;
+    # the heap holds one (key, source index, value) entry per source, so equal keys keep the source order.
+    # The source of the value taken last is only asked for its next value when another value is taken,
+    # so a merge stopping at a limit doesn't make a source download a page it won't use.
+    def __init__(self, fetch_functions, key=None):
+        self._fetch_functions = tuple(fetch_functions)
+        self._key = key
+        self._heap = None
+        self._top_taken = False
+        self.taken_count = 0
+
+    def next(self):
+        taken = self.take(1)
+        if len(taken) == 0:
+            return None
+        return taken[0]
+
+    def take(self, count):
+        if self._heap is None:
+            self._fill_up_heap()
+
+        heap = self._heap
+        fetch_functions = self._fetch_functions
+        key = self._key
+        top_taken = self._top_taken
+        taken = []
+        while len(taken) < count:
+            if top_taken:
+                source_index = heap[0][1]
+                next_value = fetch_functions[source_index]()
+                if next_value is None:
+                    heapq.heappop(heap)
+                else:
+                    next_key = next_value if key is None else key(next_value)
+                    heapq.heapreplace(heap, (next_key, source_index, next_value))
+                top_taken = False
+            if not heap:
+                break
+            taken.append(heap[0][2])
+            self.taken_count += 1
+            top_taken = True
+        self._top_taken = top_taken
+        return taken
+
+    def _fill_up_heap(self):
+        self._heap = []
+        for source_index, fetch_func in enumerate(self._fetch_functions):
+            value = fetch_func()
+            if value is not None:
+                value_key = value if self._key is None else self._key(value)
+                self._heap.append((value_key, source_index, value))
+        heapq.heapify(self._heap)
+
+
+class SSBCursor:
+    # pages through the results of a single SSB lazily, so at most one page is held in memory; if the SSB
+    # can stream (iter_filter), not even that, the logs are parsed as they are merged. The pages start at
+    # first_page_size and double up to page_size, but no page is bigger than what wanted() returns, the
+    # number of logs the merge can still use. With raw, the streamed logs are RawRecords. The pages after the
+    # first one are asked with request(cursor) if it's given, which calls request_page in the end.
+    def __init__(self, ssb, logspace, from_timestamp, to_timestamp, search_expression, page_size,
+                 first_page_size=None, wanted=None, raw=False, request=None):
+        self._ssb = ssb
+        self._raw = raw
+        self._request = request
+        self._query = (logspace, from_timestamp, to_timestamp, search_expression)
+        self._max_page_size = page_size
+        self._page_size = page_size if first_page_size is None else min(first_page_size, page_size)
+        self._wanted = wanted
+        self._page = iter(())
+        self._requested_limit = None  # the limit of the last page asked for
+        self._page_limit = None  # None until the first page is fetched
+        self._page_length = 0
+        self._streamed = False
+        self._next_offset = 0
+        self._exhausted = False
+        self.transferred = 0  # the logs downloaded, whether they were used or not
+        self.used = 0
+
+    def fetch_page(self):
+        self.use_page(self.request_page() if self._request is None else self._request(self))
+
+    def request_page(self):
+        # doesn't change the cursor, so it can be called again if the SSB is slow to answer
+        if self._exhausted:
+            return iter(())
+        # use_page tells the last page by this limit, wanted() may return something else by then
+        limit = self._requested_limit = self._next_page_limit()
+        if not hasattr(self._ssb, 'iter_filter'):
+            return self._ssb.filter(*self._query, offset=self._next_offset, limit=limit)
+        if self._raw:
+            return self._ssb.iter_filter(*self._query, offset=self._next_offset, limit=limit, raw=True)
+        return self._ssb.iter_filter(*self._query, offset=self._next_offset, limit=limit)
+
+    def _next_page_limit(self):
+        if self._wanted is None:
+            return self._page_size
+        return max(min(self._page_size, self._wanted()), 1)
+
+    def use_page(self, page):
+        self.close()
+        # a list page is downloaded as a whole, a streamed one only as far as it is read
+        self._streamed = not hasattr(page, '__len__')
+        if not self._streamed:
+            self.transferred += len(page)
+        self._page = iter(page)
+        self._page_limit = self._requested_limit
+        self._page_length = 0
+        self._page_size = min(self._page_size * 2, self._max_page_size)
 
     def next(self):
-        self._fill_up_empty_next_value_slots()
-        return self._return_and_drop_smallest_from_next_values()
+        log = next(self._page, None)
+        if log is None:
+            if self._page_limit is not None and self._page_length < self._page_limit:
+                self._exhausted = True
+            if self._exhausted:
+                return None
+            self.fetch_page()
+            log = next(self._page, None)
+            if log is None:
+                self._exhausted = True
+                return None
+        if self._streamed:
+            self.transferred += 1
+        self._page_length += 1
+        self._next_offset += 1
+        self.used += 1
+        return log
+
+    def close(self):
+        self.close_page(self._page)
+        self._page = iter(())
+
+    @staticmethod
+    def close_page(page):
+        # gives a half read streamed page back to the SSB connection
+        if hasattr(page, 'close'):
+            page.close()
+
+
+class BackendUnavailableError(Exception):
+    pass
+
+
+class LatencyTracker:
+    # the last window response times of each backend and operation, as what's slow differs from backend to
+    # backend, and a count or a list of the logspaces takes a fraction of the time of a page of logs
+    def __init__(self, window=200, min_samples=20):
+        self._window = window
+        self._min_samples = min_samples
+        self._latencies = {}  # (backend name, operation) -> deque of seconds
+        self._lock = threading.Lock()
+
+    def record(self, backend_name, seconds, operation=None):
+        key = (backend_name, operation)
+        with self._lock:
+            if key not in self._latencies:
+                self._latencies[key] = collections.deque(maxlen=self._window)
+            self._latencies[key].append(seconds)
+
+    def percentile(self, backend_name, percent, operation=None):
+        # None until there are enough samples to tell
+        with self._lock:
+            latencies = sorted(self._latencies.get((backend_name, operation), ()))
+        if len(latencies) < self._min_samples:
+            return None
+        return latencies[min(len(latencies) * percent // 100, len(latencies) - 1)]
+
+
+class CircuitBreaker:
+    # after failure_threshold failures in a row a backend isn't called for reset_timeout seconds, so a dead
+    # one doesn't make every query wait for its timeout; then a single trial call decides if it's back
+    def __init__(self, failure_threshold=5, reset_timeout=30, clock=time.monotonic):
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._clock = clock
+        self._failures = collections.Counter()
+        self._open_until = {}
+        self._trials = set()
+        self._lock = threading.Lock()
+
+    def allow(self, backend_name):
+        with self._lock:
+            if backend_name not in self._open_until:
+                return True
+            if self._clock() < self._open_until[backend_name] or backend_name in self._trials:
+                return False
+            self._trials.add(backend_name)
+            return True
+
+    def record_success(self, backend_name):
+        with self._lock:
+            del self._failures[backend_name]
+            self._open_until.pop(backend_name, None)
+            self._trials.discard(backend_name)
+
+    def record_failure(self, backend_name):
+        with self._lock:
+            self._failures[backend_name] += 1
+            self._trials.discard(backend_name)
+            if self._failures[backend_name] >= self._failure_threshold:
+                self._open_until[backend_name] = self._clock() + self._reset_timeout
+
+    def release_trial(self, backend_name):
+        # the trial call was given up on before it started, it tells nothing: the next call is the trial
+        with self._lock:
+            self._trials.discard(backend_name)
+
+    def trip(self, backend_name):
+        # opens the breaker without waiting for failure_threshold failures
+        with self._lock:
+            self._failures[backend_name] = max(self._failures[backend_name], self._failure_threshold)
+            self._trials.discard(backend_name)
+            self._open_until[backend_name] = self._clock() + self._reset_timeout
+
+    def open_backends(self):
+        with self._lock:
+            return set(self._open_until)
+
+
+class _Attempt:
+    def __init__(self, executor, func, backend):
+        self.started = None
+        self.finished = None
+        self.future = executor.submit(self._run, func, backend)
+
+    def _run(self, func, backend):
+        self.started = time.monotonic()
+        try:
+            return func(backend)
+        finally:
+            self.finished = time.monotonic()
+
+
+class FanOutExecutor:
+    # runs the same call against every backend at once; the timeout is counted for each
+    # backend separately from the moment its call actually started (not while queued).
+    # The backend names enable the latency tracking and the circuit breaker; with hedge, a call
+    # running longer than the hedge_percentile latency of its backend gets an identical second
+    # call, the first answer wins. Only calls without side effects may be hedged.
+    def __init__(self, max_workers, timeout=None, latency_tracker=None, circuit_breaker=None,
+                 hedge_percentile=95, min_hedge_delay=0.01):
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self._timeout = timeout
+        self._latency_tracker = latency_tracker
+        self._circuit_breaker = circuit_breaker
+        self._hedge_percentile = hedge_percentile
+        self._min_hedge_delay = min_hedge_delay
+        self.hedged_calls = 0
+
+    def map(self, func, backends, names=None, hedge=False, discard=None, operation=None):
+        (results, failures) = self._run(func, backends, names, hedge, discard, None, operation, partial=False)
+        if failures:
+            raise failures[min(failures)]
+        return results
+
+    def map_partial(self, func, backends, names=None, hedge=False, discard=None, deadline=None, operation=None):
+        # doesn't raise: the results of the failed backends are None, failures has their exception by index,
+        # and the backends not done in deadline seconds count as failed. discard gets the results which
+        # arrive after their backend was given up (or lost the race of a hedged call), to release them.
+        # The latencies are tracked (and the calls hedged) by operation, the name of what func does.
+        return self._run(func, backends, names, hedge, discard, deadline, operation, partial=True)
+
+    def _run(self, func, backends, names, hedge, discard, deadline, operation, partial):
+        started = time.monotonic()
+        if names is None:
+            names = [None] * len(backends)
+        attempts = [[] for backend in backends]
+        results = [None] * len(backends)
+        failures = {}
+        pending = set()
+        for (index, backend) in enumerate(backends):
+            if names[index] is not None and self._circuit_breaker is not None and \
+                    not self._circuit_breaker.allow(names[index]):
+                failures[index] = BackendUnavailableError("backend %s keeps failing, it's left out for a while" %
+                                                          names[index])
+            else:
+                attempts[index].append(_Attempt(self._executor, func, backend))
+                pending.add(index)
+
+        while pending and (partial or not failures):
+            now = time.monotonic()
+            wake_up_times = [] if deadline is None else [started + deadline]
+            for index in sorted(pending):
+                (outcome, wake_up_time) = self._check(index, func, backends[index], names[index], attempts[index],
+                                                      hedge, discard, now,
+                                                      deadline is not None and now >= started + deadline, operation)
+                if outcome is None:
+                    if wake_up_time is not None:
+                        wake_up_times.append(wake_up_time)
+                    continue
+                pending.discard(index)
+                (succeeded, value) = outcome
+                if succeeded:
+                    results[index] = value
+                else:
+                    failures[index] = value
+                    self._abandon(attempts[index], discard)
+            if pending and (partial or not failures):
+                self._wait(attempts, pending, wake_up_times, now)
+
+        for index in pending:
+            # given up on as another backend failed: the outcome is recorded once the calls end, so a circuit
+            # breaker trial among them doesn't stay in flight
+            self._abandon(attempts[index], discard)
+            self._record_when_done(names[index], attempts[index], operation)
+        return results, failures
+
+    def _check(self, index, func, backend, name, attempts, hedge, discard, now, deadline_passed, operation):
+        # returns ((succeeded, result or exception), None) when the backend is done, (None, wake up time) if not
+        for attempt in attempts:
+            if attempt.future.done() and attempt.future.exception() is None:
+                self._record(name, True, attempt.finished - attempt.started, operation)
+                self._abandon([other for other in attempts if other is not attempt], discard)
+                return (True, attempt.future.result()), None
+        if all(attempt.future.done() for attempt in attempts):
+            self._record(name, False)
+            return (False, attempts[-1].future.exception()), None
+
+        first_started = attempts[0].started
+        if deadline_passed or (self._timeout is not None and first_started is not None and
+                               now - first_started >= self._timeout):
+            self._record(name, False)
+            return (False, concurrent.futures.TimeoutError("backend %s did not answer in time" %
+                                                           (name if name is not None else "#%d" % index))), None
+
+        wake_up_times = []
+        if first_started is None:
+            # a queued call has no start time yet to count from, so it's looked at again soon
+            return None, (now + 0.01 if self._timeout is not None or hedge else None)
+        if self._timeout is not None:
+            wake_up_times.append(first_started + self._timeout)
+        hedge_delay = self._hedge_delay(name, operation) if hedge and len(attempts) == 1 else None
+        if hedge_delay is not None:
+            if now - first_started >= hedge_delay:
+                attempts.append(_Attempt(self._executor, func, backend))
+                self.hedged_calls += 1
+            else:
+                wake_up_times.append(first_started + hedge_delay)
+        return None, min(wake_up_times) if wake_up_times else None
+
+    def _hedge_delay(self, name, operation):
+        if name is None or self._latency_tracker is None:
+            return None
+        latency = self._latency_tracker.percentile(name, self._hedge_percentile, operation)
+        return None if latency is None else max(latency, self._min_hedge_delay)
+
+    def _record(self, name, succeeded, seconds=None, operation=None):
+        if name is None:
+            return
+        if self._latency_tracker is not None and succeeded:
+            self._latency_tracker.record(name, seconds, operation)
+        if self._circuit_breaker is not None:
+            if succeeded:
+                self._circuit_breaker.record_success(name)
+            else:
+                self._circuit_breaker.record_failure(name)
+
+    def _record_when_done(self, name, attempts, operation):
+        if name is None:
+            return
+        lock = threading.Lock()
+        state = {'done': 0, 'recorded': False}
+
+        def attempt_done(attempt):
+            future = attempt.future
+            with lock:
+                state['done'] += 1
+                if state['recorded']:
+                    return
+                succeeded = not future.cancelled() and future.exception() is None
+                if not succeeded and state['done'] < len(attempts):
+                    return
+                state['recorded'] = True
+            if succeeded:
+                self._record(name, True, attempt.finished - attempt.started, operation)
+            elif any(not other.future.cancelled() for other in attempts):
+                self._record(name, False)
+            elif self._circuit_breaker is not None:
+                self._circuit_breaker.release_trial(name)
+
+        for attempt in attempts:
+            attempt.future.add_done_callback(lambda future, attempt=attempt: attempt_done(attempt))
+
+    @staticmethod
+    def _abandon(attempts, discard):
+        for attempt in attempts:
+            if not attempt.future.cancel() and discard is not None:
+                attempt.future.add_done_callback(
+                    lambda future: discard(future.result()) if future.exception() is None else None)
+
+    def _wait(self, attempts, pending, wake_up_times, now):
+        # the answered calls are passed too, a call started by the last check may have answered already;
+        # the failed ones are not, those would end the wait right away while their hedging pair still runs
+        futures = [attempt.future for index in pending for attempt in attempts[index]
+                   if not attempt.future.done() or attempt.future.exception() is None]
+        wait_time = max(min(wake_up_times) - now, 0) if wake_up_times else None
+        concurrent.futures.wait(futures, timeout=wait_time, return_when=concurrent.futures.FIRST_COMPLETED)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+class SessionManager:
+    # keeps every SSB logged in: the logins run simultaneously, so the startup takes as long as the
+    # slowest one, and a background thread logs in again every refresh_interval seconds, ahead of the
+    # session expiry. A session lost anyway is renewed by SSBAPI on the first 401. An SSB failing to log in
+    # doesn't stop the others: SSBAPI logs in on its next request, and until then its circuit breaker is open.
+    def __init__(self, ssbs, refresh_interval=SESSION_REFRESH_INTERVAL, timeout=None, circuit_breaker=None):
+        self._ssbs = ssbs
+        self._refresh_interval = refresh_interval
+        self._circuit_breaker = circuit_breaker
+        self._fan_out = FanOutExecutor(max(len(ssbs), 1), timeout)
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def login_all(self, credentials):
+        # credentials has a (username, password) pair for each SSB; returns the names of the SSBs failing to log in
+        def login(indexed_ssb_and_credentials):
+            (ssb_index, (ssb_instance, (username, password))) = indexed_ssb_and_credentials
+            try:
+                ssb_instance.login(username, password)
+            except Exception:
+                backend_name = MergeProxy._backend_name(ssb_index, ssb_instance)
+                cherrypy.log("Logging in to SSB %s failed" % backend_name, traceback=True)
+                if self._circuit_breaker is not None:
+                    self._circuit_breaker.trip(backend_name)
+                return backend_name
+            return None
+
+        failed = self._fan_out.map(login, list(enumerate(zip(self._ssbs, credentials))))
+        return [backend_name for backend_name in failed if backend_name is not None]
+
+    def refresh_all(self):
+        def refresh(indexed_ssb):
+            (ssb_index, ssb_instance) = indexed_ssb
+            try:
+                ssb_instance.refresh_session()
+            except Exception:
+                # the next refresh or the first 401 will try again
+                cherrypy.log("Refreshing the session of SSB %s failed" %
+                             MergeProxy._backend_name(ssb_index, ssb_instance), traceback=True)
+
+        self._fan_out.map(refresh, list(enumerate(self._ssbs)))
+
+    def logout_all(self):
+        self._fan_out.map(lambda ssb_instance: ssb_instance.logout(), self._ssbs)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._refresh_periodically, name="session-refresh", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _refresh_periodically(self):
+        while not self._stopped.wait(self._refresh_interval):
+            self.refresh_all()
+
+
+class ResultCache:
+    # an LRU cache for merged results; logs with a processed_timestamp well in the past can't change any
+    # more, so queries ending there are kept for long_ttl, the ones touching the present only for short_ttl.
+    # The cached results hold at most max_logs logs together, and a result of more than max_entry_logs logs
+    # is not cached at all, so a few huge pages can't push out everything else.
+    def __init__(self, max_entries=1024, short_ttl=5, long_ttl=24 * 3600, settle_time=60, clock=time.time,
+                 max_logs=1000000, max_entry_logs=100000):
+        self._max_entries = max_entries
+        self._max_logs = max_logs
+        self._max_entry_logs = max_entry_logs
+        self._short_ttl = short_ttl
+        self._long_ttl = long_ttl
+        self._settle_time = settle_time
+        self._clock = clock
+        self._entries = collections.OrderedDict()  # key -> (expires at, value, number of logs)
+        self._logs = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_or_compute(self, key, to_timestamp, compute):
+        now = self._clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                (expires_at, value, size) = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+                self._logs -= size
+            self.misses += 1
+
+        value = compute()
+        if getattr(value, 'degraded_backends', None):
+            # an incomplete result is not kept, the next query may get the whole of it
+            return value
+        # a count is a single number, a page is as big as its logs
+        size = len(value) if hasattr(value, '__len__') else 1
+        if size > self._max_entry_logs:
+            return value
+        ttl = self._long_ttl if to_timestamp <= now - self._settle_time else self._short_ttl
+        with self._lock:
+            if key in self._entries:
+                self._logs -= self._entries[key][2]
+            self._entries[key] = (now + ttl, value, size)
+            self._entries.move_to_end(key)
+            self._logs += size
+            while len(self._entries) > self._max_entries or self._logs > self._max_logs:
+                (evicted_key, (expires_at, evicted_value, evicted_size)) = self._entries.popitem(last=False)
+                self._logs -= evicted_size
+                self.evictions += 1
+        return value
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self._entries), 'logs': self._logs}
+
+
+class SingleFlight:
+    # concurrent calls with the same key share one computation: the first one runs it, the ones arriving
+    # while it's running wait for its result, or get its exception
+    def __init__(self):
+        self._in_flight = {}  # key -> concurrent.futures.Future of the running computation
+        self._lock = threading.Lock()
+        self.executed = 0
+        self.coalesced = 0
+
+    def do(self, key, compute):
+        with self._lock:
+            running = key in self._in_flight
+            if running:
+                self.coalesced += 1
+            else:
+                self._in_flight[key] = concurrent.futures.Future()
+                self.executed += 1
+            future = self._in_flight[key]
+        if running:
+            return future.result()
+
+        try:
+            value = compute()
+        except BaseException as error:
+            future.set_exception(error)
+            raise
+        else:
+            future.set_result(value)
+            return value
+        finally:
+            # the ones arriving from now on compute it again, a finished result may already be stale
+            with self._lock:
+                del self._in_flight[key]
+
+    def stats(self):
+        with self._lock:
+            return {'executed': self.executed, 'coalesced': self.coalesced, 'in_flight': len(self._in_flight)}
+
+
+class CountIndex:
+    # message counts of complete time buckets per SSB, logspace and search expression, so counting a range
+    # only needs the SSB for the partial buckets at the edges; buckets are only stored once they are
+    # settle_time in the past, as they can't change after that. A range with more unknown buckets than
+    # max_bucket_queries is counted with a single query, and max_bucket_queries of its buckets are counted
+    # in the background, so long ranges are indexed over a few queries. A range of more than max_buckets
+    # buckets (like the default, whole logspace one) couldn't be kept anyway, it's left to the SSB. The least
+    # recently used counts are dropped beyond max_keys and the oldest buckets beyond max_buckets; started,
+    # the index is saved to path every save_interval seconds if it changed.
+    def __init__(self, bucket_size=3600, settle_time=60, max_bucket_queries=24, path=None, clock=time.time,
+                 max_keys=1024, max_buckets=366 * 24, max_workers=8, fill_workers=2, save_interval=60):
+        self._bucket_size = bucket_size
+        self._settle_time = settle_time
+        self._max_bucket_queries = max_bucket_queries
+        self._path = path
+        self._clock = clock
+        self._max_keys = max_keys
+        self._max_buckets = max_buckets
+        self._save_interval = save_interval
+        self._counts = collections.OrderedDict()  # (backend name, logspace, search expression) -> {bucket start: count}
+        self._filling = set()  # (key, bucket start) being counted in the background
+        self._fills = set()  # futures of the background counts
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self._fill_executor = concurrent.futures.ThreadPoolExecutor(max_workers=fill_workers)
+        self._stopped = threading.Event()
+        self._thread = None
+        if path is not None and os.path.exists(path):
+            self._load()
+
+    def number_of_messages(self, backend_name, ssb, logspace, from_timestamp, to_timestamp, search_expression):
+        from_timestamp = int(from_timestamp)
+        to_timestamp = int(to_timestamp)
+        first_bucket = -(-from_timestamp // self._bucket_size) * self._bucket_size
+        settled_until = min(to_timestamp, int(self._clock()) - self._settle_time)
+        buckets_end = settled_until // self._bucket_size * self._bucket_size
+        if buckets_end <= first_bucket or (buckets_end - first_bucket) // self._bucket_size > self._max_buckets:
+            # a range longer than the index can hold (like the whole logspace) is never answered from it
+            return ssb.number_of_messages(logspace, from_timestamp, to_timestamp, search_expression)
 
-    def _fill_up_empty_next_value_slots(self):
-        fetcher_count = 0
-        for fetch_func in self._fetch_functions:
-            if self._next_values[fetcher_count] is None:
-                self._next_values[fetcher_count] = fetch_func()
-            fetcher_count += 1
+        key = (backend_name, logspace, search_expression)
+        with self._lock:
+            bucket_counts = self._counts.get(key, {})
+            if key in self._counts:
+                self._counts.move_to_end(key)
+            known_buckets = sorted(bucket for bucket in bucket_counts if first_bucket <= bucket < buckets_end)
+            count = sum(bucket_counts[bucket] for bucket in known_buckets)
+        missing_buckets = list(itertools.islice(
+            (bucket for (run_start, run_end) in self._missing_runs(known_buckets, first_bucket, buckets_end)
+             for bucket in range(run_start, run_end, self._bucket_size)), self._max_bucket_queries + 1))
 
-    def _return_and_drop_smallest_from_next_values(self):
-        (smallest_key, smallest) = self._find_smallest(self._next_values)
-        self._next_values[smallest_key] = None
-        return smallest
+        def count_range(time_range):
+            return ssb.number_of_messages(logspace, time_range[0], time_range[1], search_expression)
+
+        if len(missing_buckets) > self._max_bucket_queries:
+            self._fill(key, missing_buckets[:self._max_bucket_queries], count_range)
+            return count_range((from_timestamp, to_timestamp))
+
+        edges = [(edge_start, edge_end) for (edge_start, edge_end) in ((from_timestamp, first_bucket),
+                                                                         (buckets_end, to_timestamp))
+                 if edge_start < edge_end]
+        bucket_ranges = [(bucket, bucket + self._bucket_size) for bucket in missing_buckets]
+        counts = list(self._executor.map(count_range, bucket_ranges + edges))
+        if missing_buckets:
+            self._store(key, dict(zip(missing_buckets, counts)))
+        return count + sum(counts)
+
+    def _fill(self, key, buckets, count_range):
+        with self._lock:
+            buckets = [bucket for bucket in buckets if (key, bucket) not in self._filling]
+            self._filling.update((key, bucket) for bucket in buckets)
+
+        def fill(bucket):
+            try:
+                self._store(key, {bucket: count_range((bucket, bucket + self._bucket_size))})
+            except Exception:
+                pass  # it's tried again by the next query of the range
+            finally:
+                with self._lock:
+                    self._filling.discard((key, bucket))
+
+        for bucket in buckets:
+            future = self._fill_executor.submit(fill, bucket)
+            with self._lock:
+                self._fills.add(future)
+            future.add_done_callback(self._fill_done)
+
+    def _fill_done(self, future):
+        with self._lock:
+            self._fills.discard(future)
+
+    def wait_for_fills(self, timeout=None):
+        with self._lock:
+            fills = list(self._fills)
+        concurrent.futures.wait(fills, timeout)
+
+    def _store(self, key, new_bucket_counts):
+        with self._lock:
+            bucket_counts = self._counts.setdefault(key, {})
+            self._counts.move_to_end(key)
+            bucket_counts.update(new_bucket_counts)
+            if len(bucket_counts) > self._max_buckets:
+                for bucket in sorted(bucket_counts)[:len(bucket_counts) - self._max_buckets]:
+                    del bucket_counts[bucket]
+            while len(self._counts) > self._max_keys:
+                self._counts.popitem(last=False)
+            self._dirty = True
+
+    def _missing_runs(self, known_buckets, first_bucket, buckets_end):
+        runs = []
+        run_start = first_bucket
+        for bucket in known_buckets:
+            if bucket > run_start:
+                runs.append((run_start, bucket))
+            run_start = bucket + self._bucket_size
+        if run_start < buckets_end:
+            runs.append((run_start, buckets_end))
+        return runs
+
+    def start(self):
+        self._thread = threading.Thread(target=self._save_periodically, name="count-index-save", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._fill_executor.shutdown(wait=True)
+        self._executor.shutdown(wait=True)
+        self.save()
+
+    def _save_periodically(self):
+        while not self._stopped.wait(self._save_interval):
+            try:
+                self.save()
+            except OSError:
+                cherrypy.log("Saving the count index to %s failed" % self._path, traceback=True)
+
+    def _load(self):
+        with open(self._path, 'r') as index_file:
+            saved_index = json.load(index_file)
+        if saved_index['bucket_size'] != self._bucket_size:
+            return
+        for (backend_name, logspace, search_expression, bucket_counts) in saved_index['counts'][-self._max_keys:]:
+            self._counts[(backend_name, logspace, search_expression)] = \
+                {int(bucket): count for (bucket, count) in bucket_counts.items()}
+
+    def save(self):
+        if self._path is None:
+            return
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                saved_index = {'bucket_size': self._bucket_size,
+                               'counts': [list(key) + [dict(bucket_counts)]
+                                          for (key, bucket_counts) in self._counts.items()]}
+                self._dirty = False
+            # written next to the old one and renamed, so a crash can't leave a half written index behind
+            temporary_path = self._path + '.tmp'
+            with open(temporary_path, 'w') as index_file:
+                json.dump(saved_index, index_file)
+            os.replace(temporary_path, self._path)
+
+
+class LogFollower:
+    # polls an SSB for the logs newer than the last processed_timestamp seen. The logs at exactly that
+    # timestamp are asked again (more of them may arrive in the same second), so the number of them
+    # returned already is remembered and skipped with the offset of the next poll.
+    def __init__(self, ssb, logspace, search_expression=None, backlog=10, page_size=1000):
+        self._ssb = ssb
+        self._logspace = logspace
+        self._search_expression = search_expression
+        self._backlog = backlog
+        self._page_size = page_size
+        self._from_timestamp = 0
+        self._returned_at_from_timestamp = 0
+
+    def start(self):
+        # where the end is, is only known from the count; the logs before the backlog are not downloaded
+        count = self._ssb.number_of_messages(self._logspace, 0, 9999999999, self._search_expression)
+        if count == 0:
+            return []
+        first = max(count - max(self._backlog, 1), 0)
+        logs = self._ssb.filter(self._logspace, 0, 9999999999, self._search_expression,
+                                offset=first, limit=count - first)
+        self._move_boundary(logs)
+        if logs and first > 0 and self._returned_at_from_timestamp == len(logs):
+            # the logs at the last timestamp may start before the backlog, the ones before it are counted
+            self._returned_at_from_timestamp = count - self._ssb.number_of_messages(
+                self._logspace, 0, self._from_timestamp, self._search_expression)
+        return logs[-self._backlog:] if self._backlog > 0 else []
+
+    def poll(self):
+        new_logs = []
+        offset = self._returned_at_from_timestamp
+        while True:
+            page = self._ssb.filter(self._logspace, self._from_timestamp, 9999999999, self._search_expression,
+                                    offset=offset, limit=self._page_size)
+            new_logs.extend(page)
+            if len(page) < self._page_size:
+                break
+            offset += len(page)
+        self._move_boundary(new_logs)
+        return new_logs
+
+    def _move_boundary(self, logs):
+        if not logs:
+            return
+        last_timestamp = logs[-1]['processed_timestamp']
+        if last_timestamp != self._from_timestamp:
+            self._from_timestamp = last_timestamp
+            self._returned_at_from_timestamp = 0
+        for log in reversed(logs):
+            if log['processed_timestamp'] != last_timestamp:
+                break
+            self._returned_at_from_timestamp += 1
+
+
+class MergedLogFollower:
+    # follows the same query on several SSBs, polling them simultaneously; the logs of one poll are
+    # merged by processed_timestamp, but an SSB lagging behind may still deliver older logs in a later poll
+    def __init__(self, followers, fan_out, backlog=10):
+        self._followers = followers
+        self._fan_out = fan_out
+        self._backlog = backlog
+
+    def start(self):
+        logs = self._merge(self._fan_out.map(lambda follower: follower.start(), self._followers))
+        return logs[-self._backlog:] if self._backlog > 0 else []
+
+    def poll(self):
+        return self._merge(self._fan_out.map(lambda follower: follower.poll(), self._followers))
 
     @staticmethod
-    def _find_smallest(list_to_search_in):
-        smallest = None
-        smallest_key = None
-        for i in range(len(list_to_search_in)):
-            current = list_to_search_in[i]
-            if smallest is None or (current is not None and current < smallest):
-                smallest = current
-                smallest_key = i
+    def _merge(lists_of_logs):
+        return list(heapq.merge(*lists_of_logs, key=lambda log: log['processed_timestamp']))
+
+
+def follow_logs(follower, min_interval=FOLLOW_MIN_INTERVAL, max_interval=FOLLOW_MAX_INTERVAL, sleep=time.sleep):
+    for logs in follow_pages(follower, min_interval, max_interval, sleep):
+        for log in logs:
+            yield log
+
+
+def follow_pages(follower, min_interval=FOLLOW_MIN_INTERVAL, max_interval=FOLLOW_MAX_INTERVAL, sleep=time.sleep,
+                 empty_pages=False):
+    # yields the new logs of each poll together. It polls every min_interval seconds while logs are
+    # flowing and doubles the wait after each empty poll, so an idle SSB is asked only every max_interval seconds.
+    # With empty_pages the empty polls are yielded too, so the caller gets the control back regularly.
+    logs = follower.start()
+    if logs:
+        yield logs
+    interval = min_interval
+    while True:
+        logs = follower.poll()
+        if logs or empty_pages:
+            yield logs
+        if logs:
+            interval = min_interval
+        sleep(interval)
+        if not logs:
+            interval = min(interval * 2, max_interval)
+
+
+class QueryPlanner:
+    # remembers which SSBs host which logspaces, and the first processed_timestamp of each of those, so
+    # a query is only sent to the SSBs which can have logs for it. Both are asked again after ttl seconds;
+    # anything not known (an SSB not answering) keeps the SSB in the plan, the pruning can only save requests.
+    # A failed lookup is only tried again after failure_ttl seconds, so a dead SSB doesn't hold up every query.
+    def __init__(self, ttl=300, settle_time=60, clock=time.time, failure_ttl=10):
+        self._ttl = ttl
+        self._failure_ttl = failure_ttl
+        self._settle_time = settle_time
+        self._clock = clock
+        self._logspaces = {}  # backend name -> (expires at, set of logspaces or None if the lookup failed)
+        self._starts = {}  # (backend name, logspace) -> (expires at, no logs before this timestamp or None)
+        self._lock = threading.Lock()
+        self.pruned = 0
+
+    def plan(self, fan_out, ssbs, names, routes, to_timestamp, deadline=None):
+        # routes are (SSB index, logspace on that SSB) pairs; returns the ones which may have logs
+        # before to_timestamp. The lookups are given up after deadline seconds, like the query itself.
+        self._refresh(fan_out, self._logspaces, [ssb_index for (ssb_index, logspace) in routes], names,
+                      lambda ssb_index: names[ssb_index], lambda ssb_index: ssbs[ssb_index].list_logspaces(),
+                      deadline, 'list_logspaces')
+        hosts = [(ssb_index, logspace) for (ssb_index, logspace) in routes if self._hosts(names[ssb_index], logspace)]
+        logspaces = dict(hosts)
+        self._refresh(fan_out, self._starts, [ssb_index for (ssb_index, logspace) in hosts], names,
+                      lambda ssb_index: (names[ssb_index], logspaces[ssb_index]),
+                      lambda ssb_index: self._first_timestamp(ssbs[ssb_index], logspaces[ssb_index]), deadline,
+                      'first_timestamp')
+        plan = [(ssb_index, logspace) for (ssb_index, logspace) in hosts
+                if self._may_have_logs(names[ssb_index], logspace, to_timestamp)]
+        with self._lock:
+            self.pruned += len(routes) - len(plan)
+        return plan
+
+    def learn_logspaces(self, backend_name, logspaces):
+        with self._lock:
+            self._logspaces[backend_name] = (self._clock() + self._ttl, set(logspaces))
+
+    def _refresh(self, fan_out, known, indexes, names, key, ask, deadline, operation):
+        now = self._clock()
+        with self._lock:
+            stale = [index for index in indexes if key(index) not in known or known[key(index)][0] <= now]
+        if not stale:
+            return
+        # with the names, the SSBs whose circuit breaker is open are not even asked
+        (answers, failures) = fan_out.map_partial(ask, stale, [names[index] for index in stale], deadline=deadline,
+                                                  operation=operation)
+        with self._lock:
+            for (position, (index, answer)) in enumerate(zip(stale, answers)):
+                if position in failures:
+                    known[key(index)] = (now + self._failure_ttl, None)
+                else:
+                    known[key(index)] = (now + self._ttl, answer)
+
+    def _first_timestamp(self, ssb_instance, logspace):
+        first_logs = ssb_instance.filter(logspace, 0, 9999999999, offset=0, limit=1)
+        if len(first_logs) > 0:
+            return first_logs[0]['processed_timestamp']
+        # an empty logspace: the logs arriving from now on get a processed_timestamp of about now
+        return self._clock() - self._settle_time
+
+    def _hosts(self, backend_name, logspace):
+        with self._lock:
+            entry = self._logspaces.get(backend_name)
+        return entry is None or entry[1] is None or logspace in entry[1]
+
+    def _may_have_logs(self, backend_name, logspace, to_timestamp):
+        with self._lock:
+            entry = self._starts.get((backend_name, logspace))
+        return entry is None or entry[1] is None or to_timestamp > entry[1]
+
 
-        return smallest_key, smallest
+class RoutingError(Exception):
+    pass
+
+
+class RoutingTable:
+    # tells which SSBs hold a logspace of the proxy, and under what name. Every route of a logspace is
+    # queried; the heavier routes come first, so at equal processed_timestamps their logs are merged first,
+    # and a route of weight 0 is not queried at all (an SSB taken out of a logspace). The logspaces without
+    # routes are asked from every SSB under their own name.
+    def __init__(self, routes):
+        # routes: logspace -> list of (backend name, logspace name on that SSB, weight)
+        self._routes = {}
+        self._aliases = {}  # (backend name, logspace name on that SSB) -> logspace
+        for (logspace, logspace_routes) in routes.items():
+            for (backend_name, ssb_logspace, weight) in logspace_routes:
+                if weight < 0:
+                    raise RoutingError("The route of logspace '%s' to %s has a negative weight" %
+                                       (logspace, backend_name))
+                self._aliases[(backend_name, ssb_logspace)] = logspace
+            self._routes[logspace] = [(backend_name, ssb_logspace)
+                                      for (backend_name, ssb_logspace, weight)
+                                      in sorted(logspace_routes, key=lambda route: -route[2]) if weight > 0]
+
+    def check_backends(self, backend_names):
+        unknown = sorted({backend_name for (backend_name, ssb_logspace) in self._aliases} - set(backend_names))
+        if unknown:
+            raise RoutingError("Logspaces are routed to unknown SSBs: %s" % ', '.join(unknown))
+
+    def route(self, logspace, backend_names):
+        # returns the (SSB index, logspace name on that SSB) pairs to query
+        if logspace not in self._routes:
+            return [(ssb_index, logspace) for ssb_index in range(len(backend_names))]
+        return [(backend_names.index(backend_name), ssb_logspace)
+                for (backend_name, ssb_logspace) in self._routes[logspace]]
+
+    def logspaces(self, backend_name, ssb_logspaces):
+        # the names of the logspaces of an SSB in the proxy
+        return {self._aliases.get((backend_name, ssb_logspace), ssb_logspace) for ssb_logspace in ssb_logspaces}
+
+    def missing(self, backend_name, ssb_logspaces):
+        # the routes pointing to logspaces the SSB doesn't have
+        return ["logspace '%s' is routed to '%s' on %s, which doesn't exist" % (logspace, ssb_logspace, backend_name)
+                for ((route_backend_name, ssb_logspace), logspace) in sorted(self._aliases.items())
+                if route_backend_name == backend_name and ssb_logspace not in ssb_logspaces]
+
+    def routed_backends(self):
+        return {backend_name for (backend_name, ssb_logspace) in self._aliases}
+
+
+class DegradedList(list):
+    # a merged result missing the answers of some backends
+    def __init__(self, iterable, degraded_backends):
+        super().__init__(iterable)
+        self.degraded_backends = degraded_backends
+
+
+class DegradedSet(set):
+    def __init__(self, iterable, degraded_backends):
+        super().__init__(iterable)
+        self.degraded_backends = degraded_backends
+
+
+class DegradedInt(int):
+    def __new__(cls, value, degraded_backends):
+        degraded_int = super().__new__(cls, value)
+        degraded_int.degraded_backends = degraded_backends
+        return degraded_int
+
+
+class TransferStats:
+    # what became of the logs the merges downloaded from the SSBs: returned, skipped for an offset, or
+    # discarded (the rest of the last pages, and the logs left in the merge when the limit was reached)
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.merges = 0
+        self.transferred = 0
+        self.returned = 0
+        self.skipped = 0
+
+    def record(self, transferred, returned, skipped):
+        with self._lock:
+            self.merges += 1
+            self.transferred += transferred
+            self.returned += returned
+            self.skipped += skipped
+
+    def stats(self):
+        with self._lock:
+            return {'merges': self.merges, 'transferred': self.transferred, 'returned': self.returned,
+                    'skipped': self.skipped, 'discarded': self.transferred - self.returned - self.skipped}
+
+
+class Metrics:
+    # timing histograms of the phases of the requests to the SSBs (connect, tls, server, read, decode,
+    # stream) and of the merged queries (first_pages, merge, serialize), with the bytes received from the
+    # SSBs, in the Prometheus text format. The collectors add the counters of the other parts of the proxy.
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}  # (backend name or None, phase, logspace) -> counts and sum, see observe
+        self._bytes = collections.Counter()  # (backend name, logspace) -> bytes
+        self._collectors = []
+
+    def observe(self, phase, seconds, logspace='', backend_name=None):
+        bucket = bisect.bisect_left(self.BUCKETS, seconds)
+        key = (backend_name, phase, logspace)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # a count for each bucket and for +Inf, then the count and the sum of all
+                histogram = self._histograms[key] = [0] * (len(self.BUCKETS) + 2) + [0.0]
+            histogram[bucket] += 1
+            histogram[-2] += 1
+            histogram[-1] += seconds
+
+    def add_bytes(self, number_of_bytes, logspace, backend_name):
+        with self._lock:
+            self._bytes[(backend_name, logspace)] += number_of_bytes
+
+    def add_collector(self, name, stats):
+        # stats returns a dict of numbers, rendered as merge_proxy_<name>_<key>
+        self._collectors.append((name, stats))
+
+    def render(self):
+        with self._lock:
+            histograms = sorted(self._histograms.items(), key=lambda item: tuple(map(str, item[0])))
+            received_bytes = sorted(self._bytes.items())
+        lines = []
+        for (metric, description, backend) in (('merge_proxy_backend_phase_seconds',
+                                                 "Time spent in the phases of the requests to the SSBs", True),
+                                                ('merge_proxy_query_phase_seconds',
+                                                 "Time spent in the phases of the merged queries", False)):
+            lines += ['# HELP %s %s' % (metric, description), '# TYPE %s histogram' % metric]
+            for ((backend_name, phase, logspace), histogram) in histograms:
+                if (backend_name is not None) != backend:
+                    continue
+                labels = [('phase', phase), ('logspace', logspace)]
+                if backend:
+                    labels.insert(0, ('backend', backend_name))
+                cumulative = 0
+                for (bound, count) in zip(self.BUCKETS + ('+Inf', ), histogram):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (metric, _labels(labels + [('le', str(bound))]), cumulative))
+                lines.append('%s_count%s %d' % (metric, _labels(labels), histogram[-2]))
+                lines.append('%s_sum%s %r' % (metric, _labels(labels), histogram[-1]))
+        lines += ['# HELP merge_proxy_backend_received_bytes_total Bytes of response bodies read from the SSBs',
+                  '# TYPE merge_proxy_backend_received_bytes_total counter']
+        for ((backend_name, logspace), number_of_bytes) in received_bytes:
+            lines.append('merge_proxy_backend_received_bytes_total%s %d' %
+                         (_labels([('backend', backend_name), ('logspace', logspace)]), number_of_bytes))
+        for (name, stats) in self._collectors:
+            for (key, value) in sorted(stats().items()):
+                lines.append('merge_proxy_%s_%s %r' % (name, key, value))
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    def escape(value):
+        return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    return '{%s}' % ','.join('%s="%s"' % (name, escape(value)) for (name, value) in labels)
 
 
 class MergeProxy(SSBAPI):
-    # FIXME: the logspace should be the unit here, not the SSB
-    def __init__(self, ssbs):
+    # With a latency_tracker the slow calls are hedged, with a circuit_breaker the failing SSBs are left out
+    # quickly, and with a deadline the SSBs not answering in time are left out of the result, which is then
+    # marked with their names in degraded_backends. A routing table maps the logspaces to (some of) the
+    # SSBs, possibly under other names there. With compact, the merged logs are LogRecords and filter
+    # returns a LogBatch, which take a fraction of the memory of the dicts. With metrics, the downloading
+    # of the first pages and the merging are timed for each logspace. With a single_flight, identical
+    # filter and number_of_messages queries running at the same time share one fan-out to the SSBs. With
+    # raw_json, the merged logs are RawRecords in a LogBatch, kept as the JSON text the SSBs sent, which
+    # MergeProxyServer writes out without encoding them again; the logs are still decoded for the merge, so
+    # this only pays off without orjson, dicts encoded by orjson are faster.
+    def __init__(self, ssbs, max_workers=None, timeout=None, page_size=1000, cache=None, count_index=None,
+                 seek_index=None, latency_tracker=None, circuit_breaker=None, deadline=None, planner=None,
+                 routing=None, compact=False, metrics=None, single_flight=None, raw_json=False):
         self.ssbs = ssbs
+        self._compact = compact
+        self._raw_json = raw_json
+        self.metrics = metrics
+        self._planner = planner
+        self._routing = routing
+        self._seek_index = seek_index
+        self._page_size = page_size
+        self._cache = cache
+        self._single_flight = single_flight
+        self._count_index = count_index
+        self._deadline = deadline
+        self.transfer_stats = TransferStats()
+        self._backend_names = [self._backend_name(ssb_index, ssb_instance)
+                               for (ssb_index, ssb_instance) in enumerate(ssbs)]
+        if routing is not None:
+            routing.check_backends(self._backend_names)
+        if max_workers is None:
+            # the hedged calls and the calls still running after the deadline need workers too
+            max_workers = max(len(ssbs), 1) * (4 if latency_tracker is not None or deadline is not None else 1)
+        self._fan_out = FanOutExecutor(max_workers, timeout, latency_tracker, circuit_breaker)
 
-    # TODO: it could be a nice shortcut to do it simultaneously for all SSBs
     def login(self, username, password):
-        raise NotImplementedError
+        self._fan_out.map(lambda ssb_instance: ssb_instance.login(username, password), self.ssbs)
+
+    def refresh_session(self):
+        self._fan_out.map(lambda ssb_instance: ssb_instance.refresh_session(), self.ssbs)
 
-    # TODO: it could be a nice shortcut to do it simultaneously for all SSBs
     def logout(self):
-        raise NotImplementedError
+        self._fan_out.map(lambda ssb_instance: ssb_instance.logout(), self.ssbs)
 
     def list_logspaces(self):
-        # FIXME: this is not parallel!!! it HAS to be unless it will be very-very slow
         logspaces = set()
-        for ssb_instance in self.ssbs:
-            logspaces |= ssb_instance.list_logspaces()
-        return logspaces
+        all_ssbs = range(len(self.ssbs))
+        (results, degraded_backends) = self._map_ssbs(lambda ssb_instance: ssb_instance.list_logspaces(), self.ssbs,
+                                                      all_ssbs, 'list_logspaces')
+        for (ssb_index, ssb_logspaces) in zip(all_ssbs, results):
+            if ssb_logspaces is not None:
+                self._learn_logspaces(ssb_index, ssb_logspaces)
+                if self._routing is not None:
+                    ssb_logspaces = self._routing.logspaces(self._backend_names[ssb_index], ssb_logspaces)
+                logspaces |= ssb_logspaces
+        return DegradedSet(logspaces, degraded_backends) if degraded_backends else logspaces
+
+    def validate_routing(self):
+        # asks all the SSBs at once for their logspaces, and raises RoutingError if a route leads nowhere; an
+        # SSB not answering (down, or failing to log in) proves nothing, its routes are checked by the queries
+        if self._routing is None:
+            return
+        routed_backends = self._routing.routed_backends()
+        (results, failures) = self._fan_out.map_partial(lambda ssb_instance: ssb_instance.list_logspaces(),
+                                                        self.ssbs, self._backend_names, operation='list_logspaces')
+        problems = []
+        for (ssb_index, ssb_logspaces) in enumerate(results):
+            backend_name = self._backend_names[ssb_index]
+            if ssb_logspaces is not None:
+                self._learn_logspaces(ssb_index, ssb_logspaces)
+                problems.extend(self._routing.missing(backend_name, ssb_logspaces))
+            elif backend_name in routed_backends:
+                cherrypy.log("The logspaces of SSB %s could not be listed, its routes are not checked: %s" %
+                             (backend_name, failures[ssb_index]))
+        if problems:
+            raise RoutingError("Invalid routing: %s" % '; '.join(problems))
+
+    def _learn_logspaces(self, ssb_index, ssb_logspaces):
+        if self._planner is not None:
+            self._planner.learn_logspaces(self._backend_names[ssb_index], ssb_logspaces)
+
+    def _map_ssbs(self, func, backends, ssb_indexes, operation, discard=None):
+        # backends has an element for each SSB of ssb_indexes, in the same order; returns the results
+        # (None for the SSBs left out) and the names of the SSBs left out
+        names = [self._backend_names[ssb_index] for ssb_index in ssb_indexes]
+        if self._deadline is None:
+            return self._fan_out.map(func, backends, names, hedge=True, discard=discard, operation=operation), []
+        (results, failures) = self._fan_out.map_partial(func, backends, names, hedge=True, discard=discard,
+                                                        deadline=self._deadline, operation=operation)
+        if len(failures) == len(backends):
+            # there's nothing to return a part of
+            raise failures[min(failures)]
+        return results, [names[index] for index in sorted(failures)]
+
+    def _plan(self, logspace, to_timestamp):
+        # the (SSB index, logspace name on that SSB) pairs to send the query to
+        routes = self._routes(logspace)
+        if self._planner is None:
+            return routes
+        return self._planner.plan(self._fan_out, self.ssbs, self._backend_names, routes, int(to_timestamp),
+                                  self._deadline)
+
+    def _routes(self, logspace):
+        if self._routing is None:
+            return [(ssb_index, logspace) for ssb_index in range(len(self.ssbs))]
+        return self._routing.route(logspace, self._backend_names)
+
+    def query_etag(self, command, logspace, parameters):
+        # a weak ETag, the same for the same query sent to the same logspaces of the same SSBs; it's only
+        # worth anything for a query whose result can't change any more
+        routes = [(self._backend_names[ssb_index], ssb_logspace)
+                  for (ssb_index, ssb_logspace) in self._routes(logspace)]
+        query = repr((command, logspace, sorted(parameters.items()), routes))
+        return 'W/"%s"' % hashlib.sha1(query.encode('utf-8')).hexdigest()
+
+    def _cached(self, command, logspace, from_timestamp, to_timestamp, search_expression, offset, limit, compute):
+        # the parameters may arrive as strings from the HTTP API, those should hit the same entry
+        key = (command, logspace, int(from_timestamp), int(to_timestamp), search_expression, offset, limit)
+        if self._single_flight is not None:
+            # the cache misses of identical queries arriving together are merged only once
+            merge = compute
+            compute = lambda: self._single_flight.do(key, merge)
+        if self._cache is None:
+            return compute()
+        return self._cache.get_or_compute(key, int(to_timestamp), compute)
 
     def number_of_messages(self, logspace, from_timestamp=0, to_timestamp=9999999999, search_expression=None):
-        # FIXME: this is not parallel!!! it HAS to be unless it will be very-very slow
-        # FIXME: logspace has to be the same, it could easily be separate...
-        merged_number = 0
-        for ssb_instance in self.ssbs:
-            merged_number += ssb_instance.number_of_messages(logspace, from_timestamp, to_timestamp, search_expression)
-        return merged_number
+        return self._cached("number_of_messages", logspace, from_timestamp, to_timestamp, search_expression,
+                            None, None,
+                            lambda: self._merged_number_of_messages(logspace, from_timestamp, to_timestamp,
+                                                                    search_expression))
+
+    def _merged_number_of_messages(self, logspace, from_timestamp, to_timestamp, search_expression):
+        def count(route):
+            (ssb_index, ssb_logspace) = route
+            ssb_instance = self.ssbs[ssb_index]
+            if self._count_index is None:
+                return ssb_instance.number_of_messages(ssb_logspace, from_timestamp, to_timestamp, search_expression)
+            return self._count_index.number_of_messages(self._backend_names[ssb_index], ssb_instance,
+                                                        ssb_logspace, from_timestamp, to_timestamp, search_expression)
+
+        routes = self._plan(logspace, to_timestamp)
+        if not routes:
+            return 0
+        (counts, degraded_backends) = self._map_ssbs(count, routes, [ssb_index for (ssb_index, ssb_logspace) in routes],
+                                                     'number_of_messages')
+        total = sum(count for count in counts if count is not None)
+        return DegradedInt(total, degraded_backends) if degraded_backends else total
+
+    @staticmethod
+    def _backend_name(ssb_index, ssb_instance):
+        # the address identifies an SSB across restarts, the position in the list is only a fallback
+        return getattr(ssb_instance, 'address', str(ssb_index))
 
     def filter(self, logspace, from_timestamp=0, to_timestamp=9999999999, search_expression=None, offset=0, limit=10):
-        # FIXME: this is not parallel!!! it HAS to be unless it will be very-very slow
-        if (offset > 0):
-            raise NotImplementedError  # TODO: this would really be needed but that needs the k-way merge
+        offset = int(offset)
+        limit = int(limit)
+        if limit <= 0:
+            return []
+
+        logs = self._cached("filter", logspace, from_timestamp, to_timestamp, search_expression, offset, limit,
+                            lambda: self._merged_filter(logspace, from_timestamp, to_timestamp, search_expression,
+                                                        offset, limit))
+        if getattr(logs, 'degraded_backends', None):
+            return logs  # never cached
+        # a copy, so the caller can't change the cached list
+        return logs[:]
+
+    def follower(self, logspace, search_expression=None, backlog=10, page_size=1000):
+        followers = [LogFollower(self.ssbs[ssb_index], ssb_logspace, search_expression, backlog, page_size)
+                     for (ssb_index, ssb_logspace) in self._plan(logspace, 9999999999)]
+        return MergedLogFollower(followers, self._fan_out, backlog)
+
+    def _merged_filter(self, logspace, from_timestamp, to_timestamp, search_expression, offset, limit):
+        degraded_backends = []
+        logs = self._iter_merged(logspace, from_timestamp, to_timestamp, search_expression, offset, limit,
+                                 degraded_backends)
+        if self._compact or self._raw_json:
+            batch = LogBatch(logs)
+            batch.degraded_backends = degraded_backends
+            return batch
+        logs = list(logs)
+        return DegradedList(logs, degraded_backends) if degraded_backends else logs
+
+    def iter_filter(self, logspace, from_timestamp=0, to_timestamp=9999999999, search_expression=None, offset=0, limit=10,
+                    degraded_backends=None):
+        # the merged logs come out while the SSBs are still paged through, never more than a page per SSB
+        # is held in memory; the results are not cached. The names of the SSBs left out are added to
+        # degraded_backends while the logs are iterated.
+        if degraded_backends is None:
+            degraded_backends = []
+        return self._iter_merged(logspace, from_timestamp, to_timestamp, search_expression, offset, limit,
+                                 degraded_backends)
+
+    def _iter_merged(self, logspace, from_timestamp, to_timestamp, search_expression, offset, limit,
+                     degraded_backends):
+        offset = int(offset)
+        limit = int(limit)
+        if limit <= 0:
+            return
+        query = (logspace, int(from_timestamp), int(to_timestamp), search_expression)
+        (seek_from_timestamp, to_skip) = (None, offset)
+        if self._seek_index is not None:
+            (seek_from_timestamp, to_skip) = self._seek_index.seek(query, offset)
+        if seek_from_timestamp is None:
+            seek_from_timestamp = from_timestamp
+
+        needed = to_skip + limit
+        page_size = min(self._page_size, needed)
+        routes = self._plan(logspace, to_timestamp)
+        if not routes:
+            return
+        ssb_indexes = [ssb_index for (ssb_index, ssb_logspace) in routes]
+        merger = None
+
+        def wanted():
+            # a cursor is never asked for more logs than the merge still has to take
+            return needed - (merger.taken_count if merger is not None else 0)
+
+        # with the logs spread evenly, each SSB gives its share of the needed logs; a cursor running out of
+        # its first page asks for twice as many
+        first_page_size = max(-(-needed // len(routes)), MIN_FIRST_PAGE_SIZE)
+        # the pages of a query share a single deadline, counted from its first pages
+        query_deadline = None if self._deadline is None else time.monotonic() + self._deadline
+        cursors = [SSBCursor(self.ssbs[ssb_index], ssb_logspace, seek_from_timestamp, to_timestamp, search_expression,
+                             page_size, first_page_size=first_page_size, wanted=wanted, raw=self._raw_json,
+                             request=self._page_requester(self._backend_names[ssb_index], query_deadline))
+                   for (ssb_index, ssb_logspace) in routes]
+        # the first pages are downloaded simultaneously, the rest only when a cursor runs dry during the merge
+        first_pages_started = time.perf_counter()
+        (pages, left_out) = self._map_ssbs(lambda cursor: cursor.request_page(), cursors, ssb_indexes, 'filter',
+                                           discard=SSBCursor.close_page)
+        if self.metrics is not None:
+            self.metrics.observe('first_pages', time.perf_counter() - first_pages_started, logspace)
+        degraded_backends.extend(left_out)
+        (skipped_count, taken) = (0, 0)
+        merge_stopwatch = None
+        try:
+            fetch_functions = []
+            for (ssb_index, cursor, page) in zip(ssb_indexes, cursors, pages):
+                if page is not None:
+                    cursor.use_page(page)
+                    fetch_functions.append(self._fetch_function(cursor, self._backend_names[ssb_index],
+                                                                degraded_backends))
+            merger = KWayMerger(fetch_functions, key=lambda log: log['processed_timestamp'])
+            take = merger.take
+            if self.metrics is not None:
+                # the pages fetched by the cursors running dry during the merge are timed here too
+                merge_stopwatch = Stopwatch()
+                take = merge_stopwatch.timed(take)
+
+            # skipping in page sized batches, so a deep offset never piles up in memory
+            while to_skip > 0:
+                skipped = take(min(to_skip, page_size))
+                if len(skipped) == 0:
+                    return
+                self._record_checkpoint(query, offset - to_skip, skipped, degraded_backends)
+                to_skip -= len(skipped)
+                skipped_count += len(skipped)
+
+            # taking page sized batches here too, each of them goes out before the next is merged
+            while taken < limit:
+                logs = take(min(limit - taken, page_size))
+                if len(logs) == 0:
+                    return
+                self._record_checkpoint(query, offset + taken, logs, degraded_backends)
+                taken += len(logs)
+                for log in logs:
+                    yield log
+        finally:
+            for cursor in cursors:
+                cursor.close()
+            self.transfer_stats.record(sum(cursor.transferred for cursor in cursors), taken, skipped_count)
+            if merge_stopwatch is not None:
+                self.metrics.observe('merge', merge_stopwatch.seconds, logspace)
+
+    def _page_requester(self, backend_name, query_deadline):
+        # the pages after the first one get what's left of the deadline of the query (query_deadline is a
+        # time.monotonic time), the SSB is then left out of the rest of the result by the fetch function
+        if query_deadline is None:
+            return None
+
+        def request_page(cursor):
+            time_left = query_deadline - time.monotonic()
+            if time_left <= 0:
+                raise concurrent.futures.TimeoutError("backend %s: the deadline of the query has passed" %
+                                                      backend_name)
+            (pages, failures) = self._fan_out.map_partial(lambda cursor: cursor.request_page(), [cursor],
+                                                          [backend_name], hedge=True, discard=SSBCursor.close_page,
+                                                          deadline=time_left, operation='filter')
+            if failures:
+                raise failures[0]
+            return pages[0]
+
+        return request_page
+
+    def _fetch_function(self, cursor, backend_name, degraded_backends):
+        fetch = cursor.next
+        if self._raw_json:
+            def fetch_raw_record():
+                # only the SSBs which can't stream send dicts, those are encoded here
+                log = cursor.next()
+                return log if log is None or isinstance(log, RawRecord) else RawRecord.from_dict(log)
 
-        logs = []
-        for ssb_instance in self.ssbs:
-            logs += ssb_instance.filter(logspace, from_timestamp, to_timestamp, search_expression,
-                                        offset=0, limit=limit)
+            fetch = fetch_raw_record
+        elif self._compact:
+            def fetch_record():
+                # the dict parsed from the SSB response is dropped as soon as its log enters the merge
+                log = cursor.next()
+                return None if log is None else LogRecord.from_dict(log)
 
-        logs = sorted(logs, key=lambda log: log['processed_timestamp'])
-        logs = logs[:int(limit)]
-        return(logs)
+            fetch = fetch_record
+        if self._deadline is None:
+            return fetch
+
+        def fetch_or_leave_out():
+            # a page failing later in the merge leaves the SSB out of the rest of the result
+            try:
+                return fetch()
+            except Exception:
+                degraded_backends.append(backend_name)
+                return None
+
+        return fetch_or_leave_out
+
+    def _record_checkpoint(self, query, offset, logs, degraded_backends):
+        # the offsets of a result with an SSB missing are not the offsets of the query
+        if self._seek_index is not None and not degraded_backends:
+            self._seek_index.record(query, offset, logs)
+
+
+def _timed_json_handler(*args, **kwargs):
+    # the json_out handler of cherrypy, encoding with the RecordEncoder of the server and timing it; args are
+    # the ones of the page handler
+    value = cherrypy.serving.request._json_inner_handler(*args, **kwargs)
+    root = cherrypy.serving.request.app.root
+    metrics = getattr(root, 'metrics', None)
+    encoder = getattr(root, 'encoder', None) or RecordEncoder()
+    if metrics is None:
+        return encoder.encode(value)
+    started = time.perf_counter()
+    body = encoder.encode(value)
+    metrics.observe('serialize', time.perf_counter() - started, args[0] if args else '')
+    return body
+
+
+def _compress_response(min_size=1024):
+    # compresses the response body with the best coding the client accepts; a streamed body is compressed
+    # chunk by chunk, each of them flushed, so the logs don't wait in the compressor
+    request = cherrypy.serving.request
+    response = cherrypy.serving.response
+    if not response.body or 'Content-Encoding' in response.headers:
+        return
+    vary = response.headers.get('Vary')
+    response.headers['Vary'] = 'Accept-Encoding' if not vary else vary + ', Accept-Encoding'
+    encoding = content_encoding.choose_encoding(request.headers.get('Accept-Encoding'))
+    if encoding is None:
+        return
+    if response.stream:
+        response.body = _compressed_chunks(encoding, response.body)
+    else:
+        body = b''.join(response.body)
+        if len(body) < min_size:
+            return  # not worth it
+        response.body = content_encoding.compress(encoding, body)
+    response.headers['Content-Encoding'] = encoding
+    response.headers.pop('Content-Length', None)
+
+
+def _compressed_chunks(encoding, chunks):
+    compressor = content_encoding.Compressor(encoding)
+    for chunk in chunks:
+        yield compressor.compress(chunk) + compressor.flush()
+    yield compressor.finish()
+
+
+cherrypy.tools.compress_response = cherrypy.Tool('before_finalize', _compress_response, priority=80)
 
 
 class MergeProxyServer:
     # FIXME: all the results should be wrapped into the required base structure
-    def __init__(self, merge_proxy: MergeProxy):
+    # With fast_json, the responses are encoded with orjson if it's installed. The responses are compressed
+    # for the clients accepting that. The filter and number_of_messages results of the ranges ending
+    # settle_time before now can't change any more, those have ETags, and a client sending one in
+    # If-None-Match gets a 304 without a query. A stream isn't tagged, an SSB may fail after its first logs.
+    # A followed stream holds a server thread as long as its client stays, so with max_follows the ones over
+    # it get a 503; server.thread_pool has to be larger than max_follows, or the follows starve the rest.
+    _cp_config = {'tools.compress_response.on': True}
+
+    def __init__(self, merge_proxy: MergeProxy, fast_json=False, settle_time=60, clock=time.time, max_follows=None):
         self.merge_proxy = merge_proxy
+        self.metrics = getattr(merge_proxy, 'metrics', None)
+        self.encoder = RecordEncoder(fast=fast_json)
+        self._settle_time = settle_time
+        self._clock = clock
+        self._follow_slots = None if max_follows is None else threading.BoundedSemaphore(max_follows)
 
     @cherrypy.expose
-    @cherrypy.tools.json_out()
+    @cherrypy.tools.json_out(handler=_timed_json_handler)
     def list_logspaces(self):
         return self._json_safe_object(self.merge_proxy.list_logspaces())
 
     @cherrypy.expose
-    @cherrypy.tools.json_out()
+    @cherrypy.tools.json_out(handler=_timed_json_handler)
     def filter(self, logspace, **kwargs):
+        self._check_etag("filter", logspace, kwargs)
         result = self.merge_proxy.filter(logspace, **kwargs)
         return self._json_safe_object(result)
 
     @cherrypy.expose
-    @cherrypy.tools.json_out()
+    @cherrypy.tools.json_out(handler=_timed_json_handler)
     def number_of_messages(self, logspace, **kwargs):
+        self._check_etag("number_of_messages", logspace, kwargs)
         result = self.merge_proxy.number_of_messages(logspace, **kwargs)
         return self._json_safe_object(result)
 
+    def _check_etag(self, command, logspace, kwargs):
+        # the parameters come from the query string, to_timestamp may be missing or not even a number
+        try:
+            to_timestamp = int(kwargs['to_timestamp'])
+        except (KeyError, ValueError):
+            return
+        if to_timestamp > self._clock() - self._settle_time:
+            return
+        etag = self.merge_proxy.query_etag(command, logspace, kwargs)
+        cherrypy.response.headers['ETag'] = etag
+        if _etag_matches(cherrypy.request.headers.get('If-None-Match'), etag):
+            raise cherrypy.HTTPRedirect([], 304)
+
+    @cherrypy.expose
+    def filter_stream(self, logspace, format='ndjson', **kwargs):
+        degraded_backends = []
+        logs = self.merge_proxy.iter_filter(logspace, degraded_backends=degraded_backends, **kwargs)
+        return self._stream(format, self._chunks(logs), logspace, degraded_backends)
+    filter_stream._cp_config = {'response.stream': True}
+
+    @cherrypy.expose
+    def follow_stream(self, logspace, search_expression=None, backlog=10, format='sse'):
+        # the empty polls send a keep-alive, so a client which went away is noticed and its polling stops
+        if self._follow_slots is None:
+            follower = self.merge_proxy.follower(logspace, search_expression, int(backlog))
+            return self._stream(format, follow_pages(follower, empty_pages=True), logspace)
+        if not self._follow_slots.acquire(blocking=False):
+            cherrypy.response.headers['Retry-After'] = str(int(FOLLOW_MAX_INTERVAL))
+            raise cherrypy.HTTPError(503, "Too many followed streams, try again later")
+        try:
+            follower = self.merge_proxy.follower(logspace, search_expression, int(backlog))
+            stream = self._stream(format, follow_pages(follower, empty_pages=True), logspace)
+        except BaseException:
+            self._follow_slots.release()
+            raise
+        return _ReleasingIterator(stream, self._follow_slots.release)
+    follow_stream._cp_config = {'response.stream': True}
+
+    @staticmethod
+    def _chunks(logs):
+        chunk = []
+        for log in logs:
+            chunk.append(log)
+            if len(chunk) == STREAM_CHUNK_SIZE:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def _stream(self, format, chunks, logspace, degraded_backends=()):
+        # the SSBs left out of the result (degraded_backends, filled while the chunks are made) are named
+        # in the last record, like a failure
+        if format not in _STREAM_FORMATS:
+            raise cherrypy.HTTPError(400, "Unknown format '%s', it should be one of %s" %
+                                     (format, ', '.join(_STREAM_FORMATS)))
+        (content_type, encode_chunk, encode_error, encode_degraded) = _STREAM_FORMATS[format]
+        cherrypy.response.headers['Content-Type'] = content_type
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+        encode_chunk = functools.partial(encode_chunk, self.encoder.encode)
+
+        stopwatch = None
+        if self.metrics is not None:
+            stopwatch = Stopwatch()
+            encode_chunk = stopwatch.timed(encode_chunk)
+
+        def generate():
+            # the status line is out by the time an SSB fails, so the error can only be the last record
+            try:
+                for chunk in chunks:
+                    yield encode_chunk(chunk)
+                if degraded_backends:
+                    yield encode_degraded(sorted(set(degraded_backends))).encode()
+            except Exception as error:
+                cherrypy.log("Streaming failed", traceback=True)
+                yield encode_error(str(error)).encode()
+            finally:
+                if stopwatch is not None:
+                    self.metrics.observe('serialize', stopwatch.seconds, logspace)
+
+        return generate()
+
     def _json_safe_object(self, object_to_convert):
-        if type(object_to_convert) == type(set()):
+        degraded_backends = getattr(object_to_convert, 'degraded_backends', None)
+        if degraded_backends:
+            cherrypy.response.headers['X-Degraded-Backends'] = ', '.join(degraded_backends)
+            # the next query may get the whole result
+            cherrypy.response.headers.pop('ETag', None)
+        if isinstance(object_to_convert, set):
             object_to_convert = list(object_to_convert)
+        elif isinstance(object_to_convert, LogBatch):
+            # the records themselves are left to the encoder, RawRecords are spliced in as they are
+            object_to_convert = object_to_convert.records
         return object_to_convert
 
 
+class _ReleasingIterator:
+    # the items of iterator, then release is called once: at the end, on an error, or when it's closed or
+    # dropped, even before its first item (unlike the finally of a generator which never started)
+    def __init__(self, iterator, release):
+        self._iterator = iterator
+        self._release = release
+        self._released = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._iterator)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        if self._released:
+            return
+        self._released = True
+        try:
+            self._iterator.close()
+        finally:
+            self._release()
+
+    def __del__(self):
+        self.close()
+
+
+def _etag_matches(if_none_match, etag):
+    # the weak comparison of If-None-Match
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or _weak(etag) in [_weak(tag) for tag in tags]
+
+
+def _weak(etag):
+    return etag[2:] if etag.startswith('W/') else etag
+
+
+def _ndjson_chunk(encode, logs):
+    # an empty chunk (an idle poll) is a blank line, which NDJSON readers skip
+    return b''.join(encode(log) + b'\n' for log in logs) if logs else b'\n'
+
+
+def _sse_chunk(encode, logs):
+    if not logs:
+        return b': keep-alive\n\n'
+    return b''.join(b'data: ' + encode(log) + b'\n\n' for log in logs)
+
+
+_STREAM_FORMATS = {
+    'ndjson': ('application/x-ndjson', _ndjson_chunk, lambda message: json.dumps({'error': message}) + '\n',
+               lambda backends: json.dumps({'degraded_backends': backends}) + '\n'),
+    'sse': ('text/event-stream', _sse_chunk, lambda message: 'event: error\ndata: %s\n\n' % json.dumps(message),
+            lambda backends: 'event: degraded\ndata: %s\n\n' % json.dumps(backends)),
+}
+
+
+class MetricsServer:
+    def __init__(self, metrics):
+        self._metrics = metrics
+
+    @cherrypy.expose
+    def index(self):
+        cherrypy.response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+        return self._metrics.render()
+
+
 class MergeProxyConfig():
+    # the sections are the SSBs, except the [logspace:NAME] ones, which route a logspace of the proxy:
+    #   [logspace:center]
+    #   10.10.0.1 = center
+    #   example.foo.bar = center_eu, 2
+    # with the name of the logspace on that SSB (the same by default) and the weight of the route (1 by default)
+    LOGSPACE_SECTION_PREFIX = 'logspace:'
+
     def __init__(self, config_text):
         self._config = configparser.ConfigParser()
+        self._config.optionxform = str  # the SSB addresses are the keys of the routes
         self._config.read_string(config_text)
 
     def get_servers(self):
         servers = []
-        for server_name in self._config.sections():
-            user = self._config[server_name]['user']
-            password = self._config[server_name]['password']
+        for server_name in self._server_sections():
+            user = self._option(server_name, 'user')
+            password = self._option(server_name, 'password')
             servers.append({'address': server_name, 'user': user, 'password': password})
         return servers
 
+    def _option(self, section_name, option_name):
+        # optionxform keeps the case of the keys for the routes, the options of the SSBs are case-insensitive
+        for (name, value) in self._config[section_name].items():
+            if name.lower() == option_name:
+                return value
+        raise KeyError(option_name)
+
+    def get_routing(self):
+        # None when no logspace is routed
+        server_names = self._server_sections()
+        routes = {}
+        for section_name in self._config.sections():
+            if not section_name.startswith(self.LOGSPACE_SECTION_PREFIX):
+                continue
+            logspace = section_name[len(self.LOGSPACE_SECTION_PREFIX):]
+            routes[logspace] = []
+            for (server_name, route) in self._config[section_name].items():
+                if server_name not in server_names:
+                    raise RoutingError("Logspace '%s' is routed to %s, which is not configured" %
+                                       (logspace, server_name))
+                routes[logspace].append((server_name,) + self._parse_route(logspace, route))
+        return RoutingTable(routes) if routes else None
+
+    def _server_sections(self):
+        return [section_name for section_name in self._config.sections()
+                if not section_name.startswith(self.LOGSPACE_SECTION_PREFIX)]
+
+    @staticmethod
+    def _parse_route(logspace, route):
+        (ssb_logspace, separator, weight) = (part.strip() for part in route.partition(','))
+        try:
+            weight = int(weight) if separator else 1
+        except ValueError:
+            raise RoutingError("The weight of a route of logspace '%s' is not a number: %s" % (logspace, weight))
+        return ssb_logspace or logspace, weight
+
 
 def print_logs(list_of_logs):
-    for log in list_of_logs:
-        pretty_date = datetime.datetime.fromtimestamp(log['processed_timestamp']).strftime('%Y-%m-%d %H:%M:%S')
-        print("%s %s %s: %s" % (pretty_date, log['host'], log['program'], log['message']))
+    SyslogFormatter(timestamp_field='processed_timestamp').write_page(list_of_logs, sys.stdout)
 
 if __name__ == '__main__':
     with open('merge_proxy.ini', 'r') as configfile:
         config_text = '\n'.join(configfile.readlines())
     config = MergeProxyConfig(config_text)
-    servers = []
-    for server_params in config.get_servers():
-        ssb = SSB(server_params['address'])
-        ssb.login(server_params['user'], server_params['password'])
-        servers.append(ssb)
-    servers = tuple(servers)
+    servers_params = config.get_servers()
+    metrics = Metrics() if METRICS_ENABLED else None
+    servers = tuple(SSB(server_params['address'], timeout=BACKEND_TIMEOUT, metrics=metrics)
+                    for server_params in servers_params)
+    circuit_breaker = CircuitBreaker()
+    sessions = SessionManager(servers, timeout=BACKEND_TIMEOUT, circuit_breaker=circuit_breaker)
+    sessions.login_all([(server_params['user'], server_params['password']) for server_params in servers_params])
+    sessions.start()
 
-    merge_proxy = MergeProxy(servers)
-    server = MergeProxyServer(merge_proxy)
+    cache = ResultCache()
+    single_flight = SingleFlight()
+    count_index = CountIndex(path=COUNT_INDEX_PATH)
+    count_index.start()
+    merge_proxy = MergeProxy(servers, timeout=BACKEND_TIMEOUT, cache=cache,
+                             count_index=count_index, seek_index=SeekIndex(),
+                             latency_tracker=LatencyTracker(), circuit_breaker=circuit_breaker,
+                             deadline=BACKEND_DEADLINE, planner=QueryPlanner(), routing=config.get_routing(),
+                             metrics=metrics, single_flight=single_flight)
+    try:
+        merge_proxy.validate_routing()
+    except RoutingError:
+        sessions.stop()
+        sessions.logout_all()
+        count_index.stop()
+        raise
+    server = MergeProxyServer(merge_proxy, fast_json=True, max_follows=MAX_FOLLOWS)
 
     cherrypy.tree.mount(
         server, '/api/1/search/logspace'
     )
+    if metrics is not None:
+        metrics.add_collector('cache', cache.stats)
+        metrics.add_collector('single_flight', single_flight.stats)
+        metrics.add_collector('transfer', merge_proxy.transfer_stats.stats)
+        cherrypy.tree.mount(MetricsServer(metrics), '/metrics')
+    cherrypy.server.thread_pool = SERVER_THREAD_POOL
     cherrypy.server.ssl_module = 'builtin'
     cherrypy.server.ssl_certificate = "merge_proxy.pem"
     cherrypy.server.ssl_private_key = "merge_proxy.pem"
+    cherrypy.engine.subscribe('stop', sessions.stop)
+    cherrypy.engine.subscribe('stop', count_index.stop)
+    cherrypy.engine.subscribe('stop', sessions.logout_all, priority=60)
     cherrypy.engine.start()
     cherrypy.engine.block()
 
@@ -2,7 +2,16 @@ __author__ = 'gyp'
 
 import unittest
 import urllib.parse, json
+import threading, time
+import os, tempfile
+import concurrent.futures
+import gzip, zlib
+import itertools
+import cherrypy
+import content_encoding
+import merge_proxy
 from merge_proxy import *
+from fake_ssb import FakeSSB, SyntheticLogspace
 
 class SSBAPITests(unittest.TestCase):
     USERNAME = "foo"
@@ -114,6 +123,33 @@ class SSBAPITests(unittest.TestCase):
             response_value=return_value
         )
 
+    def test_iter_filter_proxies_filter_and_yields_the_logs(self):
+        LOGS = [{"processed_timestamp": i, "message": "message %d" % i} for i in range(100)]
+        (connection, api) = self._get_connection_api_pair()
+        connection.set_responses([self._generate_successful_response(LOGS)])
+
+        logs = api.iter_filter(self.LOGSPACE_NAME, 123, 456, offset=10, limit=100)
+
+        (method, url, body, headers) = connection.get_requests()[0]
+        self._assertURLEqual("/api/1/search/logspace/filter/%s?from=123&to=456&offset=10&limit=100" %
+                             self.LOGSPACE_NAME, url)
+        self.assertListEqual(LOGS, list(logs))
+
+    def test_deep_filter_seeks_with_from_after_a_checkpoint_was_recorded(self):
+        LOGS = [{"processed_timestamp": 1000 + i // 3} for i in range(30)]
+        connection = MockHTTPConnection()
+        api = SSBAPI(connection, SeekIndex())
+        connection.set_responses([self._generate_successful_response(LOGS),
+                                  self._generate_successful_response([])])
+
+        api.filter(self.LOGSPACE_NAME, 500, 5000, offset=100, limit=30)
+        api.filter(self.LOGSPACE_NAME, 500, 5000, offset=200, limit=30)
+
+        # the last timestamp change in the first page was at offset 127, to 1009
+        (method, url, body, headers) = connection.get_requests()[1]
+        self._assertURLEqual("/api/1/search/logspace/filter/%s?from=1009&to=5000&offset=73&limit=30" %
+                             self.LOGSPACE_NAME, url)
+
     def test_number_of_messages_proxies_number_of_messages(self):
         self._test_filter_type_command("number_of_messages", "number_of_messages", 999, False)
 
@@ -144,6 +180,110 @@ class SSBAPITests(unittest.TestCase):
             self.assertEqual("AUTHENTICATION_TOKEN=%s" % AUTH_TOKEN, headers['Cookie'])
 
 
+    def test_compressed_responses_are_asked_for_and_decompressed(self):
+        (connection, api) = self._get_connection_api_pair()
+        body = json.dumps({"result": [{"processed_timestamp": i} for i in range(3)]}).encode()
+        connection.set_responses([None, (200, content_encoding.compress('gzip', body), {'Content-Encoding': 'gzip'}),
+                                  (200, content_encoding.compress('deflate', body), {'Content-Encoding': 'deflate'})])
+        api.login(self.USERNAME, self.PASSWORD)
+
+        self.assertEqual([{"processed_timestamp": i} for i in range(3)], api.filter(self.LOGSPACE_NAME))
+        self.assertEqual([{"processed_timestamp": i} for i in range(3)], list(api.iter_filter(self.LOGSPACE_NAME)))
+        for (method, url, body, headers) in connection.get_requests()[1:]:
+            self.assertEqual(content_encoding.accept_encoding(), headers['Accept-Encoding'])
+
+    def test_failed_login_raises_authentication_error(self):
+        for response in ((401, '{"error": {"message": "bad password"}}'), '{"result": null}', "<html>"):
+            (connection, api) = self._get_connection_api_pair()
+            connection.set_responses([response])
+
+            with self.assertRaises(AuthenticationError):
+                api.login(self.USERNAME, self.PASSWORD)
+
+    def test_failed_login_is_tried_again_by_the_next_request(self):
+        (connection, api) = self._get_connection_api_pair()
+        connection.set_responses([(500, ""), self._generate_successful_response("token"),
+                                  self._generate_successful_response(["logspace1"])])
+
+        with self.assertRaises(AuthenticationError):
+            api.login(self.USERNAME, self.PASSWORD)
+
+        self.assertEqual({"logspace1"}, api.list_logspaces())
+        requests = connection.get_requests()
+        self.assertListEqual(["/api/1/login", "/api/1/login", "/api/1/search/logspace/list_logspaces"],
+                             [url for (method, url, body, headers) in requests])
+        self.assertEqual("AUTHENTICATION_TOKEN=token", requests[2][3]['Cookie'])
+
+    def test_error_status_raises_ssb_error_for_streamed_and_whole_results(self):
+        (connection, api) = self._get_connection_api_pair()
+        connection.set_responses([None, (500, '{"error": {"message": "search failed"}}'),
+                                  (500, '{"error": {"message": "search failed"}}')])
+        api.login(self.USERNAME, self.PASSWORD)
+
+        with self.assertRaisesRegex(SSBError, "500: search failed"):
+            api.filter(self.LOGSPACE_NAME)
+        with self.assertRaisesRegex(SSBError, "500: search failed"):
+            list(api.iter_filter(self.LOGSPACE_NAME))
+
+    def test_expired_session_is_renewed_and_the_request_is_sent_again(self):
+        (connection, api) = self._get_connection_api_pair()
+        connection.set_responses([
+            self._generate_successful_response("old_token"),  # login
+            (401, '{"error": {"message": "session expired"}}'),  # list_logspaces
+            self._generate_successful_response("new_token"),  # login again
+            self._generate_successful_response(["logspace1"]),  # list_logspaces again
+        ])
+
+        api.login(self.USERNAME, self.PASSWORD)
+
+        self.assertEqual({"logspace1"}, api.list_logspaces())
+        requests = connection.get_requests()
+        self.assertListEqual(["/api/1/login", "/api/1/search/logspace/list_logspaces", "/api/1/login",
+                              "/api/1/search/logspace/list_logspaces"],
+                             [url for (method, url, body, headers) in requests])
+        self.assertEqual("AUTHENTICATION_TOKEN=new_token", requests[3][3]['Cookie'])
+
+    def test_session_is_renewed_only_once_for_a_request(self):
+        (connection, api) = self._get_connection_api_pair()
+        connection.set_responses([None, (401, ""), None, (401, "")])
+        api.login(self.USERNAME, self.PASSWORD)
+
+        with self.assertRaises(AuthenticationError):
+            api.filter(self.LOGSPACE_NAME)
+        self.assertEqual(4, len(connection.get_requests()))
+
+    def test_streamed_filter_renews_the_expired_session_too(self):
+        (connection, api) = self._get_connection_api_pair()
+        connection.set_responses([None, (401, ""), None, self._generate_successful_response([{"a": 1}])])
+        api.login(self.USERNAME, self.PASSWORD)
+
+        self.assertListEqual([{"a": 1}], list(api.iter_filter(self.LOGSPACE_NAME)))
+
+    def test_no_login_is_attempted_after_logout(self):
+        (connection, api) = self._get_connection_api_pair()
+        connection.set_responses([None, None, (401, "")])
+        api.login(self.USERNAME, self.PASSWORD)
+        api.logout()
+
+        with self.assertRaises(AuthenticationError):
+            api.list_logspaces()
+        self.assertEqual(3, len(connection.get_requests()))
+
+    def test_refresh_session_logs_in_again_and_closes_the_old_session(self):
+        (connection, api) = self._get_connection_api_pair()
+        connection.set_responses([self._generate_successful_response("old_token"),
+                                  self._generate_successful_response("new_token")])
+        api.login(self.USERNAME, self.PASSWORD)
+
+        api.refresh_session()
+
+        (login, relogin, logout) = connection.get_requests()
+        self.assertEqual(login, relogin)
+        self.assertEqual("/api/1/logout", logout[1])
+        self.assertEqual("AUTHENTICATION_TOKEN=old_token", logout[3]['Cookie'])
+        self.assertEqual("new_token", api.authentication_token)
+
+
 class MockHTTPConnection:
     def __init__(self):
         self.requests = []
@@ -163,12 +303,18 @@ class MockHTTPConnection:
         self.requests.append((method, url, body, headers))
 
     def getresponse(self):
+        response_data = None
         if len(self.responses) > 0:
             response_data = self.responses.pop(0)
 
         if response_data is None:
-            response_data = ""
+            # a login has to get a token, otherwise it fails
+            (method, url, body, headers) = self.requests[-1]
+            response_data = '{"result": "mock_token"}' if url == "/api/1/login" else ""
 
+        # a (status, body) pair for the failing responses, (status, body, headers) for the special ones
+        if isinstance(response_data, tuple):
+            return MockHTTPResponse(*response_data)
         return MockHTTPResponse(200, response_data)
 
     def close(self):
@@ -176,16 +322,179 @@ class MockHTTPConnection:
 
 
 class MockHTTPResponse:
-    def __init__(self, status, data):
+    def __init__(self, status, data, headers=None):
         self.status = status
-        self.data = str.encode(data)
+        self.data = data if isinstance(data, bytes) else str.encode(data)
+        self.headers = headers or {}
+        self._position = 0
 
-    def read(self):
-        return self.data
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+    def read(self, amt=None):
+        end = len(self.data) if amt is None else self._position + amt
+        data = self.data[self._position:end]
+        self._position += len(data)
+        return data
 
     def readall(self):
         return self.read()
 
+    def close(self):
+        pass
+
+
+class HTTPSConnectionPoolTests(unittest.TestCase):
+    ADDRESS = "ssb.example.com"
+
+    def setUp(self):
+        MockPoolConnection.instances = []
+
+    def _get_pool(self, maxsize=4):
+        return HTTPSConnectionPool(self.ADDRESS, maxsize=maxsize, connection_class=MockPoolConnection)
+
+    def _do_a_request(self, pool, url="/api/1/search/logspace/list_logspaces"):
+        pool.request("GET", url)
+        return pool.getresponse().read()
+
+    def test_connection_is_reused_for_subsequent_requests(self):
+        pool = self._get_pool()
+
+        for i in range(5):
+            self._do_a_request(pool)
+
+        self.assertEqual(1, len(MockPoolConnection.instances))
+        self.assertEqual(5, len(MockPoolConnection.instances[0].requests))
+        self.assertFalse(MockPoolConnection.instances[0].closed)
+
+    def test_connections_are_created_for_the_right_address(self):
+        self._do_a_request(self._get_pool())
+
+        self.assertEqual(self.ADDRESS, MockPoolConnection.instances[0].address)
+
+    def test_concurrent_requests_use_separate_connections(self):
+        pool = self._get_pool()
+        first_request_sent = threading.Event()
+        second_request_done = threading.Event()
+
+        def first_request():
+            pool.request("GET", "/first")
+            first_request_sent.set()
+            second_request_done.wait(5)
+            pool.getresponse().read()
+
+        thread = threading.Thread(target=first_request)
+        thread.start()
+        first_request_sent.wait(5)
+        self._do_a_request(pool, "/second")
+        second_request_done.set()
+        thread.join()
+
+        self.assertEqual(2, len(MockPoolConnection.instances))
+
+    def test_reconnects_if_the_server_closed_the_idle_connection(self):
+        pool = self._get_pool()
+        self._do_a_request(pool)
+        MockPoolConnection.instances[0].set_server_closed()
+
+        self.assertEqual(b"response for /again", self._do_a_request(pool, "/again"))
+        self.assertEqual(2, len(MockPoolConnection.instances))
+        self.assertTrue(MockPoolConnection.instances[0].closed)
+        self.assertEqual("/again", MockPoolConnection.instances[1].requests[0][1])
+
+    def test_error_on_a_fresh_connection_is_not_retried(self):
+        pool = HTTPSConnectionPool(self.ADDRESS, connection_class=BrokenMockPoolConnection)
+
+        with self.assertRaises(ConnectionResetError):
+            self._do_a_request(pool)
+
+    def test_connection_with_short_unread_body_is_drained_and_reused(self):
+        pool = self._get_pool()
+        pool.request("GET", "/partially_read")
+        response = pool.getresponse()
+        response.read(3)
+        response.close()
+
+        self._do_a_request(pool)
+
+        self.assertEqual(1, len(MockPoolConnection.instances))
+
+    def test_connection_with_long_unread_body_is_not_reused(self):
+        pool = self._get_pool()
+        pool.request("GET", "/" + "x" * (PooledResponse.MAX_BYTES_TO_DRAIN + 1))
+        pool.getresponse().close()
+
+        self._do_a_request(pool)
+
+        self.assertEqual(2, len(MockPoolConnection.instances))
+        self.assertTrue(MockPoolConnection.instances[0].closed)
+
+    def test_at_most_maxsize_idle_connections_are_kept(self):
+        pool = self._get_pool(maxsize=1)
+        pool.request("GET", "/first")
+        first_response = pool.getresponse()
+        pool.request("GET", "/second")
+        second_response = pool.getresponse()
+
+        first_response.read()
+        second_response.read()
+
+        self.assertFalse(MockPoolConnection.instances[0].closed)
+        self.assertTrue(MockPoolConnection.instances[1].closed)
+
+
+class MockPoolConnection:
+    instances = []
+
+    def __init__(self, address, timeout=None, context=None):
+        self.address = address
+        self.requests = []
+        self.closed = False
+        self._server_closed = False
+        self.instances.append(self)
+
+    def set_server_closed(self):
+        self._server_closed = True
+
+    def request(self, method, url, body=None, headers={}):
+        self.requests.append((method, url, body, headers))
+
+    def getresponse(self):
+        if self._server_closed:
+            raise http.client.RemoteDisconnected("Remote end closed connection without response")
+        return MockPoolResponse("response for %s" % self.requests[-1][1])
+
+    def close(self):
+        self.closed = True
+
+
+class BrokenMockPoolConnection(MockPoolConnection):
+    def getresponse(self):
+        raise ConnectionResetError
+
+
+class MockPoolResponse(MockHTTPResponse):
+    def __init__(self, data):
+        super().__init__(200, data)
+        self.will_close = False
+        self._closed = False
+
+    def read(self, amt=None):
+        data = super().read(amt)
+        if self._position == len(self.data):
+            self._closed = True
+        return data
+
+    @property
+    def length(self):
+        return len(self.data) - self._position
+
+    def isclosed(self):
+        return self._closed
+
+    def close(self):
+        self._closed = True
+
 
 class KWayMergeTests(unittest.TestCase):
     def test_next_throws_exception_if_fetch_functions_is_not_iterable(self):
@@ -253,18 +562,68 @@ class KWayMergeTests(unittest.TestCase):
         for i in range(LIST_LENGTH * NUMBER_OF_LISTS):
             self.assertEqual(i, merger.next())
 
+    def test_next_returns_none_when_all_fetchers_are_exhausted(self):
+        merger = KWayMerger((MockFetcher([1]).next, MockFetcher([]).next))
+
+        self.assertEqual(1, merger.next())
+        self.assertIsNone(merger.next())
+
+    def test_key_is_used_for_ordering(self):
+        merger = KWayMerger((MockFetcher([{'ts': 1}, {'ts': 4}]).next, MockFetcher([{'ts': 2}, {'ts': 3}]).next),
+                            key=lambda log: log['ts'])
+
+        self.assertListEqual([1, 2, 3, 4], [log['ts'] for log in merger.take(10)])
+
+    def test_equal_keys_keep_the_order_of_the_fetchers(self):
+        first = MockFetcher([{'ts': 1, 'id': 'a1'}, {'ts': 1, 'id': 'a2'}]).next
+        second = MockFetcher([{'ts': 0, 'id': 'b1'}, {'ts': 1, 'id': 'b2'}]).next
+        merger = KWayMerger((first, second), key=lambda log: log['ts'])
+
+        self.assertListEqual(['b1', 'a1', 'a2', 'b2'], [log['id'] for log in merger.take(4)])
+
+    def test_take_returns_at_most_count_elements_in_order(self):
+        merger = KWayMerger((MockFetcher([1, 3, 5]).next, MockFetcher([2, 4, 6]).next))
+
+        self.assertListEqual([1, 2, 3, 4], merger.take(4))
+        self.assertListEqual([5, 6], merger.take(4))
+        self.assertListEqual([], merger.take(4))
+
+    def test_exhausted_fetchers_are_not_called_again(self):
+        fetcher = MockFetcher([1])
+        merger = KWayMerger((fetcher.next, MockFetcher(list(range(10))).next))
+
+        merger.take(100)
+
+        self.assertEqual(2, fetcher.calls)
+
 
 class MockFetcher:
     def __init__(self, list_to_return):
         self._list_to_return = list_to_return
+        self.calls = 0
 
     def next(self):
+        self.calls += 1
         if len(self._list_to_return) > 0:
             return self._list_to_return.pop(0)
         else:
             return None
 
-    #TODO_fetches_are_not_called_multiple_times
+class SSBCursorTests(unittest.TestCase):
+    def test_page_is_judged_by_the_limit_it_was_asked_with(self):
+        ssb = MockLiveSSB()
+        ssb.add_logs([{'processed_timestamp': timestamp} for timestamp in range(20)])
+        wanted = [5]
+        cursor = SSBCursor(ssb, "logspace", 0, 9999999999, None, 100, first_page_size=10,
+                           wanted=lambda: wanted[0])
+
+        page = cursor.request_page()
+        # the merge wants more by the time the page is used
+        wanted[0] = 20
+        cursor.use_page(page)
+
+        self.assertListEqual(list(range(20)), [cursor.next()['processed_timestamp'] for i in range(20)])
+
 
 class MergeProxyTest(unittest.TestCase):
     LOGSPACE_NAME = "testlogspacename"
@@ -463,62 +822,1741 @@ class MergeProxyTest(unittest.TestCase):
 
         self.assertEqual(limit_to_test, len(proxy.filter(self.LOGSPACE_NAME, limit=limit_to_test)))
 
+    def test_filter_with_offset_returns_the_right_slice_of_the_merged_logs(self):
+        (ssbs, all_logs) = self._create_ssbs_with_interleaved_logs(number_of_ssbs=4, logs_per_ssb=50)
+        proxy = MergeProxy(ssbs, page_size=7)
 
-class MockSSB():
-    def __init__(self):
-        self.logspaces = set()
-        self.calls = []
-        self._number_of_messages = 0
-        self._logs = []
+        self.assertListEqual(all_logs[95:120], proxy.filter(self.LOGSPACE_NAME, offset=95, limit=25))
 
-    def set_logspaces(self, logspaces):
-        self._logspaces = logspaces
+    def _create_ssbs_with_interleaved_logs(self, number_of_ssbs, logs_per_ssb):
+        ssbs = []
+        all_logs = []
+        for i in range(number_of_ssbs):
+            new_ssb = MockSSB()
+            new_logs = [{'processed_timestamp': j * number_of_ssbs + i, 'host': i} for j in range(logs_per_ssb)]
+            new_ssb.set_logs(new_logs)
+            all_logs += new_logs
+            ssbs.append(new_ssb)
+        all_logs = sorted(all_logs, key=lambda log: log['processed_timestamp'])
+        return tuple(ssbs), all_logs
 
-    def set_logs(self, logs):
-        self._logs = logs
+    def test_filter_with_offset_past_the_end_returns_empty_list(self):
+        (ssbs, all_logs) = self._create_ssbs_with_interleaved_logs(number_of_ssbs=3, logs_per_ssb=10)
+        proxy = MergeProxy(ssbs)
 
-    def set_number_of_messages(self, number_of_messages):
-        self._number_of_messages = number_of_messages
+        self.assertListEqual([], proxy.filter(self.LOGSPACE_NAME, offset=len(all_logs), limit=10))
 
-    def get_calls(self):
-        return self.calls
+    def test_deep_filter_fetches_from_SSBs_in_pages(self):
+        PAGE_SIZE = 10
+        (ssbs, all_logs) = self._create_ssbs_with_interleaved_logs(number_of_ssbs=3, logs_per_ssb=100)
+        proxy = MergeProxy(ssbs, page_size=PAGE_SIZE)
 
-    def number_of_messages(self, *args, **kwargs):
-        self.calls.append({"func": "number_of_messages", "args": args, "kwarg": kwargs})
-        return self._number_of_messages
+        proxy.filter(self.LOGSPACE_NAME, offset=200, limit=20)
 
-    def filter(self, *args, **kwargs):
-        self.calls.append({"func": "filter", "args": args, "kwarg": kwargs})
-        return self._logs
+        for ssb in ssbs:
+            for call in ssb.get_calls():
+                self.assertLessEqual(call['kwarg']['limit'], PAGE_SIZE)
 
-    def list_logspaces(self):
-        return self._logspaces
+    def test_small_limit_asks_small_first_pages_and_counts_what_is_discarded(self):
+        (ssbs, all_logs) = self._create_ssbs_with_interleaved_logs(number_of_ssbs=4, logs_per_ssb=1000)
+        proxy = MergeProxy(ssbs)
 
-class MergeProxyConfigTest(unittest.TestCase):
-    def test_get_servers_returns_a_list(self):
-        servers = self._feed_with_sample_2_server_config_and_return_what_get_servers_returns()
-        self.assertEqual(type(list()), type(servers))
+        self.assertListEqual(all_logs[:100], proxy.filter(self.LOGSPACE_NAME, limit=100))
 
-    def _feed_with_sample_2_server_config_and_return_what_get_servers_returns(self):
-        config_text = """
-[server1.serverhost]
-user=a
-password=a
-[1.2.3.4]
-user=a
-password=a
-"""
-        config = MergeProxyConfig(config_text)
-        return config.get_servers()
+        self.assertListEqual([25, 25, 25, 25], [ssb.get_calls()[0]['kwarg']['limit'] for ssb in ssbs])
+        stats = proxy.transfer_stats.stats()
+        self.assertEqual(100, stats['returned'])
+        self.assertLess(stats['transferred'], 200)
+        self.assertEqual(stats['transferred'] - 100, stats['discarded'])
 
-    def test_returns_all_servers(self):
-        servers = self._feed_with_sample_2_server_config_and_return_what_get_servers_returns()
-        self.assertEqual(2, len(servers))
+    def test_SSB_holding_all_the_first_logs_is_asked_for_growing_pages_up_to_the_limit(self):
+        (first_ssb, late_ssb) = (MockSSB(), MockSSB())
+        first_ssb.set_logs([{'processed_timestamp': i} for i in range(1000)])
+        late_ssb.set_logs([{'processed_timestamp': 5000 + i} for i in range(1000)])
+        proxy = MergeProxy((first_ssb, late_ssb))
+
+        logs = proxy.filter(self.LOGSPACE_NAME, offset=20, limit=100)
+
+        self.assertListEqual(list(range(20, 120)), [log['processed_timestamp'] for log in logs])
+        self.assertListEqual([(0, 60), (60, 60)], [(call['kwarg']['offset'], call['kwarg']['limit'])
+                                                   for call in first_ssb.get_calls()])
+        self.assertListEqual([60], [call['kwarg']['limit'] for call in late_ssb.get_calls()])
+        self.assertDictEqual({'merges': 1, 'transferred': 180, 'returned': 100, 'skipped': 20, 'discarded': 60},
+                             proxy.transfer_stats.stats())
+
+    def test_compact_filter_returns_the_same_logs_as_a_batch(self):
+        (ssbs, all_logs) = self._create_ssbs_with_interleaved_logs(number_of_ssbs=3, logs_per_ssb=50)
+        proxy = MergeProxy(ssbs, page_size=7, compact=True, cache=ResultCache())
+
+        logs = proxy.filter(self.LOGSPACE_NAME, offset=20, limit=100)
+
+        self.assertIsInstance(logs, LogBatch)
+        self.assertListEqual(all_logs[20:120], logs.to_dicts())
+        self.assertEqual(all_logs[20:120], proxy.filter(self.LOGSPACE_NAME, offset=20, limit=100))
+        self.assertListEqual(all_logs[20:30], [record.as_dict() for record in
+                                               proxy.iter_filter(self.LOGSPACE_NAME, offset=20, limit=10)])
+
+    def test_filter_accepts_offset_and_limit_as_strings(self):
+        (ssbs, all_logs) = self._create_ssbs_with_interleaved_logs(number_of_ssbs=2, logs_per_ssb=10)
+        proxy = MergeProxy(ssbs)
+
+        self.assertListEqual(all_logs[5:8], proxy.filter(self.LOGSPACE_NAME, offset="5", limit="3"))
+
+    def test_filter_streams_from_SSBs_which_can_stream_and_closes_the_streams(self):
+        ssbs = []
+        all_logs = []
+        for i in range(3):
+            new_ssb = MockStreamingSSB()
+            new_logs = [{'processed_timestamp': j * 3 + i} for j in range(20)]
+            new_ssb.set_logs(new_logs)
+            all_logs += new_logs
+            ssbs.append(new_ssb)
+        all_logs = sorted(all_logs, key=lambda log: log['processed_timestamp'])
+        proxy = MergeProxy(tuple(ssbs))
+
+        self.assertListEqual(all_logs[5:15], proxy.filter(self.LOGSPACE_NAME, offset=5, limit=10))
+        for ssb in ssbs:
+            self.assertEqual("iter_filter", ssb.get_calls()[0]['func'])
+            self.assertEqual(0, ssb.open_streams)
+
+    def test_iter_filter_gives_back_the_streams_when_closed_early(self):
+        ssbs = []
+        for i in range(3):
+            new_ssb = MockStreamingSSB()
+            new_ssb.set_logs([{'processed_timestamp': j * 3 + i} for j in range(20)])
+            ssbs.append(new_ssb)
+        proxy = MergeProxy(tuple(ssbs), page_size=4)
+
+        logs = proxy.iter_filter(self.LOGSPACE_NAME, offset=2, limit=50)
+        self.assertListEqual([2, 3, 4], [next(logs)['processed_timestamp'] for i in range(3)])
+        logs.close()
+
+        for ssb in ssbs:
+            self.assertEqual(0, ssb.open_streams)
+
+    def test_SSBs_are_queried_simultaneously(self):
+        number_of_ssbs = 5
+        # the barrier only opens if all the SSBs are waiting on it at the same time
+        barrier = threading.Barrier(number_of_ssbs, timeout=5)
+        ssbs = []
+        for i in range(number_of_ssbs):
+            new_ssb = MockSSB()
+            new_ssb.set_number_of_messages(1)
+            new_ssb.set_delay(barrier.wait)
+            ssbs.append(new_ssb)
+
+        proxy = MergeProxy(tuple(ssbs))
+
+        self.assertEqual(number_of_ssbs, proxy.number_of_messages(self.LOGSPACE_NAME))
+
+    def test_results_are_the_same_with_a_concurrency_cap_of_one(self):
+        ssbs = []
+        for i in range(10):
+            new_ssb = MockSSB()
+            new_ssb.set_logs([{'processed_timestamp': 10 - i, 'id': i}])
+            ssbs.append(new_ssb)
+
+        proxy = MergeProxy(tuple(ssbs), max_workers=1)
+
+        merged_ids = [log['id'] for log in proxy.filter(self.LOGSPACE_NAME)]
+        self.assertListEqual(list(reversed(range(10))), merged_ids)
+
+    def test_slow_SSB_raises_timeout_error(self):
+        slow_ssb = MockSSB()
+        slow_ssb.set_delay(lambda: time.sleep(1))
+
+        proxy = MergeProxy((MockSSB(), slow_ssb), timeout=0.05)
+
+        with self.assertRaises(concurrent.futures.TimeoutError):
+            proxy.number_of_messages(self.LOGSPACE_NAME)
+
+
+    def test_cached_proxy_answers_repeated_queries_without_asking_the_SSBs(self):
+        ssb = MockSSB()
+        ssb.set_number_of_messages(42)
+        ssb.set_logs([{'processed_timestamp': 1}])
+        proxy = MergeProxy((ssb, ), cache=ResultCache())
+
+        for i in range(3):
+            self.assertEqual(42, proxy.number_of_messages(self.LOGSPACE_NAME, 0, 1000))
+            self.assertListEqual([{'processed_timestamp': 1}], proxy.filter(self.LOGSPACE_NAME, 0, "1000"))
+
+        self.assertEqual(2, len(ssb.get_calls()))
+
+    def test_cached_filter_results_cant_be_changed_by_the_caller(self):
+        ssb = MockSSB()
+        ssb.set_logs([{'processed_timestamp': 1}])
+        proxy = MergeProxy((ssb, ), cache=ResultCache())
+
+        proxy.filter(self.LOGSPACE_NAME, 0, 1000).clear()
+
+        self.assertEqual(1, len(proxy.filter(self.LOGSPACE_NAME, 0, 1000)))
+
+
+class LatencyTrackerTest(unittest.TestCase):
+    def test_percentile_is_unknown_until_there_are_enough_samples(self):
+        tracker = LatencyTracker(min_samples=3)
+        tracker.record("ssb1", 1)
+        tracker.record("ssb1", 2)
+
+        self.assertIsNone(tracker.percentile("ssb1", 95))
+        self.assertIsNone(tracker.percentile("ssb2", 95))
+
+    def test_percentile_of_the_last_window_samples(self):
+        tracker = LatencyTracker(window=100, min_samples=1)
+        for latency in range(1000):
+            tracker.record("ssb1", latency)
+        tracker.record("ssb2", 5)
+
+        self.assertEqual(995, tracker.percentile("ssb1", 95))
+        self.assertEqual(950, tracker.percentile("ssb1", 50))
+        self.assertEqual(5, tracker.percentile("ssb2", 95))
+
+    def test_operations_are_tracked_separately(self):
+        tracker = LatencyTracker(min_samples=1)
+        tracker.record("ssb1", 2, 'filter')
+        tracker.record("ssb1", 0.01, 'number_of_messages')
+
+        self.assertEqual(2, tracker.percentile("ssb1", 95, 'filter'))
+        self.assertEqual(0.01, tracker.percentile("ssb1", 95, 'number_of_messages'))
+        self.assertIsNone(tracker.percentile("ssb1", 95, 'list_logspaces'))
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000
+        self.breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30, clock=lambda: self.now)
+
+    def _fail(self, times):
+        for i in range(times):
+            self.breaker.record_failure("ssb1")
+
+    def test_backend_is_left_out_after_failures_in_a_row(self):
+        self._fail(2)
+        self.breaker.record_success("ssb1")
+        self._fail(2)
+        self.assertTrue(self.breaker.allow("ssb1"))
+
+        self._fail(1)
+
+        self.assertFalse(self.breaker.allow("ssb1"))
+        self.assertTrue(self.breaker.allow("ssb2"))
+        self.assertSetEqual({"ssb1"}, self.breaker.open_backends())
+
+    def test_a_single_trial_is_let_through_after_the_reset_timeout(self):
+        self._fail(3)
+        self.now += 30
+
+        self.assertTrue(self.breaker.allow("ssb1"))
+        self.assertFalse(self.breaker.allow("ssb1"))
+        self.breaker.record_success("ssb1")
+        self.assertTrue(self.breaker.allow("ssb1"))
+        self.assertSetEqual(set(), self.breaker.open_backends())
+
+    def test_failed_trial_leaves_the_backend_out_again(self):
+        self._fail(3)
+        self.now += 30
+        self.breaker.allow("ssb1")
+
+        self._fail(1)
+
+        self.assertFalse(self.breaker.allow("ssb1"))
+        self.now += 29
+        self.assertFalse(self.breaker.allow("ssb1"))
+
+    def test_trial_given_up_before_it_started_is_released(self):
+        self._fail(3)
+        self.now += 30
+        self.breaker.allow("ssb1")
+
+        self.breaker.release_trial("ssb1")
+
+        self.assertTrue(self.breaker.allow("ssb1"))
+        self.assertSetEqual({"ssb1"}, self.breaker.open_backends())
+
+
+class FanOutExecutorTest(unittest.TestCase):
+    def _tracker_with_latency(self, backend_name, latency):
+        tracker = LatencyTracker(min_samples=1)
+        tracker.record(backend_name, latency)
+        return tracker
+
+    def test_slow_call_is_hedged_and_the_first_answer_wins(self):
+        calls = []
+        discarded = []
+
+        def call(backend):
+            calls.append(backend)
+            if len(calls) == 1:
+                time.sleep(0.5)
+                return "slow"
+            return "fast"
+
+        executor = FanOutExecutor(2, latency_tracker=self._tracker_with_latency("ssb1", 0.01))
+
+        started = time.monotonic()
+        self.assertListEqual(["fast"], executor.map(call, ["ssb"], names=["ssb1"], hedge=True,
+                                                    discard=discarded.append))
+        self.assertLess(time.monotonic() - started, 0.4)
+        self.assertEqual(1, executor.hedged_calls)
+        time.sleep(0.6)
+        self.assertListEqual(["slow"], discarded)
+
+    def test_calls_are_not_hedged_unless_asked(self):
+        executor = FanOutExecutor(2, latency_tracker=self._tracker_with_latency("ssb1", 0.01))
+
+        self.assertListEqual([1], executor.map(lambda backend: time.sleep(0.1) or 1, ["ssb"], names=["ssb1"]))
+        self.assertEqual(0, executor.hedged_calls)
+
+    def test_partial_map_gives_up_the_backends_at_the_deadline(self):
+        discarded = []
+        executor = FanOutExecutor(3)
+
+        def call(delay):
+            time.sleep(delay)
+            if delay < 0:
+                raise ValueError("no such delay")
+            return delay
+
+        (results, failures) = executor.map_partial(call, [0, 0.5, -1], deadline=0.1, discard=discarded.append)
+
+        self.assertListEqual([0, None, None], results)
+        self.assertIsInstance(failures[1], concurrent.futures.TimeoutError)
+        self.assertIsInstance(failures[2], ValueError)
+        time.sleep(0.6)
+        self.assertListEqual([0.5], discarded)
+
+    def test_backend_with_an_open_circuit_is_not_called(self):
+        breaker = CircuitBreaker(failure_threshold=1)
+        breaker.record_failure("ssb2")
+        calls = []
+        executor = FanOutExecutor(2, circuit_breaker=breaker)
+
+        with self.assertRaises(BackendUnavailableError):
+            executor.map(calls.append, ["a", "b"], names=["ssb1", "ssb2"])
+        (results, failures) = executor.map_partial(calls.append, ["a", "b"], names=["ssb1", "ssb2"])
+
+        self.assertNotIn("b", calls)
+        self.assertListEqual([1], list(failures))
+
+    def test_failures_and_timeouts_open_the_circuit(self):
+        breaker = CircuitBreaker(failure_threshold=2)
+        executor = FanOutExecutor(2, timeout=0.05, circuit_breaker=breaker)
+
+        for i in range(2):
+            executor.map_partial(lambda delay: time.sleep(delay), [0, 1], names=["ssb1", "ssb2"])
+
+        self.assertSetEqual({"ssb2"}, breaker.open_backends())
+
+    def test_calls_given_up_on_after_another_failed_are_still_recorded(self):
+        now = [1000]
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30, clock=lambda: now[0])
+        breaker.record_failure("ssb2")
+        now[0] += 30
+        executor = FanOutExecutor(2, circuit_breaker=breaker)
+
+        def call(delay):
+            time.sleep(delay)
+            if delay == 0:
+                raise ValueError("failed at once")
+
+        with self.assertRaises(ValueError):
+            executor.map(call, [0, 0.1], names=["ssb1", "ssb2"])
+        time.sleep(0.2)
+
+        self.assertSetEqual({"ssb1"}, breaker.open_backends())
+        self.assertTrue(breaker.allow("ssb2"))
+
+
+class DegradedMergeProxyTest(unittest.TestCase):
+    LOGSPACE_NAME = "testlogspacename"
+
+    def _ssbs(self, delays):
+        ssbs = []
+        for (i, delay) in enumerate(delays):
+            new_ssb = MockStreamingSSB()
+            new_ssb.address = "ssb%d" % i
+            new_ssb.set_number_of_messages(10)
+            new_ssb.set_logspaces({"logspace%d" % i})
+            new_ssb.set_logs([{'processed_timestamp': j * len(delays) + i} for j in range(10)])
+            new_ssb.set_delay(lambda delay=delay: time.sleep(delay))
+            ssbs.append(new_ssb)
+        return tuple(ssbs)
+
+    def test_SSBs_missing_the_deadline_are_left_out_and_named(self):
+        ssbs = self._ssbs([0, 0.5, 0])
+        proxy = MergeProxy(ssbs, deadline=0.1)
+
+        logs = proxy.filter(self.LOGSPACE_NAME, limit=100)
+        self.assertListEqual([0, 2, 3, 5], [log['processed_timestamp'] for log in logs[:4]])
+        self.assertListEqual(["ssb1"], logs.degraded_backends)
+
+        count = proxy.number_of_messages(self.LOGSPACE_NAME)
+        self.assertEqual(20, count)
+        self.assertListEqual(["ssb1"], count.degraded_backends)
+
+        logspaces = proxy.list_logspaces()
+        self.assertSetEqual({"logspace0", "logspace2"}, logspaces)
+        self.assertListEqual(["ssb1"], logspaces.degraded_backends)
+
+    def test_SSBs_missing_the_deadline_with_a_later_page_are_left_out_of_the_rest(self):
+        ssbs = self._ssbs([0, 0])
+        ssbs[1].set_logs([{'processed_timestamp': j * 2 + 1} for j in range(100)])
+        calls = []
+
+        def slow_after_the_first_page():
+            calls.append(None)
+            if len(calls) > 1:
+                time.sleep(0.5)
+
+        ssbs[1].set_delay(slow_after_the_first_page)
+        proxy = MergeProxy(ssbs, deadline=0.1)
+
+        started = time.monotonic()
+        logs = proxy.filter(self.LOGSPACE_NAME, limit=60)
+
+        self.assertLess(time.monotonic() - started, 0.4)
+        self.assertListEqual(["ssb1"], logs.degraded_backends)
+        self.assertEqual(10 + 30, len(logs))
+
+    def test_later_pages_share_the_deadline_of_the_query(self):
+        ssbs = self._ssbs([0, 0])
+        ssbs[1].set_logs([{'processed_timestamp': j * 2 + 1} for j in range(100)])
+        calls = []
+
+        def slower_than_the_deadline_in_total():
+            calls.append(None)
+            if len(calls) > 1:
+                time.sleep(0.05)
+
+        ssbs[1].set_delay(slower_than_the_deadline_in_total)
+        proxy = MergeProxy(ssbs, deadline=0.15, page_size=10)
+
+        started = time.monotonic()
+        logs = proxy.filter(self.LOGSPACE_NAME, limit=100)
+
+        self.assertLess(time.monotonic() - started, 0.4)
+        self.assertListEqual(["ssb1"], logs.degraded_backends)
+
+    def test_streamed_result_names_the_SSBs_left_out_in_the_last_record(self):
+        server = MergeProxyServer(MergeProxy(self._ssbs([0, 0.5, 0]), deadline=0.1))
+
+        lines = ''.join(chunk.decode() for chunk in server.filter_stream(self.LOGSPACE_NAME, limit="100")).splitlines()
+
+        self.assertEqual(20, len(lines) - 1)
+        self.assertDictEqual({'degraded_backends': ["ssb1"]}, json.loads(lines[-1]))
+
+    def test_results_in_time_are_not_marked(self):
+        proxy = MergeProxy(self._ssbs([0, 0]), deadline=1)
+
+        self.assertEqual(20, len(proxy.filter(self.LOGSPACE_NAME, limit=100)))
+        self.assertNotIsInstance(proxy.number_of_messages(self.LOGSPACE_NAME), DegradedInt)
+
+    def test_degraded_results_are_not_cached(self):
+        ssbs = self._ssbs([0, 0])
+        cache = ResultCache()
+        proxy = MergeProxy(ssbs, deadline=0.1, cache=cache)
+        ssbs[1].set_delay(lambda: time.sleep(0.3))
+
+        self.assertEqual(10, proxy.number_of_messages(self.LOGSPACE_NAME))
+        time.sleep(0.3)
+        ssbs[1].set_delay(None)
+
+        self.assertEqual(20, proxy.number_of_messages(self.LOGSPACE_NAME))
+
+    def test_streams_of_the_SSBs_left_out_are_closed(self):
+        ssbs = self._ssbs([0, 0.3])
+        proxy = MergeProxy(ssbs, deadline=0.1)
+
+        proxy.filter(self.LOGSPACE_NAME, limit=5)
+        time.sleep(0.4)
+
+        for ssb in ssbs:
+            self.assertEqual(0, ssb.open_streams)
+
+    def test_without_answers_there_is_no_partial_result(self):
+        proxy = MergeProxy(self._ssbs([0.5]), deadline=0.05)
+
+        with self.assertRaises(concurrent.futures.TimeoutError):
+            proxy.number_of_messages(self.LOGSPACE_NAME)
+
+    def test_degraded_backends_are_sent_in_a_header(self):
+        server = MergeProxyServer(MergeProxy(self._ssbs([0, 0.5]), deadline=0.1))
+        cherrypy.response.headers.pop('X-Degraded-Backends', None)
+
+        self.assertEqual(10, server.number_of_messages(self.LOGSPACE_NAME))
+        self.assertEqual("ssb1", cherrypy.response.headers['X-Degraded-Backends'])
+
+    def test_degraded_result_of_a_settled_range_has_no_etag(self):
+        server = MergeProxyServer(MergeProxy(self._ssbs([0, 0.5]), deadline=0.1))
+
+        server.number_of_messages(self.LOGSPACE_NAME, to_timestamp="1000")
+
+        self.assertNotIn('ETag', cherrypy.response.headers)
+
+
+class QueryPlannerTest(unittest.TestCase):
+    LOGSPACE_NAME = "testlogspacename"
+
+    def setUp(self):
+        self.now = 100000
+
+    def _ssb(self, logspaces, *timestamps):
+        ssb = MockLiveSSB()
+        ssb.set_logspaces(set(logspaces))
+        ssb.add_logs([{'processed_timestamp': timestamp} for timestamp in timestamps])
+        return ssb
+
+    def _proxy(self, ssbs, **kwargs):
+        self.planner = QueryPlanner(ttl=300, settle_time=60, clock=lambda: self.now)
+        return MergeProxy(ssbs, planner=self.planner, **kwargs)
+
+    def _queries(self, ssb):
+        return [call['func'] for call in ssb.get_calls() if call['func'] in ("filter", "number_of_messages")
+                and call['kwarg'].get('limit') != 1]
+
+    def test_queries_go_only_to_the_SSBs_hosting_the_logspace(self):
+        ssbs = (self._ssb([self.LOGSPACE_NAME], 1, 3), self._ssb(["other"], 2), self._ssb([self.LOGSPACE_NAME], 4))
+        proxy = self._proxy(ssbs)
+
+        self.assertEqual(3, proxy.number_of_messages(self.LOGSPACE_NAME))
+        self.assertListEqual([1, 3, 4], [log['processed_timestamp'] for log in proxy.filter(self.LOGSPACE_NAME)])
+        self.assertListEqual([], ssbs[1].get_calls()[1:])
+        self.assertEqual(2, self.planner.pruned)
+
+    def test_SSBs_whose_logs_start_after_the_queried_range_are_left_out(self):
+        ssbs = (self._ssb([self.LOGSPACE_NAME], 10, 20), self._ssb([self.LOGSPACE_NAME], 500, 600))
+        proxy = self._proxy(ssbs)
+
+        self.assertEqual(2, proxy.number_of_messages(self.LOGSPACE_NAME, 0, 500))
+        self.assertListEqual([], self._queries(ssbs[1]))
+        self.assertEqual(3, proxy.number_of_messages(self.LOGSPACE_NAME, 0, 501))
+        self.assertListEqual(["number_of_messages"], self._queries(ssbs[1]))
+
+    def test_empty_logspace_is_only_asked_about_the_present(self):
+        empty_ssb = self._ssb([self.LOGSPACE_NAME])
+        proxy = self._proxy((self._ssb([self.LOGSPACE_NAME], 10), empty_ssb))
+
+        proxy.number_of_messages(self.LOGSPACE_NAME, 0, self.now - 3600)
+        self.assertListEqual([], self._queries(empty_ssb))
+        proxy.number_of_messages(self.LOGSPACE_NAME, 0, self.now)
+        self.assertListEqual(["number_of_messages"], self._queries(empty_ssb))
+
+    def test_what_the_SSBs_host_is_asked_again_after_the_ttl(self):
+        ssb = self._ssb(["other"])
+        proxy = self._proxy((self._ssb([self.LOGSPACE_NAME], 1), ssb))
+
+        for i in range(3):
+            proxy.number_of_messages(self.LOGSPACE_NAME)
+        ssb.set_logspaces({"other", self.LOGSPACE_NAME})
+        self.now += 300
+        proxy.number_of_messages(self.LOGSPACE_NAME)
+
+        self.assertListEqual(["list_logspaces", "list_logspaces", "filter", "number_of_messages"],
+                             [call['func'] for call in ssb.get_calls()])
+
+    def test_list_logspaces_answers_are_used_for_planning(self):
+        ssbs = (self._ssb([self.LOGSPACE_NAME], 1), self._ssb(["other"]))
+        proxy = self._proxy(ssbs)
+
+        proxy.list_logspaces()
+        proxy.number_of_messages(self.LOGSPACE_NAME)
+
+        self.assertListEqual(["list_logspaces"], [call['func'] for call in ssbs[1].get_calls()])
+
+    def test_SSB_failing_to_tell_what_it_hosts_is_kept_in_the_plan(self):
+        failing_ssb = self._ssb([self.LOGSPACE_NAME], 5)
+
+        def fail():
+            raise ConnectionError("SSB went away")
+
+        failing_ssb.set_delay(fail)
+        proxy = self._proxy((self._ssb([self.LOGSPACE_NAME], 1), failing_ssb))
+
+        with self.assertRaises(ConnectionError):
+            proxy.number_of_messages(self.LOGSPACE_NAME)
+
+    def test_failed_lookup_is_not_tried_again_before_the_failure_ttl(self):
+        failing_ssb = self._ssb([self.LOGSPACE_NAME], 5)
+
+        def fail():
+            raise ConnectionError("SSB went away")
+
+        failing_ssb.set_delay(fail)
+        proxy = self._proxy((self._ssb([self.LOGSPACE_NAME], 1), failing_ssb))
+
+        for i in range(3):
+            with self.assertRaises(ConnectionError):
+                proxy.number_of_messages(self.LOGSPACE_NAME)
+        self.now += 10
+        with self.assertRaises(ConnectionError):
+            proxy.number_of_messages(self.LOGSPACE_NAME)
+
+        self.assertListEqual(["list_logspaces", "filter", "number_of_messages", "number_of_messages",
+                              "number_of_messages", "list_logspaces", "filter", "number_of_messages"],
+                             [call['func'] for call in failing_ssb.get_calls()])
+
+
+class MetricsTest(unittest.TestCase):
+    LOGSPACE_NAME = "testlogspacename"
+
+    def _render(self, metrics):
+        return metrics.render().splitlines()
+
+    def test_observations_are_rendered_as_cumulative_histograms(self):
+        metrics = Metrics()
+        metrics.observe('server', 0.003, 'center', '10.0.0.1')
+        metrics.observe('server', 0.2, 'center', '10.0.0.1')
+        metrics.observe('merge', 20, 'center')
+
+        lines = self._render(metrics)
+
+        self.assertIn('merge_proxy_backend_phase_seconds_bucket{backend="10.0.0.1",phase="server",logspace="center",'
+                      'le="0.0025"} 0', lines)
+        self.assertIn('merge_proxy_backend_phase_seconds_bucket{backend="10.0.0.1",phase="server",logspace="center",'
+                      'le="0.005"} 1', lines)
+        self.assertIn('merge_proxy_backend_phase_seconds_bucket{backend="10.0.0.1",phase="server",logspace="center",'
+                      'le="+Inf"} 2', lines)
+        self.assertIn('merge_proxy_backend_phase_seconds_count{backend="10.0.0.1",phase="server",logspace="center"} 2',
+                      lines)
+        self.assertIn('merge_proxy_query_phase_seconds_bucket{phase="merge",logspace="center",le="10"} 0', lines)
+        self.assertIn('merge_proxy_query_phase_seconds_sum{phase="merge",logspace="center"} 20.0', lines)
+
+    def test_label_values_are_escaped(self):
+        metrics = Metrics()
+        metrics.add_bytes(100, 'a "quoted"\\name', 'ssb')
+
+        self.assertIn('merge_proxy_backend_received_bytes_total{backend="ssb",logspace="a \\"quoted\\"\\\\name"} 100',
+                      self._render(metrics))
+
+    def test_collectors_are_rendered(self):
+        metrics = Metrics()
+        metrics.add_collector('cache', lambda: {'hits': 3, 'misses': 1})
+
+        self.assertListEqual(['merge_proxy_cache_hits 3', 'merge_proxy_cache_misses 1'], self._render(metrics)[-2:])
+
+    def test_ssb_api_records_reading_decoding_and_bytes_per_logspace(self):
+        connection = MockHTTPConnection()
+        body = json.dumps({"result": [{"processed_timestamp": 1}]})
+        connection.set_responses([None, body])
+        api = SSBAPI(connection, metrics=Metrics())
+        api.login("user", "password")
+
+        api.filter(self.LOGSPACE_NAME)
+
+        lines = self._render(api.metrics)
+        for phase in ('read', 'decode'):
+            self.assertIn('merge_proxy_backend_phase_seconds_count{backend="",phase="%s",logspace="%s"} 1' %
+                          (phase, self.LOGSPACE_NAME), lines)
+        self.assertIn('merge_proxy_backend_received_bytes_total{backend="",logspace="%s"} %d' %
+                      (self.LOGSPACE_NAME, len(body)), lines)
+
+    def test_connecting_tls_and_server_time_are_timed_by_the_connection_pool(self):
+        fake_ssb = FakeSSB([SyntheticLogspace(self.LOGSPACE_NAME, 100)], latency=0.01).start()
+        try:
+            ssb = SSB(fake_ssb.address, context=FakeSSB.client_context(), metrics=Metrics())
+            ssb.login("user", "password")
+            ssb.number_of_messages(self.LOGSPACE_NAME)
+            self.assertEqual(100, len(list(ssb.iter_filter(self.LOGSPACE_NAME, limit=1000))))
+            ssb.conn.close()
+        finally:
+            fake_ssb.stop()
+
+        lines = self._render(ssb.metrics)
+        labels = 'backend="%s",phase="%%s",logspace="%s"' % (fake_ssb.address, self.LOGSPACE_NAME)
+        # login opened the connection, the queries reused it
+        self.assertNotIn('merge_proxy_backend_phase_seconds_count{%s} 1' % (labels % 'connect'), lines)
+        self.assertIn('merge_proxy_backend_phase_seconds_count{%s} 2' % (labels % 'server'), lines)
+        self.assertIn('merge_proxy_backend_phase_seconds_count{%s} 1' % (labels % 'stream'), lines)
+        self.assertIn('merge_proxy_backend_phase_seconds_bucket{%s,le="0.005"} 0' % (labels % 'server'), lines)
+
+    def test_connect_and_tls_are_recorded_for_new_connections(self):
+        fake_ssb = FakeSSB([SyntheticLogspace(self.LOGSPACE_NAME, 100)]).start()
+        try:
+            ssb = SSB(fake_ssb.address, context=FakeSSB.client_context(), metrics=Metrics())
+            ssb.login("user", "password")
+            ssb.conn.close()
+            ssb.number_of_messages(self.LOGSPACE_NAME)
+            ssb.conn.close()
+        finally:
+            fake_ssb.stop()
+
+        lines = self._render(ssb.metrics)
+        for phase in ('connect', 'tls'):
+            self.assertIn('merge_proxy_backend_phase_seconds_count{backend="%s",phase="%s",logspace="%s"} 1' %
+                          (fake_ssb.address, phase, self.LOGSPACE_NAME), lines)
+
+    def test_merge_proxy_times_the_first_pages_and_the_merge(self):
+        ssbs = tuple(MockSSB() for i in range(3))
+        for (i, ssb) in enumerate(ssbs):
+            ssb.set_logs([{'processed_timestamp': j * 3 + i} for j in range(100)])
+        proxy = MergeProxy(ssbs, page_size=10, metrics=Metrics())
+
+        proxy.filter(self.LOGSPACE_NAME, offset=50, limit=100)
+
+        lines = self._render(proxy.metrics)
+        for phase in ('first_pages', 'merge'):
+            self.assertIn('merge_proxy_query_phase_seconds_count{phase="%s",logspace="%s"} 1' %
+                          (phase, self.LOGSPACE_NAME), lines)
+
+    def test_streams_time_their_serialization(self):
+        ssb = MockLiveSSB()
+        ssb.add_logs([{'processed_timestamp': timestamp} for timestamp in range(10)])
+        server = MergeProxyServer(MergeProxy((ssb, ), metrics=Metrics()))
+
+        ''.join(chunk.decode() for chunk in server.filter_stream(self.LOGSPACE_NAME, limit="100"))
+
+        self.assertIn('merge_proxy_query_phase_seconds_count{phase="serialize",logspace="%s"} 1' % self.LOGSPACE_NAME,
+                      self._render(server.metrics))
+
+    def test_metrics_server_serves_the_text_format(self):
+        metrics = Metrics()
+        metrics.observe('merge', 0.1, 'center')
+
+        self.assertEqual(metrics.render(), MetricsServer(metrics).index())
+        self.assertTrue(cherrypy.response.headers['Content-Type'].startswith('text/plain; version=0.0.4'))
+
+
+class SessionManagerTest(unittest.TestCase):
+    def _ssbs(self, number_of_ssbs):
+        return tuple(MockSSB() for i in range(number_of_ssbs))
+
+    def _calls(self, ssb):
+        return [(call['func'], call['args']) for call in ssb.get_calls()]
+
+    def test_login_all_logs_in_to_every_SSB_simultaneously(self):
+        ssbs = self._ssbs(5)
+        # the barrier only opens if all the logins are waiting on it at the same time
+        barrier = threading.Barrier(len(ssbs), timeout=5)
+        for ssb in ssbs:
+            ssb.set_delay(barrier.wait)
+
+        SessionManager(ssbs).login_all([("user%d" % i, "password%d" % i) for i in range(len(ssbs))])
+
+        for (i, ssb) in enumerate(ssbs):
+            self.assertListEqual([("login", ("user%d" % i, "password%d" % i))], self._calls(ssb))
+
+    def test_sessions_are_refreshed_in_the_background_until_stopped(self):
+        ssbs = self._ssbs(2)
+        refreshed = threading.Semaphore(0)
+        ssbs[1].set_delay(refreshed.release)
+        sessions = SessionManager(ssbs, refresh_interval=0.01)
+
+        sessions.start()
+        for i in range(3):
+            self.assertTrue(refreshed.acquire(timeout=5))
+        sessions.stop()
+
+        refresh_count = self._calls(ssbs[0]).count(("refresh_session", ()))
+        self.assertGreaterEqual(refresh_count, 3)
+        time.sleep(0.05)
+        self.assertEqual(refresh_count, self._calls(ssbs[0]).count(("refresh_session", ())))
+
+    def test_failed_login_does_not_stop_the_others_and_opens_the_circuit_breaker(self):
+        ssbs = self._ssbs(3)
+
+        def fail():
+            raise AuthenticationError("Login as 'user1' failed with HTTP status 401")
+
+        ssbs[1].set_delay(fail)
+        circuit_breaker = CircuitBreaker()
+
+        failed = SessionManager(ssbs, circuit_breaker=circuit_breaker).login_all([("user", "password")] * len(ssbs))
+
+        self.assertListEqual(["1"], failed)
+        self.assertSetEqual({"1"}, circuit_breaker.open_backends())
+        self.assertListEqual([("login", ("user", "password"))], self._calls(ssbs[2]))
+
+    def test_failed_refresh_does_not_stop_the_others(self):
+        ssbs = self._ssbs(2)
+
+        def fail():
+            raise ConnectionError("SSB went away")
+
+        ssbs[0].set_delay(fail)
+
+        SessionManager(ssbs).refresh_all()
+
+        self.assertListEqual([("refresh_session", ())], self._calls(ssbs[1]))
+
+    def test_merge_proxy_logs_in_and_out_of_every_SSB(self):
+        ssbs = self._ssbs(3)
+        proxy = MergeProxy(ssbs)
+
+        proxy.login("user", "password")
+        proxy.logout()
+
+        for ssb in ssbs:
+            self.assertListEqual([("login", ("user", "password")), ("logout", ())], self._calls(ssb))
+
+
+class ResultCacheTest(unittest.TestCase):
+    NOW = 1000000
+
+    def setUp(self):
+        self.now = self.NOW
+        self.computations = 0
+
+    def _clock(self):
+        return self.now
+
+    def _compute(self):
+        self.computations += 1
+        return self.computations
+
+    def _get_cache(self, **kwargs):
+        return ResultCache(short_ttl=5, long_ttl=3600, settle_time=60, clock=self._clock, **kwargs)
+
+    def test_value_is_computed_once_and_then_served_from_the_cache(self):
+        cache = self._get_cache()
+
+        self.assertEqual(1, cache.get_or_compute("key", self.NOW, self._compute))
+        self.assertEqual(1, cache.get_or_compute("key", self.NOW, self._compute))
+        self.assertDictEqual({'hits': 1, 'misses': 1, 'evictions': 0, 'entries': 1, 'logs': 1}, cache.stats())
+
+    def test_query_touching_the_present_expires_after_the_short_ttl(self):
+        cache = self._get_cache()
+        cache.get_or_compute("key", self.NOW + 100, self._compute)
+
+        self.now += 6
+
+        self.assertEqual(2, cache.get_or_compute("key", self.NOW + 100, self._compute))
+
+    def test_query_of_the_past_is_kept_for_the_long_ttl(self):
+        cache = self._get_cache()
+        cache.get_or_compute("key", self.NOW - 120, self._compute)
+
+        self.now += 3000
+        self.assertEqual(1, cache.get_or_compute("key", self.NOW - 120, self._compute))
+        self.now += 1000
+        self.assertEqual(2, cache.get_or_compute("key", self.NOW - 120, self._compute))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = self._get_cache(max_entries=2)
+        cache.get_or_compute("first", self.NOW, self._compute)
+        cache.get_or_compute("second", self.NOW, self._compute)
+        cache.get_or_compute("first", self.NOW, self._compute)
+
+        cache.get_or_compute("third", self.NOW, self._compute)
+
+        self.assertEqual(1, cache.get_or_compute("first", self.NOW, self._compute))
+        self.assertEqual(4, cache.get_or_compute("second", self.NOW, self._compute))
+        self.assertEqual(2, cache.stats()['evictions'])
+
+    def test_least_recently_used_entries_are_evicted_beyond_the_log_budget(self):
+        cache = self._get_cache(max_logs=10)
+        cache.get_or_compute("first", self.NOW, lambda: list(range(4)))
+        cache.get_or_compute("second", self.NOW, lambda: list(range(4)))
+        cache.get_or_compute("first", self.NOW, self._compute)
+
+        cache.get_or_compute("third", self.NOW, lambda: list(range(4)))
+
+        self.assertListEqual([0, 1, 2, 3], cache.get_or_compute("first", self.NOW, self._compute))
+        self.assertEqual(1, cache.get_or_compute("second", self.NOW, self._compute))
+        self.assertDictEqual({'hits': 2, 'misses': 4, 'evictions': 1, 'entries': 3, 'logs': 9}, cache.stats())
+
+    def test_result_over_the_entry_cap_is_not_cached(self):
+        cache = self._get_cache(max_entry_logs=3)
+
+        cache.get_or_compute("key", self.NOW, lambda: list(range(4)))
+
+        self.assertEqual(1, cache.get_or_compute("key", self.NOW, self._compute))
+
+
+class SingleFlightTest(unittest.TestCase):
+    LOGSPACE_NAME = "testlogspacename"
+
+    def _wait_for(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.001)
+
+    def _start_blocked(self, single_flight, number_of_calls, compute):
+        # the first call computes until released, the others are waiting for it when this returns
+        executor = concurrent.futures.ThreadPoolExecutor(number_of_calls)
+        self.addCleanup(executor.shutdown)
+        futures = [executor.submit(single_flight.do, "key", compute)]
+        self._wait_for(lambda: single_flight.stats()['in_flight'] == 1)
+        futures += [executor.submit(single_flight.do, "key", compute) for i in range(number_of_calls - 1)]
+        self._wait_for(lambda: single_flight.coalesced == number_of_calls - 1)
+        return futures
+
+    def test_concurrent_calls_share_one_computation(self):
+        single_flight = SingleFlight()
+        release = threading.Event()
+        computations = []
+
+        def compute():
+            computations.append(1)
+            release.wait(5)
+            return [1, 2, 3]
+
+        futures = self._start_blocked(single_flight, 5, compute)
+        release.set()
+
+        self.assertListEqual([[1, 2, 3]] * 5, [future.result(5) for future in futures])
+        self.assertEqual(1, len(computations))
+        self.assertDictEqual({'executed': 1, 'coalesced': 4, 'in_flight': 0}, single_flight.stats())
+
+    def test_waiting_calls_get_the_exception_of_the_computation(self):
+        single_flight = SingleFlight()
+        release = threading.Event()
+
+        def compute():
+            release.wait(5)
+            raise BackendUnavailableError("down")
+
+        futures = self._start_blocked(single_flight, 3, compute)
+        release.set()
+
+        for future in futures:
+            with self.assertRaises(BackendUnavailableError):
+                future.result(5)
+
+    def test_calls_after_the_computation_finished_compute_again(self):
+        single_flight = SingleFlight()
+
+        self.assertEqual(1, single_flight.do("key", lambda: 1))
+        self.assertEqual(2, single_flight.do("key", lambda: 2))
+        self.assertEqual(3, single_flight.do("other key", lambda: 3))
+        self.assertDictEqual({'executed': 3, 'coalesced': 0, 'in_flight': 0}, single_flight.stats())
+
+    def _get_blocked_merge_proxy(self, single_flight, **kwargs):
+        ssbs = (MockSSB(), MockSSB())
+        release = threading.Event()
+        for (i, ssb) in enumerate(ssbs):
+            ssb.set_logs([{'processed_timestamp': j * 2 + i} for j in range(10)])
+            ssb.set_number_of_messages(10)
+            ssb.set_delay(lambda: release.wait(5))
+        return MergeProxy(ssbs, single_flight=single_flight, **kwargs), release
+
+    def _run_concurrently(self, single_flight, number_of_calls, release, func, *args, **kwargs):
+        executor = concurrent.futures.ThreadPoolExecutor(number_of_calls)
+        self.addCleanup(executor.shutdown)
+        futures = [executor.submit(func, *args, **kwargs) for i in range(number_of_calls)]
+        self._wait_for(lambda: single_flight.coalesced == number_of_calls - 1)
+        release.set()
+        return [future.result(5) for future in futures]
+
+    def test_identical_filter_queries_of_the_merge_proxy_share_one_fan_out(self):
+        single_flight = SingleFlight()
+        (proxy, release) = self._get_blocked_merge_proxy(single_flight)
+
+        results = self._run_concurrently(single_flight, 4, release, proxy.filter, self.LOGSPACE_NAME, limit=5)
+
+        self.assertListEqual([[{'processed_timestamp': timestamp} for timestamp in range(5)]] * 4, results)
+        for ssb in proxy.ssbs:
+            self.assertEqual(1, len(ssb.get_calls()))
+        # every caller gets a list of its own
+        self.assertEqual(4, len(set(map(id, results))))
+
+    def test_identical_counts_are_coalesced_in_front_of_the_cache(self):
+        single_flight = SingleFlight()
+        cache = ResultCache()
+        (proxy, release) = self._get_blocked_merge_proxy(single_flight, cache=cache)
+
+        results = self._run_concurrently(single_flight, 3, release, proxy.number_of_messages, self.LOGSPACE_NAME,
+                                         0, "100")
+
+        self.assertListEqual([20] * 3, results)
+        for ssb in proxy.ssbs:
+            self.assertEqual(1, len(ssb.get_calls()))
+        self.assertEqual(20, proxy.number_of_messages(self.LOGSPACE_NAME, 0, 100))
+        self.assertEqual(1, cache.stats()['entries'])
+
+
+class CountIndexTest(unittest.TestCase):
+    LOGSPACE_NAME = "testlogspacename"
+    BUCKET_SIZE = 100
+    NOW = 100000
+
+    def setUp(self):
+        self.now = self.NOW
+        # one log every 10 seconds, plus one more at every bucket boundary
+        timestamps = list(range(0, self.NOW, 10)) + list(range(0, self.NOW, self.BUCKET_SIZE))
+        self.ssb = MockTimestampCountingSSB(timestamps)
+
+    def _clock(self):
+        return self.now
+
+    def _get_index(self, **kwargs):
+        return CountIndex(bucket_size=self.BUCKET_SIZE, settle_time=60, clock=self._clock, **kwargs)
+
+    def _count(self, index, from_timestamp, to_timestamp, ssb=None):
+        return index.number_of_messages("ssb1", ssb or self.ssb, self.LOGSPACE_NAME, from_timestamp, to_timestamp,
+                                        "expression")
+
+    def test_count_is_the_same_as_what_the_SSB_counts(self):
+        index = self._get_index()
+
+        for (from_timestamp, to_timestamp) in ((0, 1000), (55, 1234), (1234, 1299), (5000, self.NOW + 500)):
+            for i in range(2):
+                self.assertEqual(self.ssb.count(from_timestamp, to_timestamp),
+                                 self._count(index, from_timestamp, to_timestamp))
+
+    def test_warm_index_only_asks_the_SSB_about_the_edges(self):
+        index = self._get_index()
+        self._count(index, 150, 1950)
+        self.ssb.calls = []
+
+        self._count(index, 150, 1950)
+
+        self.assertCountEqual([(150, 200), (1900, 1950)], self.ssb.calls)
+
+    def test_edges_are_counted_simultaneously(self):
+        index = self._get_index()
+        self._count(index, 150, 1950)
+        barrier = threading.Barrier(2, timeout=5)
+        self.ssb.delay = barrier.wait
+
+        self.assertEqual(self.ssb.count(150, 1950), self._count(index, 150, 1950))
+
+    def test_buckets_touching_the_present_are_not_stored(self):
+        index = self._get_index()
+        self._count(index, self.NOW - 1000, self.NOW + 1000)
+        self.ssb.calls = []
+
+        self._count(index, self.NOW - 1000, self.NOW + 1000)
+
+        self.assertListEqual([(self.NOW - 100, self.NOW + 1000)], self.ssb.calls)
+
+    def test_long_range_is_counted_with_one_query_and_indexed_over_a_few_queries(self):
+        index = self._get_index(max_bucket_queries=5)
+
+        calls = []
+        for i in range(3):
+            self.assertEqual(self.ssb.count(0, 1000), self._count(index, 0, 1000))
+            index.wait_for_fills(5)
+            calls.append(sorted(self.ssb.calls))
+            self.ssb.calls = []
+
+        self.assertListEqual([[(0, 100), (0, 1000), (100, 200), (200, 300), (300, 400), (400, 500)],
+                              [(500, 600), (600, 700), (700, 800), (800, 900), (900, 1000)],
+                              []], calls)
+
+    def test_range_longer_than_the_index_can_hold_is_counted_by_the_SSB_alone(self):
+        index = self._get_index(max_buckets=5)
+
+        for i in range(3):
+            self.assertEqual(self.ssb.count(0, 9999999999), self._count(index, 0, 9999999999))
+            index.wait_for_fills(5)
+
+        self.assertListEqual([(0, 9999999999)] * 3, self.ssb.calls)
+
+    def test_least_recently_used_counts_are_forgotten(self):
+        index = self._get_index(max_keys=1)
+        self._count(index, 0, 1000)
+        index.number_of_messages("ssb2", self.ssb, self.LOGSPACE_NAME, 0, 1000, "expression")
+        self.ssb.calls = []
+
+        self._count(index, 0, 1000)
+
+        self.assertEqual(10, len(self.ssb.calls))
+
+    def test_oldest_buckets_are_forgotten(self):
+        index = self._get_index(max_buckets=5)
+        self._count(index, 0, 500)
+        self._count(index, 500, 1000)
+        self.ssb.calls = []
+
+        self._count(index, 0, 500)
+        self._count(index, 500, 1000)
+
+        self.assertCountEqual([(bucket, bucket + 100) for bucket in range(0, 500, 100)], self.ssb.calls)
+
+    def test_index_is_reloaded_from_its_file(self):
+        (file_descriptor, path) = tempfile.mkstemp()
+        os.close(file_descriptor)
+        os.remove(path)
+        self.addCleanup(os.remove, path)
+        index = self._get_index(path=path)
+        self._count(index, 0, 1000)
+        self.assertFalse(os.path.exists(path))
+        index.stop()
+        self.ssb.calls = []
+
+        self.assertEqual(self.ssb.count(0, 1000), self._count(self._get_index(path=path), 0, 1000))
+        self.assertListEqual([], self.ssb.calls)
+
+    def test_merge_proxy_counts_through_the_index(self):
+        proxy = MergeProxy((self.ssb, self.ssb), count_index=self._get_index())
+        proxy.number_of_messages(self.LOGSPACE_NAME, 0, 1000)
+        self.ssb.calls = []
+
+        self.assertEqual(2 * self.ssb.count(0, 1000), proxy.number_of_messages(self.LOGSPACE_NAME, 0, 1000))
+        self.assertListEqual([], self.ssb.calls)
+
+
+class MockTimestampCountingSSB:
+    def __init__(self, timestamps):
+        self._timestamps = timestamps
+        self.calls = []
+        self.delay = None
+
+    def count(self, from_timestamp, to_timestamp):
+        return len([timestamp for timestamp in self._timestamps if from_timestamp <= timestamp < to_timestamp])
+
+    def number_of_messages(self, logspace, from_timestamp, to_timestamp, search_expression=None):
+        self.calls.append((from_timestamp, to_timestamp))
+        if self.delay is not None:
+            self.delay()
+        return self.count(from_timestamp, to_timestamp)
+
+
+class SeekIndexTest(unittest.TestCase):
+    QUERY = ("logspace", 0, 9999999999, None)
+
+    def _logs(self, *timestamps):
+        return [{'processed_timestamp': timestamp} for timestamp in timestamps]
+
+    def test_without_checkpoints_the_offset_is_kept(self):
+        self.assertEqual((None, 1234), SeekIndex().seek(self.QUERY, 1234))
+
+    def test_nearest_checkpoint_below_the_offset_is_used(self):
+        index = SeekIndex()
+        index.record(self.QUERY, 0, self._logs(1, 1, 2, 2))
+        index.record(self.QUERY, 100, self._logs(5, 6, 6, 6))
+
+        self.assertEqual((None, 1), index.seek(self.QUERY, 1))
+        self.assertEqual((2, 48), index.seek(self.QUERY, 50))
+        self.assertEqual((6, 0), index.seek(self.QUERY, 101))
+        self.assertEqual((6, 999), index.seek(self.QUERY, 1100))
+
+    def test_page_with_a_single_timestamp_records_nothing(self):
+        index = SeekIndex()
+        index.record(self.QUERY, 100, self._logs(5, 5, 5))
+
+        self.assertEqual((None, 200), index.seek(self.QUERY, 200))
+
+    def test_checkpoints_are_per_query(self):
+        index = SeekIndex()
+        index.record(self.QUERY, 0, self._logs(1, 2))
+
+        self.assertEqual((None, 50), index.seek(("other_logspace", 0, 9999999999, None), 50))
+
+    def test_least_recently_used_queries_are_forgotten(self):
+        index = SeekIndex(max_queries=1)
+        index.record(self.QUERY, 0, self._logs(1, 2))
+        index.record(("other_logspace", 0, 9999999999, None), 0, self._logs(1, 2))
+
+        self.assertEqual((None, 50), index.seek(self.QUERY, 50))
+
+    def test_merge_proxy_seeks_deep_pages_and_returns_the_same_logs(self):
+        ssbs = []
+        for i in range(3):
+            new_ssb = MockSSB()
+            new_ssb.set_logs([{'processed_timestamp': j // 2, 'host': i, 'id': j} for j in range(200)])
+            ssbs.append(new_ssb)
+        plain_proxy = MergeProxy(tuple(ssbs))
+        seeking_proxy = MergeProxy(tuple(ssbs), seek_index=SeekIndex())
+
+        seeking_proxy.filter("logspace", offset=0, limit=300)
+        first_query_calls = [len(ssb.get_calls()) for ssb in ssbs]
+        deep_logs = seeking_proxy.filter("logspace", offset=450, limit=30)
+
+        self.assertListEqual(plain_proxy.filter("logspace", offset=450, limit=30), deep_logs)
+        # the last timestamp change in the first 300 merged logs was to 49
+        for (ssb, calls_before) in zip(ssbs, first_query_calls):
+            self.assertEqual(49, ssb.get_calls()[calls_before]['args'][1])
+            self.assertEqual(0, ssb.get_calls()[calls_before]['kwarg']['offset'])
+
+
+class LogFollowerTest(unittest.TestCase):
+    LOGSPACE_NAME = "testlogspacename"
+
+    def _log(self, timestamp, message):
+        return {'processed_timestamp': timestamp, 'message': message}
+
+    def _live_ssb(self, *timestamps):
+        ssb = MockLiveSSB()
+        ssb.add_logs([self._log(timestamp, "old %d" % i) for (i, timestamp) in enumerate(timestamps)])
+        return ssb
+
+    def test_start_returns_the_backlog_with_two_requests(self):
+        ssb = self._live_ssb(*range(100))
+
+        logs = LogFollower(ssb, self.LOGSPACE_NAME, backlog=3).start()
+
+        self.assertListEqual([97, 98, 99], [log['processed_timestamp'] for log in logs])
+        self.assertEqual(["number_of_messages", "filter"], [call['func'] for call in ssb.get_calls()])
+
+    def test_start_on_empty_logspace_returns_nothing(self):
+        self.assertListEqual([], LogFollower(MockLiveSSB(), self.LOGSPACE_NAME).start())
+
+    def test_poll_returns_only_the_new_logs(self):
+        ssb = self._live_ssb(1, 2, 3)
+        follower = LogFollower(ssb, self.LOGSPACE_NAME, backlog=1)
+        follower.start()
+
+        self.assertListEqual([], follower.poll())
+        ssb.add_logs([self._log(4, "new 1"), self._log(5, "new 2")])
+        self.assertListEqual(["new 1", "new 2"], [log['message'] for log in follower.poll()])
+        self.assertListEqual([], follower.poll())
+
+    def test_new_logs_in_the_last_second_are_returned_without_duplicates(self):
+        ssb = self._live_ssb(1, 2, 2)
+        follower = LogFollower(ssb, self.LOGSPACE_NAME, backlog=2)
+        follower.start()
+
+        ssb.add_logs([self._log(2, "new 1"), self._log(3, "new 2")])
+        self.assertListEqual(["new 1", "new 2"], [log['message'] for log in follower.poll()])
+        ssb.add_logs([self._log(3, "new 3")])
+        self.assertListEqual(["new 3"], [log['message'] for log in follower.poll()])
+
+    def test_identical_logs_in_the_last_second_are_all_returned(self):
+        ssb = self._live_ssb(1, 2)
+        follower = LogFollower(ssb, self.LOGSPACE_NAME, backlog=2)
+        follower.start()
+
+        ssb.add_logs([self._log(2, "same"), self._log(2, "same")])
+        self.assertListEqual(["same", "same"], [log['message'] for log in follower.poll()])
+        ssb.add_logs([self._log(2, "same")])
+        self.assertListEqual(["same"], [log['message'] for log in follower.poll()])
+        self.assertListEqual([], follower.poll())
+
+    def test_logs_of_the_last_second_before_the_backlog_are_not_returned_again(self):
+        ssb = self._live_ssb(1, 5, 5, 5, 5)
+        follower = LogFollower(ssb, self.LOGSPACE_NAME, backlog=2)
+
+        self.assertListEqual(["old 3", "old 4"], [log['message'] for log in follower.start()])
+        ssb.add_logs([self._log(5, "new 1")])
+        self.assertListEqual(["new 1"], [log['message'] for log in follower.poll()])
+
+    def test_poll_pages_through_many_new_logs(self):
+        ssb = self._live_ssb(0)
+        follower = LogFollower(ssb, self.LOGSPACE_NAME, backlog=0, page_size=7)
+        follower.start()
+
+        ssb.add_logs([self._log(1 + i // 3, "new %d" % i) for i in range(50)])
+
+        self.assertListEqual(["new %d" % i for i in range(50)], [log['message'] for log in follower.poll()])
+
+    def test_follow_polls_faster_while_logs_are_flowing(self):
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            if len(sleeps) == 8:
+                raise KeyboardInterrupt
+
+        follower = MockScriptedFollower([[], [], [], [1], [2], [], [], [], []])
+        logs = []
+        with self.assertRaises(KeyboardInterrupt):
+            for log in follow_logs(follower, min_interval=1, max_interval=3, sleep=sleep):
+                logs.append(log)
+
+        self.assertListEqual([0, 1, 2], logs)
+        self.assertListEqual([1, 2, 3, 1, 1, 1, 2, 3], sleeps)
+
+    def test_empty_polls_are_yielded_on_request_and_still_slow_the_polling_down(self):
+        sleeps = []
+        pages = follow_pages(MockScriptedFollower([]), min_interval=1, max_interval=8, sleep=sleeps.append,
+                             empty_pages=True)
+
+        self.assertListEqual([[0], [], [], [], []], [next(pages) for i in range(5)])
+        self.assertListEqual([1, 2, 4], sleeps)
+
+    def test_merge_proxy_follows_every_SSB_in_timestamp_order(self):
+        ssbs = (self._live_ssb(1, 3), self._live_ssb(2, 4))
+        logs = MergeProxy(ssbs).follow(self.LOGSPACE_NAME, backlog=3, min_interval=0)
+
+        self.assertListEqual([2, 3, 4], [next(logs)['processed_timestamp'] for i in range(3)])
+        ssbs[1].add_logs([self._log(6, "new 1")])
+        ssbs[0].add_logs([self._log(5, "new 2")])
+        self.assertListEqual(["new 2", "new 1"], [next(logs)['message'] for i in range(2)])
+
+
+class MockScriptedFollower:
+    def __init__(self, polls):
+        self._polls = polls
+
+    def start(self):
+        return [0]
+
+    def poll(self):
+        return self._polls.pop(0) if self._polls else []
+
+
+class MockSSB():
+    def __init__(self):
+        self.logspaces = set()
+        self.calls = []
+        self._number_of_messages = 0
+        self._logs = []
+        self._delay = None
+
+    def set_delay(self, delay_func):
+        self._delay = delay_func
+
+    def _wait(self):
+        if self._delay is not None:
+            self._delay()
+
+    def set_logspaces(self, logspaces):
+        self._logspaces = logspaces
+
+    def set_logs(self, logs):
+        self._logs = logs
+
+    def set_number_of_messages(self, number_of_messages):
+        self._number_of_messages = number_of_messages
+
+    def get_calls(self):
+        return self.calls
+
+    def login(self, *args):
+        self.calls.append({"func": "login", "args": args, "kwarg": {}})
+        self._wait()
+
+    def refresh_session(self):
+        self.calls.append({"func": "refresh_session", "args": (), "kwarg": {}})
+        self._wait()
+
+    def logout(self):
+        self.calls.append({"func": "logout", "args": (), "kwarg": {}})
+
+    def number_of_messages(self, *args, **kwargs):
+        self.calls.append({"func": "number_of_messages", "args": args, "kwarg": kwargs})
+        self._wait()
+        return self._number_of_messages
+
+    def filter(self, logspace, from_timestamp=0, to_timestamp=9999999999, *args, **kwargs):
+        self.calls.append({"func": "filter", "args": (logspace, from_timestamp, to_timestamp) + args, "kwarg": kwargs})
+        self._wait()
+        offset = kwargs.get('offset', 0)
+        limit = kwargs.get('limit', len(self._logs))
+        logs = [log for log in self._logs if int(from_timestamp) <= log['processed_timestamp'] < int(to_timestamp)]
+        return logs[offset:offset + limit]
+
+    def list_logspaces(self):
+        self.calls.append({"func": "list_logspaces", "args": (), "kwarg": {}})
+        self._wait()
+        return self._logspaces
+
+class MockStreamingSSB(MockSSB):
+    def __init__(self):
+        super().__init__()
+        self.open_streams = 0
+
+    def iter_filter(self, *args, **kwargs):
+        logs = self.filter(*args, **kwargs)
+        self.calls[-1]['func'] = "iter_filter"
+        self.open_streams += 1
+        return MockStream(self, logs)
+
+
+class MockStream:
+    # counts as open until it's read to the end or closed, even if it was never read
+    def __init__(self, ssb, logs):
+        self._ssb = ssb
+        self._logs = iter(logs)
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._logs)
+        except StopIteration:
+            self.close()
+            raise
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._ssb.open_streams -= 1
+
+class MockLiveSSB(MockSSB):
+    # logs keep arriving, and number_of_messages counts them
+    def add_logs(self, logs):
+        self._logs = self._logs + logs
+
+    def number_of_messages(self, logspace, from_timestamp=0, to_timestamp=9999999999, *args, **kwargs):
+        super().number_of_messages(logspace, from_timestamp, to_timestamp, *args, **kwargs)
+        return len([log for log in self._logs if int(from_timestamp) <= log['processed_timestamp'] < int(to_timestamp)])
+
+
+class MergeProxyServerTest(unittest.TestCase):
+    LOGSPACE_NAME = "testlogspacename"
+
+    def _server_with_logs(self, *timestamps):
+        ssb = MockLiveSSB()
+        ssb.add_logs([{'processed_timestamp': timestamp} for timestamp in timestamps])
+        return MergeProxyServer(MergeProxy((ssb, ))), ssb
+
+    def _read_stream(self, body, chunks=None):
+        return ''.join(chunk.decode() for chunk in itertools.islice(body, chunks))
+
+    def test_filter_stream_sends_ndjson_records(self):
+        (server, ssb) = self._server_with_logs(*range(1000))
+
+        body = server.filter_stream(self.LOGSPACE_NAME, offset="10", limit="600")
+
+        self.assertEqual('application/x-ndjson', cherrypy.response.headers['Content-Type'])
+        lines = self._read_stream(body).splitlines()
+        self.assertListEqual(list(range(10, 610)), [json.loads(line)['processed_timestamp'] for line in lines])
+
+    def test_compact_results_are_sent_as_json(self):
+        ssb = MockLiveSSB()
+        ssb.add_logs([{'processed_timestamp': timestamp} for timestamp in range(3)])
+        server = MergeProxyServer(MergeProxy((ssb, ), compact=True))
+
+        self.assertEqual([{'processed_timestamp': 1}, {'processed_timestamp': 2}],
+                         server.filter(self.LOGSPACE_NAME, offset="1", limit="5"))
+        body = server.filter_stream(self.LOGSPACE_NAME)
+        self.assertEqual('{"processed_timestamp": 0}\n', self._read_stream(body).splitlines(True)[0])
+
+    def test_raw_json_of_the_ssbs_is_merged_and_sent_as_it_arrived(self):
+        fake_ssbs = [FakeSSB([SyntheticLogspace(self.LOGSPACE_NAME, 50, logs_per_second=1, host_prefix=prefix)]).start()
+                     for prefix in ('first', 'second')]
+        for fake_ssb in fake_ssbs:
+            self.addCleanup(fake_ssb.stop)
+        ssbs = tuple(SSB(fake_ssb.address, context=FakeSSB.client_context()) for fake_ssb in fake_ssbs)
+        for ssb in ssbs:
+            ssb.login("user", "password")
+            self.addCleanup(ssb.conn.close)
+        server = MergeProxyServer(MergeProxy(ssbs, raw_json=True))
+
+        logs = server.filter(self.LOGSPACE_NAME, offset="5", limit="20")
+        lines = self._read_stream(server.filter_stream(self.LOGSPACE_NAME, offset="5", limit="20")).splitlines()
+
+        self.assertTrue(all(isinstance(log, RawRecord) for log in logs))
+        expected = [fake_ssbs[index % 2].logspaces[self.LOGSPACE_NAME].log(index // 2) for index in range(5, 25)]
+        self.assertListEqual(expected, [json.loads(line) for line in lines])
+        self.assertListEqual(expected, json.loads(server.encoder.encode(logs).decode()))
+        # the same text as in the SSB response, not encoded again
+        self.assertListEqual([json.dumps(log) for log in expected], lines)
+
+    def test_logs_of_ssbs_which_cannot_stream_are_encoded_for_raw_json(self):
+        ssb = MockSSB()
+        ssb.set_logs([{'processed_timestamp': timestamp} for timestamp in range(3)])
+        server = MergeProxyServer(MergeProxy((ssb, ), raw_json=True))
+
+        logs = server.filter(self.LOGSPACE_NAME, limit="5")
+
+        self.assertEqual(b'[{"processed_timestamp": 0},{"processed_timestamp": 1},{"processed_timestamp": 2}]',
+                         server.encoder.encode(logs))
+
+    def test_fast_json_streams_the_same_records(self):
+        ssb = MockLiveSSB()
+        ssb.add_logs([{'processed_timestamp': timestamp, 'message': "árvíztűrő"} for timestamp in range(3)])
+        server = MergeProxyServer(MergeProxy((ssb, )), fast_json=True)
+
+        lines = self._read_stream(server.filter_stream(self.LOGSPACE_NAME, format='sse')).split('\n\n')
+
+        self.assertListEqual([{'processed_timestamp': timestamp, 'message': "árvíztűrő"} for timestamp in range(3)],
+                             [json.loads(line[len('data: '):]) for line in lines if line])
+
+    def _load_request(self, headers):
+        # a request of its own, like the ones cherrypy serves
+        (request, response) = (cherrypy.serving.request, cherrypy.serving.response)
+        self.addCleanup(cherrypy.serving.load, request, response)
+        new_request = cherrypy._cprequest.Request(cherrypy.lib.httputil.Host('127.0.0.1', 443),
+                                                  cherrypy.lib.httputil.Host('127.0.0.1', 50000))
+        new_request.headers = cherrypy.lib.httputil.HeaderMap()  # the one of the class is shared
+        new_request.headers.update(headers)
+        cherrypy.serving.load(new_request, cherrypy._cprequest.Response())
+
+    def test_responses_are_compressed_for_the_clients_accepting_that(self):
+        self._load_request({'Accept-Encoding': 'deflate;q=0.5, gzip'})
+        body = json.dumps([{'processed_timestamp': timestamp} for timestamp in range(100)]).encode()
+        cherrypy.response.body = body
+
+        merge_proxy._compress_response()
+
+        self.assertEqual('gzip', cherrypy.response.headers['Content-Encoding'])
+        self.assertEqual('Accept-Encoding', cherrypy.response.headers['Vary'])
+        self.assertEqual(body, gzip.decompress(b''.join(cherrypy.response.body)))
+
+    def test_small_or_unaccepted_responses_are_not_compressed(self):
+        for (headers, body) in (({'Accept-Encoding': 'gzip'}, b'[1, 2]'), ({}, b'[1, 2]' * 1000),
+                                ({'Accept-Encoding': 'br'}, b'[1, 2]' * 1000)):
+            self._load_request(headers)
+            cherrypy.response.body = body
+
+            merge_proxy._compress_response()
+
+            self.assertNotIn('Content-Encoding', cherrypy.response.headers)
+            self.assertEqual(body, b''.join(cherrypy.response.body))
+
+    def test_each_chunk_of_a_compressed_stream_is_sent_right_away(self):
+        (server, ssb) = self._server_with_logs(*range(10))
+        self._load_request({'Accept-Encoding': 'gzip'})
+        cherrypy.response.stream = True
+        cherrypy.response.body = server.follow_stream(self.LOGSPACE_NAME, backlog="3")
+
+        merge_proxy._compress_response()
+
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        body = iter(cherrypy.response.body)
+        self.assertEqual(b'data: {"processed_timestamp": 7}\n\ndata: {"processed_timestamp": 8}\n\n'
+                         b'data: {"processed_timestamp": 9}\n\n', decompressor.decompress(next(body)))
+        self.assertEqual(b': keep-alive\n\n', decompressor.decompress(next(body)))
+        body.close()
+
+    def _settled_server(self, ssb, **kwargs):
+        return MergeProxyServer(MergeProxy((ssb, ), **kwargs), settle_time=60, clock=lambda: 1000)
+
+    def test_settled_ranges_have_an_etag_and_are_not_queried_again(self):
+        ssb = MockSSB()
+        ssb.set_logs([{'processed_timestamp': timestamp} for timestamp in range(10)])
+        server = self._settled_server(ssb)
+        self._load_request({})
+
+        logs = server.filter(self.LOGSPACE_NAME, to_timestamp="940", limit="5")
+        etag = cherrypy.response.headers['ETag']
+        self._load_request({'If-None-Match': '"other", %s' % etag})
+
+        with self.assertRaises(cherrypy.HTTPRedirect) as raised:
+            server.filter(self.LOGSPACE_NAME, to_timestamp="940", limit="5")
+        self.assertEqual(304, raised.exception.status)
+        self.assertEqual(1, len(ssb.get_calls()))
+        self.assertEqual(5, len(logs))
+        self.assertTrue(etag.startswith('W/"'))
+
+    def test_etags_differ_by_the_query(self):
+        ssb = MockSSB()
+        server = self._settled_server(ssb)
+        etags = set()
+
+        for (command, kwargs) in (("filter", {'to_timestamp': "940", 'limit': "5"}),
+                                  ("filter", {'to_timestamp': "940", 'limit': "6"}),
+                                  ("filter", {'to_timestamp': "930", 'limit': "5"}),
+                                  ("number_of_messages", {'to_timestamp': "940"})):
+            self._load_request({'If-None-Match': ', '.join(etags)})
+            getattr(server, command)(self.LOGSPACE_NAME, **kwargs)
+            etags.add(cherrypy.response.headers['ETag'])
+
+        self.assertEqual(4, len(etags))
+        self.assertNotEqual(server.merge_proxy.query_etag("filter", self.LOGSPACE_NAME, {}),
+                            self._settled_server(ssb, routing=RoutingTable({self.LOGSPACE_NAME: [("0", "other", 1)]}))
+                            .merge_proxy.query_etag("filter", self.LOGSPACE_NAME, {}))
+
+    def test_ranges_which_may_still_change_have_no_etag(self):
+        ssb = MockSSB()
+        server = self._settled_server(ssb)
+
+        for kwargs in ({}, {'to_timestamp': "941"}, {'to_timestamp': "9999999999"}):
+            self._load_request({'If-None-Match': '*'})
+            server.number_of_messages(self.LOGSPACE_NAME, **kwargs)
+            self.assertNotIn('ETag', cherrypy.response.headers)
+
+    def test_filter_stream_sends_server_sent_events(self):
+        (server, ssb) = self._server_with_logs(1, 2)
+
+        body = server.filter_stream(self.LOGSPACE_NAME, format='sse')
+
+        self.assertEqual('text/event-stream', cherrypy.response.headers['Content-Type'])
+        self.assertEqual('data: {"processed_timestamp": 1}\n\ndata: {"processed_timestamp": 2}\n\n',
+                         self._read_stream(body))
+
+    def test_unknown_stream_format_is_a_bad_request(self):
+        (server, ssb) = self._server_with_logs(1)
+
+        with self.assertRaises(cherrypy.HTTPError):
+            server.filter_stream(self.LOGSPACE_NAME, format='xml')
+
+    def test_failure_during_streaming_is_sent_as_the_last_record(self):
+        (server, ssb) = self._server_with_logs(1)
+
+        def fail():
+            raise ConnectionError("SSB went away")
+
+        ssb.set_delay(fail)
+        lines = self._read_stream(server.filter_stream(self.LOGSPACE_NAME)).splitlines()
+
+        self.assertEqual({'error': "SSB went away"}, json.loads(lines[-1]))
+
+    def test_follow_stream_sends_the_backlog_then_the_new_logs_and_keep_alives(self):
+        (server, ssb) = self._server_with_logs(1, 2, 3)
+
+        body = server.follow_stream(self.LOGSPACE_NAME, backlog="2")
+
+        self.assertEqual('data: {"processed_timestamp": 2}\n\ndata: {"processed_timestamp": 3}\n\n',
+                         self._read_stream(body, 1))
+        self.assertEqual(': keep-alive\n\n', self._read_stream(body, 1))
+        ssb.add_logs([{'processed_timestamp': 4}])
+        self.assertEqual('data: {"processed_timestamp": 4}\n\n', self._read_stream(body, 1))
+        body.close()
+
+    def test_follows_over_max_follows_get_a_503_until_one_is_closed(self):
+        ssb = MockLiveSSB()
+        server = MergeProxyServer(MergeProxy((ssb, )), max_follows=2)
+        first = server.follow_stream(self.LOGSPACE_NAME)
+        self._read_stream(first, 1)
+        second = server.follow_stream(self.LOGSPACE_NAME)
+
+        with self.assertRaises(cherrypy.HTTPError) as raised:
+            server.follow_stream(self.LOGSPACE_NAME)
+        self.assertEqual(503, raised.exception.status)
+
+        first.close()
+        second.close()
+        for i in range(2):
+            server.follow_stream(self.LOGSPACE_NAME).close()
+
+
+class MergeProxyConfigTest(unittest.TestCase):
+    def test_get_servers_returns_a_list(self):
+        servers = self._feed_with_sample_2_server_config_and_return_what_get_servers_returns()
+        self.assertEqual(type(list()), type(servers))
+
+    def _feed_with_sample_2_server_config_and_return_what_get_servers_returns(self):
+        config_text = """
+[server1.serverhost]
+user=a
+password=a
+[1.2.3.4]
+user=a
+password=a
+"""
+        config = MergeProxyConfig(config_text)
+        return config.get_servers()
+
+    def test_returns_all_servers(self):
+        servers = self._feed_with_sample_2_server_config_and_return_what_get_servers_returns()
+        self.assertEqual(2, len(servers))
+
+    def test_all_returned_servers_are_objects_with_user_and_pass_fields(self):
+        servers = self._feed_with_sample_2_server_config_and_return_what_get_servers_returns()
+        for server in servers:
+            self.assertEqual(type({}), type(server))
+
+    def test_user_and_password_keys_are_case_insensitive(self):
+        config = MergeProxyConfig("""
+[ssb1]
+User=a
+PASSWORD=b
+""")
+
+        self.assertListEqual([{'address': "ssb1", 'user': "a", 'password': "b"}], config.get_servers())
+
+    def test_logspace_sections_are_routes_not_servers(self):
+        config = MergeProxyConfig("""
+[ssb1]
+user=a
+password=a
+[SSB2]
+user=b
+password=b
+[logspace:center]
+ssb1 = center
+SSB2 = center_eu, 2
+""")
+
+        self.assertListEqual(['ssb1', 'SSB2'], [server['address'] for server in config.get_servers()])
+        routing = config.get_routing()
+        self.assertListEqual([(1, 'center_eu'), (0, 'center')], routing.route('center', ['ssb1', 'SSB2']))
+        self.assertListEqual([(0, 'other'), (1, 'other')], routing.route('other', ['ssb1', 'SSB2']))
+
+    def test_no_routing_without_logspace_sections(self):
+        self.assertIsNone(MergeProxyConfig("[ssb1]\nuser=a\npassword=a\n").get_routing())
+
+    def test_routes_to_unknown_servers_or_with_bad_weights_raise_routing_error(self):
+        for route in ("ssb2 = center", "ssb1 = center, heavy", "ssb1 = center, -1"):
+            config = MergeProxyConfig("[ssb1]\nuser=a\npassword=a\n[logspace:center]\n%s\n" % route)
+            with self.assertRaises(RoutingError):
+                config.get_routing()
+
+
+class RoutingTest(unittest.TestCase):
+    def _ssb(self, logspaces, *timestamps, host=None):
+        ssb = MockLiveSSB()
+        ssb.set_logspaces(set(logspaces))
+        ssb.add_logs([{'processed_timestamp': timestamp, 'host': host} for timestamp in timestamps])
+        return ssb
+
+    def _ssbs_and_proxy(self, **kwargs):
+        ssbs = (self._ssb(["center", "local"], 1, 3, host=0), self._ssb(["center_eu", "center"], 2, 3, host=1),
+                self._ssb(["center"], 5, host=2))
+        routing = RoutingTable({"center": [("0", "center", 1), ("1", "center_eu", 2), ("2", "center", 0)]})
+        return ssbs, MergeProxy(ssbs, routing=routing, **kwargs)
+
+    def _queried_logspaces(self, ssb):
+        return [call['args'][0] for call in ssb.get_calls() if call['func'] in ("filter", "number_of_messages")]
+
+    def test_routed_logspace_is_queried_on_its_routes_under_their_names(self):
+        (ssbs, proxy) = self._ssbs_and_proxy()
+
+        self.assertEqual(4, proxy.number_of_messages("center"))
+        logs = proxy.filter("center", limit=10)
+
+        self.assertListEqual([(1, 0), (2, 1), (3, 1), (3, 0)], [(log['processed_timestamp'], log['host'])
+                                                                  for log in logs])
+        self.assertListEqual(["center", "center"], self._queried_logspaces(ssbs[0]))
+        self.assertListEqual(["center_eu", "center_eu"], self._queried_logspaces(ssbs[1]))
+        self.assertListEqual([], self._queried_logspaces(ssbs[2]))
+
+    def test_unrouted_logspace_goes_to_every_SSB(self):
+        (ssbs, proxy) = self._ssbs_and_proxy()
+
+        proxy.number_of_messages("local")
+
+        for ssb in ssbs:
+            self.assertListEqual(["local"], self._queried_logspaces(ssb))
+
+    def test_aliases_are_listed_with_the_name_of_the_proxy(self):
+        (ssbs, proxy) = self._ssbs_and_proxy()
+
+        self.assertSetEqual({"center", "local"}, proxy.list_logspaces())
+
+    def test_follower_polls_the_routes(self):
+        (ssbs, proxy) = self._ssbs_and_proxy()
+
+        follower = proxy.follower("center", backlog=10)
+
+        self.assertListEqual([1, 2, 3, 3], [log['processed_timestamp'] for log in follower.start()])
+        self.assertListEqual([], self._queried_logspaces(ssbs[2]))
+
+    def test_routes_are_planned_with_their_names(self):
+        (ssbs, proxy) = self._ssbs_and_proxy(planner=QueryPlanner())
+
+        self.assertEqual(2, proxy.number_of_messages("center", 0, 3))
+        self.assertListEqual(["center_eu", "center_eu"], self._queried_logspaces(ssbs[1]))
+
+    def test_route_to_unknown_SSB_raises_routing_error(self):
+        with self.assertRaises(RoutingError):
+            MergeProxy((MockSSB(), ), routing=RoutingTable({"center": [("1", "center", 1)]}))
+
+    def test_validation_asks_all_the_SSBs_at_once(self):
+        (ssbs, proxy) = self._ssbs_and_proxy()
+        for ssb in ssbs:
+            ssb.set_delay(lambda: time.sleep(0.2))
+
+        started = time.time()
+        proxy.validate_routing()
+
+        self.assertLess(time.time() - started, 0.4)
+
+    def test_validation_reports_every_route_leading_nowhere(self):
+        ssbs = (self._ssb(["center"]), self._ssb(["local"]), self._ssb(["local"]))
+
+        def fail():
+            raise ConnectionError("SSB went away")
+
+        ssbs[2].set_delay(fail)
+        routing = RoutingTable({"center": [("0", "center", 1), ("1", "center_eu", 1)],
+                                "local": [("2", "local", 1)]})
+
+        with self.assertRaises(RoutingError) as raised:
+            MergeProxy(ssbs, routing=routing).validate_routing()
+        self.assertIn("'center_eu' on 1", str(raised.exception))
+        self.assertNotIn(" 0", str(raised.exception))
+        self.assertNotIn(" 2", str(raised.exception))
+
+    def test_SSBs_which_can_not_be_listed_are_not_routing_problems(self):
+        ssbs = (self._ssb(["center"]), self._ssb(["local"]))
+
+        def fail():
+            raise ConnectionError("SSB went away")
+
+        ssbs[1].set_delay(fail)
+        routing = RoutingTable({"center": [("0", "center", 1)], "local": [("1", "local", 1)]})
+
+        MergeProxy(ssbs, routing=routing).validate_routing()
 
-    def test_all_returned_servers_are_objects_with_user_and_pass_fields(self):
-        servers = self._feed_with_sample_2_server_config_and_return_what_get_servers_returns()
-        for server in servers:
-            self.assertEqual(type({}), type(server))
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,114 @@
+# Renders SSB logs as text lines, a whole page at a time into a single write. Works on both python 2
+# and 3, as the exporter scripts use it too.
+import calendar
+import io
+import json
+import time
+
+MODES = ('iso', 'rfc3164', 'rfc5424', 'jsonl')
+
+_TIMESTAMP_FORMATS = {
+    'iso': '%Y-%m-%dT%H:%M:%S',
+    'rfc3164': '%b {day} %H:%M:%S',  # the day is padded with a space, which strftime can't do portably
+    'rfc5424': '%Y-%m-%dT%H:%M:%S',
+}
+
+_MAX_CACHED_TIMESTAMPS = 4096
+
+
+class SyslogFormatter(object):
+    def __init__(self, mode='iso', utc=True, timestamp_field='timestamp', encoding='utf-8'):
+        if mode not in MODES:
+            raise ValueError("Unknown output mode '%s', it should be one of %s" % (mode, ', '.join(MODES)))
+        self._mode = mode
+        self._utc = utc
+        self._timestamp_field = timestamp_field
+        self._encoding = encoding
+        self._timestamp_strings = {}
+        self._json_encoder = json.JSONEncoder(ensure_ascii=False, default=_as_dict)
+        self._format_line = getattr(self, '_format_%s' % mode)
+
+    def format_page(self, logs):
+        lines = [self._format_line(log) for log in logs]
+        if not lines:
+            return u''
+        lines.append(u'')
+        return u'\n'.join(lines)
+
+    def write_page(self, logs, stream):
+        text = self.format_page(logs)
+        if not text:
+            return
+        if hasattr(stream, 'buffer'):
+            stream.buffer.write(text.encode(self._encoding))
+        elif isinstance(stream, io.TextIOBase):
+            stream.write(text)
+        else:
+            stream.write(text.encode(self._encoding))
+
+    def _timestamp_string(self, timestamp):
+        # a page mostly has lots of logs from the same few seconds, so each second is rendered only once
+        second = int(timestamp)
+        try:
+            return self._timestamp_strings[second]
+        except KeyError:
+            pass
+        if len(self._timestamp_strings) >= _MAX_CACHED_TIMESTAMPS:
+            self._timestamp_strings.clear()
+        time_struct = time.gmtime(second) if self._utc else time.localtime(second)
+        timestamp_format = _TIMESTAMP_FORMATS[self._mode].replace('{day}', '%2d' % time_struct.tm_mday)
+        timestamp_string = time.strftime(timestamp_format, time_struct)
+        if self._mode == 'rfc5424':
+            timestamp_string += self._utc_offset(second, time_struct)
+        self._timestamp_strings[second] = timestamp_string
+        return timestamp_string
+
+    def _utc_offset(self, second, time_struct):
+        if self._utc:
+            return 'Z'
+        offset_minutes = (calendar.timegm(time_struct) - second) // 60
+        sign = '+' if offset_minutes >= 0 else '-'
+        return '%s%02d:%02d' % (sign, abs(offset_minutes) // 60, abs(offset_minutes) % 60)
+
+    def _format_iso(self, log):
+        return u'%s %s %s: %s' % (self._timestamp_string(log[self._timestamp_field]),
+                                  log['host'], _tag(log), log['message'])
+
+    def _format_rfc3164(self, log):
+        return u'<%d>%s %s %s: %s' % (_priority(log), self._timestamp_string(log[self._timestamp_field]),
+                                      log['host'], _tag(log), log['message'])
+
+    def _format_rfc5424(self, log):
+        return u'<%d>1 %s %s %s %s - - %s' % (_priority(log), self._timestamp_string(log[self._timestamp_field]),
+                                             _nil_if_empty(log['host']), _nil_if_empty(log['program']),
+                                             _nil_if_empty(log.get('pid')), log['message'])
+
+    def _format_jsonl(self, log):
+        return self._json_encoder.encode(log)
+
+
+def _as_dict(value):
+    # the compact LogRecords of the merge proxy are written like the dicts they were made of
+    if hasattr(value, 'as_dict'):
+        return value.as_dict()
+    raise TypeError("%r is not JSON serializable" % (value, ))
+
+
+def _priority(log):
+    facility = log.get('facility')
+    severity = log.get('priority')
+    if isinstance(facility, int) and isinstance(severity, int):
+        return facility * 8 + severity
+    return 13  # user.notice
+
+
+def _tag(log):
+    # the logs of the programs not telling their pid have none
+    pid = log.get('pid')
+    if pid is None or pid == u'':
+        return log['program']
+    return u'%s[%s]' % (log['program'], pid)
+
+
+def _nil_if_empty(value):
+    return u'-' if value is None or value == u'' else value
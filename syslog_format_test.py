@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# the formatter is shared with the exporter, so these run on python 2 too
+import io
+import json
+import sys
+import time
+import unittest
+from syslog_format import *
+
+
+class SyslogFormatterTests(unittest.TestCase):
+    # 2015-03-05 23:51:47 UTC
+    TIMESTAMP = 1425599507
+    LOG = {'timestamp': TIMESTAMP, 'processed_timestamp': TIMESTAMP + 1, 'host': "testhost", 'program': "sshd",
+           'pid': 1234, 'message': u"Accepted publickey for árvíztűrő"}
+
+    def test_iso_mode_is_the_classic_exporter_format_in_utc(self):
+        formatter = SyslogFormatter('iso')
+
+        self.assertEqual(u"2015-03-05T23:51:47 testhost sshd[1234]: Accepted publickey for árvíztűrő\n",
+                         formatter.format_page([self.LOG]))
+
+    def test_rfc3164_mode_pads_the_day_with_a_space(self):
+        log = dict(self.LOG, timestamp=self.TIMESTAMP - 4 * 86400)
+
+        self.assertEqual(u"<13>Mar  1 23:51:47 testhost sshd[1234]: Accepted publickey for árvíztűrő\n",
+                         SyslogFormatter('rfc3164').format_page([log]))
+
+    def test_rfc3164_priority_is_taken_from_the_log_if_it_has_one(self):
+        log = dict(self.LOG, facility=4, priority=6)
+
+        self.assertTrue(SyslogFormatter('rfc3164').format_page([log]).startswith(u"<38>Mar  5 "))
+
+    def test_logs_without_pid_have_no_brackets(self):
+        log = dict(self.LOG)
+        del log['pid']
+
+        self.assertEqual(u"2015-03-05T23:51:47 testhost sshd: Accepted publickey for árvíztűrő\n",
+                         SyslogFormatter('iso').format_page([log]))
+        self.assertTrue(SyslogFormatter('rfc5424').format_page([log]).startswith(u"<13>1 2015-03-05T23:51:47Z "
+                                                                                u"testhost sshd - - - "))
+
+    def test_rfc5424_mode_has_version_priority_and_utc_offset(self):
+        self.assertEqual(u"<13>1 2015-03-05T23:51:47Z testhost sshd 1234 - - Accepted publickey for árvíztűrő\n",
+                         SyslogFormatter('rfc5424').format_page([self.LOG]))
+
+    def test_rfc5424_priority_is_taken_from_the_log_if_it_has_one(self):
+        log = dict(self.LOG, facility=4, priority=6)
+
+        self.assertTrue(SyslogFormatter('rfc5424').format_page([log]).startswith(u"<38>1 "))
+
+    def test_rfc5424_mode_writes_nil_for_empty_fields_only(self):
+        log = dict(self.LOG, host="", pid=0)
+
+        self.assertEqual(u"<13>1 2015-03-05T23:51:47Z - sshd 0 - - Accepted publickey for árvíztűrő\n",
+                         SyslogFormatter('rfc5424').format_page([log]))
+
+    def test_rfc5424_mode_in_local_time_has_the_local_offset(self):
+        line = SyslogFormatter('rfc5424', utc=False).format_page([self.LOG])
+
+        local_time = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.TIMESTAMP))
+        assert_regex = self.assertRegex if sys.version_info[0] > 2 else self.assertRegexpMatches
+        assert_regex(line, r"^<13>1 %s(Z|[+-]\d\d:\d\d) " % local_time)
+
+    def test_jsonl_mode_writes_one_json_object_per_line(self):
+        lines = SyslogFormatter('jsonl').format_page([self.LOG, self.LOG]).splitlines()
+
+        self.assertEqual(2, len(lines))
+        self.assertEqual(self.LOG, json.loads(lines[1]))
+
+    def test_timestamp_field_can_be_changed(self):
+        formatter = SyslogFormatter('iso', timestamp_field='processed_timestamp')
+
+        self.assertTrue(formatter.format_page([self.LOG]).startswith(u"2015-03-05T23:51:48 "))
+
+    def test_logs_in_different_seconds_get_their_own_timestamps(self):
+        logs = [dict(self.LOG, timestamp=self.TIMESTAMP + i) for i in range(0, 10000, 7)]
+
+        lines = SyslogFormatter('iso').format_page(logs).splitlines()
+
+        for (log, line) in zip(logs, lines):
+            self.assertTrue(line.startswith(time.strftime('%Y-%m-%dT%H:%M:%S ', time.gmtime(log['timestamp']))))
+
+    def test_empty_page_is_empty_string(self):
+        self.assertEqual(u"", SyslogFormatter().format_page([]))
+
+    def test_unknown_mode_raises_value_error(self):
+        with self.assertRaises(ValueError):
+            SyslogFormatter('xml')
+
+    def test_page_is_written_encoded_to_binary_streams(self):
+        stream = io.BytesIO()
+
+        SyslogFormatter().write_page([self.LOG], stream)
+
+        self.assertEqual(SyslogFormatter().format_page([self.LOG]).encode('utf-8'), stream.getvalue())
+
+    def test_page_is_written_as_text_to_text_streams(self):
+        stream = io.StringIO()
+
+        SyslogFormatter().write_page([self.LOG], stream)
+
+        self.assertEqual(SyslogFormatter().format_page([self.LOG]), stream.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
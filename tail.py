@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+import argparse
+import shlex
+import ssl
+import sys
+
+from merge_proxy import SSB, FOLLOW_MAX_INTERVAL, FOLLOW_MIN_INTERVAL, LogFollower, follow_pages
+from syslog_format import MODES, SyslogFormatter
+
+
+def read_credentials(path):
+    # the same KEY="value" file the shell scripts source
+    credentials = {}
+    with open(path) as credentials_file:
+        for line in credentials_file:
+            (key, separator, value) = line.strip().partition('=')
+            if separator:
+                credentials[key] = ''.join(shlex.split(value))
+    return credentials
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Prints the logs of an SSB logspace as they arrive, like tail -f')
+    parser.add_argument('search_expression', nargs='?', default=None)
+    parser.add_argument('--logspace', default='center')
+    parser.add_argument('--backlog', type=int, default=10, help='number of already stored logs printed first')
+    parser.add_argument('--min-interval', type=float, default=FOLLOW_MIN_INTERVAL,
+                        help='seconds between the polls while logs are arriving')
+    parser.add_argument('--max-interval', type=float, default=FOLLOW_MAX_INTERVAL,
+                        help='the polls slow down to this many seconds on an idle logspace')
+    parser.add_argument('--format', choices=MODES, default='iso')
+    parser.add_argument('--credentials', default='ssb_credentials')
+    parser.add_argument('--no-check-certificate', action='store_true',
+                        help="don't verify the certificate of the SSB, like wget in the shell scripts")
+    return parser.parse_args()
+
+
+def main():
+    arguments = parse_arguments()
+    credentials = read_credentials(arguments.credentials)
+    context = ssl._create_unverified_context() if arguments.no_check_certificate else None
+    ssb = SSB(credentials['SSB_IP'], context=context)
+    ssb.login(credentials['USERNAME'], credentials['PASSWORD'])
+
+    formatter = SyslogFormatter(arguments.format, timestamp_field='processed_timestamp')
+    follower = LogFollower(ssb, arguments.logspace, arguments.search_expression, arguments.backlog)
+    try:
+        # everything a poll brought is written at once
+        for page in follow_pages(follower, arguments.min_interval, arguments.max_interval):
+            formatter.write_page(page, sys.stdout)
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        ssb.logout()
+
+
+if __name__ == '__main__':
+    main()